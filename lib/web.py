@@ -89,15 +89,57 @@ class WebServer:
                 pass
 
             if path == '/pid':
-                if 'setpoint' in data: self.config.set('setpoint', data['setpoint'])
-                if 'lower_limit' in data: self.config.set('lower_limit', data['lower_limit'])
+                updates = {}
+                if 'setpoint' in data: updates['setpoint'] = data['setpoint']
+                if 'lower_limit' in data: updates['lower_limit'] = data['lower_limit']
+                if updates: self.config.update(updates) # One save
                 return json.dumps({"status": "ok"})
+            elif path == '/batch':
+                return json.dumps(self.batch(data))
             elif path == '/config':
                 self.config.update(data)
                 return json.dumps({"status": "ok"})
 
         return json.dumps({"error": "not found"})
 
+    def batch(self, data):
+        # Ordered set/get ops: all validated first, then applied with one save
+        ops = data.get('ops') if isinstance(data, dict) else None
+        if not isinstance(ops, list) or not ops:
+            return {"status": "err", "errors": ["ops must be a non-empty list"]}
+
+        view = dict(self.config.config)
+        view.update(self.get_status_callback())
+        updates = {}
+        results = []
+        errors = []
+        for i, op in enumerate(ops):
+            kind = op.get('op') if isinstance(op, dict) else None
+            key = op.get('key') if kind else None
+            if key is not None and not isinstance(key, str):
+                errors.append("%d: key must be a string" % i)
+            elif kind == 'set':
+                if key not in self.config.config or op.get('value') is None:
+                    errors.append("%d: bad set %r" % (i, key))
+                else:
+                    updates[key] = view[key] = op['value']
+                    results.append({"op": "set", "key": key, "value": op['value']})
+            elif kind == 'get':
+                if key is None:
+                    results.append({"op": "get", "value": dict(view)})
+                elif key in view:
+                    results.append({"op": "get", "key": key, "value": view[key]})
+                else:
+                    errors.append("%d: unknown key %r" % (i, key))
+            else:
+                errors.append("%d: op must be 'set' or 'get'" % i)
+
+        if errors:
+            return {"status": "err", "errors": errors}
+        if updates:
+            self.config.update(updates)
+        return {"status": "ok", "results": results}
+
     async def start(self):
         print("Starting Web Server on port 80...")
         try:
@@ -12,7 +12,8 @@ class WiFiManager:
         if network:
             self.ap = network.WLAN(network.AP_IF)
 
-    def start_ap(self):
+    def start_ap(self, wait=True):
+        # wait=False returns immediately; call poll() until it reports True
         if not self.ap:
             print(f"Mock AP started: SSID={self.ssid}, IP=192.168.4.1")
             return
@@ -20,6 +21,8 @@ class WiFiManager:
         self.ap.active(True)
         # authmode=3 is WPA2-PSK
         self.ap.config(essid=self.ssid, password=self.password, authmode=3)
+        if not wait:
+            return
 
         # Wait for active
         retries = 0
@@ -32,3 +35,8 @@ class WiFiManager:
 
         print('AP started')
         print(self.ap.ifconfig())
+
+    def poll(self):
+        if not self.ap:
+            return True
+        return self.ap.active()
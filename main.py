@@ -2,6 +2,10 @@ import socket
 import json
 import time
 import gc
+import os
+import sys
+import struct
+from array import array
 
 try:
     import network
@@ -17,18 +21,100 @@ except ImportError:
     except ImportError:
         pass
 
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+try:
+    import micropython
+except ImportError:
+    # CPython: the kernels below run as plain Python
+    class micropython:
+        @staticmethod
+        def native(f): return f
+
 # ==========================================
 # CONFIGURATION
 # ==========================================
 WIFI_SSID = 'TankController-AP'
 WIFI_PASS = 'tankwater'
 
+# Dashboard is streamed from flash, never held in RAM
+DASHBOARD_FILE = 'www/index.html'
+FILE_CHUNK = 512
+
 TRIG_PIN_NUM = 5
 ECHO_PIN_NUM = 18
 ACTUATOR_PIN_NUM = 26
 PUMP_PIN_NUM = 16
 LED_PIN_NUM = 2
 
+# Loop supervision
+LOOP_PERIOD_MS = 50        # Nominal control tick period
+LOOP_SLACK_MS = 200        # Lateness still counted as on time (WDT fed)
+LOOP_TRIP_MS = 1000        # Lateness that forces outputs to the safe state
+LOOP_RECOVER_TICKS = 10    # On-time ticks needed before outputs are released
+LOOP_HIST_EDGES_MS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+WDT_TIMEOUT_MS = 8000      # Hard reset if the loop stops feeding
+
+# Run the control loop in its own thread, networking in the main thread
+DUAL_CORE = False
+COMMAND_QUEUE_LEN = 8
+
+# Garbage collection: collect in the idle slack after a tick, never inside it
+GC_POLICY = True
+GC_COLLECT_BYTES = 8192    # Heap allocated since the last collect that warrants one
+GC_MIN_SLACK_MS = 10       # Time left before the next tick needed to start a collect
+GC_THRESHOLD_STEPS = 8     # gc.threshold = this many loop steps of measured allocation
+GC_ALLOC_EDGES = (64, 256, 1024, 4096, 16384)
+GC_PAUSE_EDGES_US = (500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+# Network admission control
+ADMIT_BUDGET_MS = 40       # Network time allowed per loop step
+ADMIT_MIN_READ_MS = 20     # Shortest wait for a request after accept
+ADMIT_SEND_TIMEOUT_MS = 500 # Per-send wait once admitted (slow soft-AP ACKs)
+ADMIT_STATIC_MIN_MS = 25   # Budget left needed to start sending the dashboard
+ADMIT_STATIC_SEND_MS = 150 # Longest dashboard send in the single loop (under LOOP_SLACK_MS)
+ADMIT_CLIENT_RATE = 5.0    # Requests/s per client IP (token refill)
+ADMIT_CLIENT_BURST = 10
+ADMIT_MAX_CLIENTS = 16
+
+# UDP telemetry: one datagram per tick to every listener on the AP subnet
+TELEMETRY_ENABLED = False
+TELEMETRY_ADDR = '192.168.4.255' # AP broadcast; a 224.x-239.x group also works
+TELEMETRY_PORT = 5005
+TELEMETRY_PERIOD_MS = 0          # Minimum gap between datagrams; 0 = every tick
+
+# Sensor trace recording (None = off); see tools/trace_replay.py
+TRACE_FILE = None          # e.g. 'trace.bin'
+TRACE_MAX_BYTES = 262144   # Stop recording before flash fills (per boot)
+TRACE_KEEP = 3             # Boots kept: TRACE_FILE, TRACE_FILE.1 (previous boot), ...
+TRACE_FLUSH_MS = 5000      # Longest a sample waits in RAM (lost on a reset)
+
+# Adaptive sensor sampling
+ADAPTIVE_SAMPLING = True
+SAMPLE_MIN_MS = 50         # Near a limit or with a large PID error
+SAMPLE_MAX_MS = 1000       # Settled mid-band (<= DT_MAX_MS of PIDFixed)
+SAMPLE_MAX_RATE = 2.0      # Assumed fastest level change, %/s
+SAMPLE_STABLE_PCT = 0.5    # Level change per sample still counted as stable
+SAMPLE_ERROR_PCT = 5.0     # |PID error| that forces fast sampling
+
+# Fixed-point control (no float boxing per tick on MicroPython)
+FIXED_POINT = False
+Q_SHIFT = 8                # Percent values: 1.0% = 256
+Q_ONE = 1 << Q_SHIFT
+Q_PCT_100 = 100 << Q_SHIFT
+GAIN_SHIFT = 10            # PID gains: 1.0 = 1024
+GAIN_MAX = (1 << 14) - 1   # |gain| < 16 keeps every product below 2**30
+FIXED_GAIN_LIMIT = GAIN_MAX / (1 << GAIN_SHIFT) # Largest |kp|/|ki|/|kd| accepted in fixed point
+DT_MAX_MS = 1000
+HW_MAX_MV = 3300
+
+# Simulated plant (no sensor attached)
+SIM_FILL_RATE = 1.5        # %/s at 100% valve with the pump on
+SIM_DRAIN_RATE = 0.5       # %/s constant draw
+
 DEFAULT_CONFIG = {
     # Geometry
     "tank_height": 200.0,
@@ -45,9 +131,163 @@ DEFAULT_CONFIG = {
     # Output
     "dac_min_v": 0.66,       # Min Voltage (0% PID)
     "dac_max_v": 3.3,        # Max Voltage (100% PID)
-    "valve_max_duty": 1023
+    "valve_max_duty": 1023,
+    "duty_resolution": 0,    # PWM rewritten only when duty moves more than this (counts)
+    # Level sensor
+    "sensor": "ultrasonic",  # or "adc": pressure transducer on adc_pin
+    "adc_pin": 34,
+    "adc_atten": "11DB",     # ADC.ATTN_*: 0DB, 2_5DB, 6DB, 11DB (full scale ~3.3 V)
+    "adc_width": 12,         # Bits, 9-12
+    "adc_samples": 32,       # Conversions per reading (burst)
+    "adc_decimate": 4,       # Conversions averaged per block
+    "adc_empty": 0,          # Raw reading with the tank empty
+    "adc_full": 4095,        # Raw reading with the tank full (tank_height)
+    # Calibration curves, [[x, y], ...]; empty = linear
+    "valve_curve": [],       # PID % -> volts (replaces dac_min_v/dac_max_v)
+    "duty_curve": []         # Volts -> duty % (replaces V / 3.3)
 }
 
+# Calibration lookup tables: uniform integer grids, indexed by shift
+CAL_PCT_SHIFT = Q_SHIFT    # Valve table: one entry per 1% (valve in Q8)
+CAL_MV_SHIFT = 2           # Duty table: one entry per 4 mV (3300 mV on the grid)
+
+# ==========================================
+# CONTROL KERNELS
+# ==========================================
+# Pure per-tick math, compiled to machine code on MicroPython. Keep them
+# free of attribute lookups and object state so native code stays fast.
+# The *_q kernels inline Q_PCT_100 (25600), GAIN_SHIFT (10) and
+# HW_MAX_MV (3300) as literals for the same reason.
+
+@micropython.native
+def pid_integral(integral, error, dt, ki, out_min, out_max):
+    integral += error * dt
+    if integral * ki > out_max: integral = out_max / ki if ki else 0
+    elif integral * ki < out_min: integral = out_min / ki if ki else 0
+    return integral
+
+@micropython.native
+def pid_output(error, last_error, integral, dt, kp, ki, kd, out_min, out_max):
+    output = kp * error + ki * integral + kd * ((error - last_error) / dt)
+    if output < out_min: output = out_min
+    elif output > out_max: output = out_max
+    return output
+
+@micropython.native
+def calc_level_percent(dist, empty, height):
+    full = empty - height
+    span = empty - full
+    if span <= 0: span = 1
+    level = ((empty - dist) / span) * 100.0
+    if level < 0: level = 0
+    if level > 100: level = 100
+    return level
+
+@micropython.native
+def calc_actuator_volts(valve, min_v, max_v, pump_on):
+    # V = Min + (PID% * (Max - Min)), 0V if Pump OFF, HW limit 3.3V
+    if pump_on:
+        voltage_span = max_v - min_v
+        if voltage_span < 0: voltage_span = 0
+        v = min_v + (valve / 100.0 * voltage_span)
+    else:
+        v = 0.0
+    if v > 3.3: v = 3.3
+    if v < 0: v = 0
+    return v
+
+@micropython.native
+def calc_duty(v, duty_res):
+    # Duty = (V / 3.3) * Resolution
+    duty_fraction = v / 3.3
+    if duty_fraction > 1.0: duty_fraction = 1.0
+    return int(duty_fraction * duty_res)
+
+@micropython.native
+def lut_interp(table, x, shift, x_max):
+    # Uniform-step table: entry x >> shift, linear between neighbours
+    if x < 0: x = 0
+    elif x > x_max: x = x_max
+    i = x >> shift
+    y0 = table[i]
+    return y0 + ((table[i + 1] - y0) * (x & ((1 << shift) - 1)) >> shift)
+
+@micropython.native
+def pid_integral_q(integral, error, dt, ki, i_min, i_max):
+    # Divide before multiplying by dt to stay in small-int range
+    integral += (ki * error) // 1000 * dt
+    if integral > i_max: integral = i_max
+    elif integral < i_min: integral = i_min
+    return integral
+
+@micropython.native
+def pid_output_q(error, last_error, integral, dt, kp, kd, out_min, out_max):
+    # D: x * 1000 >> 10 == x * 125 >> 7; x bounded so x * 125 < 2**30
+    derivative = (kd * (error - last_error)) // dt
+    if derivative > 8000000: derivative = 8000000
+    elif derivative < -8000000: derivative = -8000000
+    output = ((kp * error) >> 10) + (integral >> 10) + ((derivative * 125) >> 7)
+    if output < out_min: output = out_min
+    elif output > out_max: output = out_max
+    return output
+
+@micropython.native
+def calc_level_q(dist_mm, empty_mm, span_mm):
+    level = (empty_mm - dist_mm) * 25600 // span_mm
+    if level < 0: level = 0
+    if level > 25600: level = 25600
+    return level
+
+@micropython.native
+def calc_actuator_mv(valve_q, min_mv, max_mv, pump_on):
+    if pump_on:
+        span_mv = max_mv - min_mv
+        if span_mv < 0: span_mv = 0
+        mv = min_mv + valve_q * span_mv // 25600
+    else:
+        mv = 0
+    if mv > 3300: mv = 3300
+    if mv < 0: mv = 0
+    return mv
+
+@micropython.native
+def adc_burst(read, buf):
+    # Back-to-back conversions into a preallocated buffer
+    for i in range(len(buf)):
+        buf[i] = read()
+
+@micropython.native
+def block_mean(buf, block):
+    # Average blocks of `block` samples; with 3+ blocks drop the highest
+    # and lowest block (pump/relay spikes) before averaging the rest
+    blocks = len(buf) // block
+    total = 0
+    lo = 1 << 29
+    hi = -1
+    i = 0
+    for b in range(blocks):
+        s = 0
+        for j in range(block):
+            s += buf[i]
+            i += 1
+        total += s
+        if s < lo: lo = s
+        if s > hi: hi = s
+    if blocks >= 3:
+        return (total - lo - hi) // ((blocks - 2) * block)
+    return total // (blocks * block)
+
+@micropython.native
+def calc_adc_level_mm(raw, empty_raw, full_raw, span_mm):
+    # Linear transducer: empty_raw at level 0, full_raw at span_mm
+    cal = full_raw - empty_raw
+    if cal == 0:
+        return 0
+    level = (raw - empty_raw) * span_mm // cal
+    if level < 0: level = 0
+    elif level > span_mm: level = span_mm
+    return level
+
 # ==========================================
 # PID CONTROLLER
 # ==========================================
@@ -75,28 +315,188 @@ class PID:
 
         error = self.setpoint - input_val
 
-        # P
-        p_term = self.kp * error
+        self._integral = pid_integral(self._integral, error, dt, self.ki, self.out_min, self.out_max)
+        output = pid_output(error, self._last_error, self._integral, dt,
+                            self.kp, self.ki, self.kd, self.out_min, self.out_max)
+
+        self._last_error = error
+        self._last_time = current_time
+        return output
+
+def gain_to_q(gain):
+    # Rounded to 1/1024. Out-of-range gains are refused by ServerLoop
+    # (gain_errors); the clamp only guards direct set_config() calls.
+    q = int(gain * (1 << GAIN_SHIFT) + (0.5 if gain >= 0 else -0.5))
+    if q > GAIN_MAX: q = GAIN_MAX
+    elif q < -GAIN_MAX: q = -GAIN_MAX
+    return q
+
+class PIDFixed:
+    # Same control law as PID in scaled integers: input/output/setpoint are
+    # percent in Q8, gains Q10 and dt in ms. The integral is kept as the
+    # I-term itself (Q18) so anti-windup clamps it to the output range, like
+    # PID clamping integral * ki. All intermediates stay below 2**30, i.e.
+    # MicroPython small ints, so compute() never allocates.
+    def __init__(self, kp, ki, kd, setpoint, out_min=0, out_max=100):
+        self.update_params(kp, ki, kd)
+        self.setpoint = int(setpoint * Q_ONE)
+        self.out_min = out_min << Q_SHIFT
+        self.out_max = out_max << Q_SHIFT
+        self._integral = 0
+        self._last_error = 0
+        self._last_time = time.ticks_ms()
 
-        # I
-        self._integral += error * dt
-        if self._integral * self.ki > self.out_max: self._integral = self.out_max / self.ki if self.ki else 0
-        elif self._integral * self.ki < self.out_min: self._integral = self.out_min / self.ki if self.ki else 0
-        i_term = self.ki * self._integral
+    def update_params(self, kp, ki, kd):
+        self.kp = gain_to_q(kp)
+        self.ki = gain_to_q(ki)
+        self.kd = gain_to_q(kd)
 
-        # D
-        derivative = (error - self._last_error) / dt
-        d_term = self.kd * derivative
+    def compute(self, input_q):
+        current_time = time.ticks_ms()
+        dt = time.ticks_diff(current_time, self._last_time)
+        if dt <= 0: dt = 100
+        elif dt > DT_MAX_MS: dt = DT_MAX_MS
 
-        output = p_term + i_term + d_term
+        error = self.setpoint - input_q
 
-        if output < self.out_min: output = self.out_min
-        elif output > self.out_max: output = self.out_max
+        self._integral = pid_integral_q(self._integral, error, dt, self.ki,
+                                        self.out_min << GAIN_SHIFT, self.out_max << GAIN_SHIFT)
+        output = pid_output_q(error, self._last_error, self._integral, dt,
+                              self.kp, self.kd, self.out_min, self.out_max)
 
         self._last_error = error
         self._last_time = current_time
         return output
 
+# ==========================================
+# LEVEL SENSORS
+# ==========================================
+# The ultrasonic sensor is TankController's built-in path (_ping_us). Other
+# backends provide read_mm(empty_mm, span_mm): the sensor-to-surface
+# distance in mm, so level math, traces and telemetry are unchanged.
+
+class AdcLevelSensor:
+    """Pressure transducer (0-3.3 V, or 4-20 mA across a shunt) on an ADC.
+
+    A reading is a burst of conversions into a preallocated buffer,
+    decimated by averaging blocks and trimmed (block_mean). No blocking
+    wait on an echo, and foam or steam don't affect it.
+    """
+    def __init__(self, adc, samples=32, decimate=4, empty=0, full=4095):
+        if decimate < 1: decimate = 1
+        if samples < decimate: samples = decimate
+        self.adc = adc
+        self.decimate = decimate
+        self.buf = array('H', [0] * (samples // decimate * decimate))
+        self.empty = empty
+        self.full = full
+
+    def read_raw(self):
+        adc_burst(self.adc.read, self.buf)
+        return block_mean(self.buf, self.decimate)
+
+    def read_mm(self, empty_mm, span_mm):
+        return empty_mm - calc_adc_level_mm(self.read_raw(), self.empty, self.full, span_mm)
+
+def make_adc_sensor(c):
+    adc = machine.ADC(Pin(c['adc_pin']))
+    adc.atten(getattr(machine.ADC, 'ATTN_' + c['adc_atten']))
+    adc.width(getattr(machine.ADC, 'WIDTH_%dBIT' % c['adc_width']))
+    return AdcLevelSensor(adc, c['adc_samples'], c['adc_decimate'], c['adc_empty'], c['adc_full'])
+
+# ==========================================
+# CALIBRATION
+# ==========================================
+def curve_points(points):
+    # Validated [[x, y], ...] sorted by x, or None if unusable (linear mode)
+    try:
+        pts = sorted((float(x), float(y)) for x, y in points)
+    except (TypeError, ValueError):
+        return None
+    if len(pts) < 2:
+        return None
+    for x, y in pts:
+        # NaN compares false with everything, inf overflows int()
+        if not (-1e9 < x < 1e9 and -1e9 < y < 1e9):
+            return None
+    for i in range(1, len(pts)):
+        if pts[i][0] == pts[i - 1][0]:
+            return None
+    return pts
+
+def curve_value(pts, x):
+    # Piecewise-linear through pts, flat beyond the end points
+    if x <= pts[0][0]: return pts[0][1]
+    for i in range(1, len(pts)):
+        x1, y1 = pts[i]
+        if x <= x1:
+            x0, y0 = pts[i - 1]
+            return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+    return pts[-1][1]
+
+def build_lut(pts, x_max, shift, x_unit, y_unit, y_max):
+    # Sample the curve every 1 << shift grid units from 0 to x_max (plus
+    # one spare entry for interpolation). x_unit/y_unit are grid units per
+    # curve unit; outputs are clamped to 0..y_max.
+    table = array('H', [0] * ((x_max >> shift) + 2))
+    for i in range(len(table)):
+        y = int(curve_value(pts, (i << shift) / x_unit) * y_unit + 0.5)
+        table[i] = 0 if y < 0 else (y_max if y > y_max else y)
+    return table
+
+# ==========================================
+# OUTPUT SHADOWING
+# ==========================================
+# The controller is the only writer of its outputs, so the last value
+# written is the hardware state: repeat writes are skipped instead of
+# costing a bus access (and a relay/PWM glitch) every tick.
+class ShadowPin:
+    def __init__(self, pin):
+        self.pin = pin
+        self.state = None # Unknown until the first write
+        self.writes = 0
+        self.skipped = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self.state
+        if v == self.state:
+            self.skipped += 1
+            return v
+        self.pin.value(v)
+        self.state = v
+        self.writes += 1
+        return v
+
+    def stats(self):
+        return {"writes": self.writes, "skipped": self.skipped}
+
+class ShadowPWM:
+    # Duty changes of resolution counts or less are absorbed, except to or
+    # from 0: closing (interlock) and opening the valve are always written.
+    def __init__(self, pwm, resolution=0):
+        self.pwm = pwm
+        self.resolution = resolution
+        self.state = None
+        self.writes = 0
+        self.skipped = 0
+
+    def duty(self, d=None):
+        if d is None:
+            return self.state
+        last = self.state
+        if last is not None and (d == last or (d and last and abs(d - last) <= self.resolution)):
+            self.skipped += 1
+            return last
+        self.pwm.duty(d)
+        self.state = d
+        self.writes += 1
+        return d
+
+    def stats(self):
+        return {"writes": self.writes, "skipped": self.skipped, "duty": self.state,
+                "resolution": self.resolution}
+
 # ==========================================
 # CONTROLLER LOGIC
 # ==========================================
@@ -107,9 +507,10 @@ class TankController:
         try:
             self.trig = Pin(TRIG_PIN_NUM, Pin.OUT)
             self.echo = Pin(ECHO_PIN_NUM, Pin.IN)
-            self.actuator = PWM(Pin(ACTUATOR_PIN_NUM), freq=1000)
-            self.pump = Pin(PUMP_PIN_NUM, Pin.OUT)
-            self.led = Pin(LED_PIN_NUM, Pin.OUT)
+            self.actuator = ShadowPWM(PWM(Pin(ACTUATOR_PIN_NUM), freq=1000),
+                                      self.config.get('duty_resolution', 0))
+            self.pump = ShadowPin(Pin(PUMP_PIN_NUM, Pin.OUT))
+            self.led = ShadowPin(Pin(LED_PIN_NUM, Pin.OUT))
 
             self.actuator.duty(0)
             self.pump.value(0)
@@ -128,17 +529,123 @@ class TankController:
         self.actuator_voltage = 0.0
         self.pump_on = False
         self.simulated_level = 50.0
+        self._sim_last = None
         self.pump_active_latch = False
+        self.safe_hold = False
+        self.config_version = 0
+        self.recorder = None # TraceRecorder: raw inputs for offline replay
+        self.level_sensor = None # Non-ultrasonic backend (config 'sensor')
+        self._sensor_version = -1
+        self._sensor_key = None
+        self._valve_lut = None # Calibration tables, None = linear
+        self._duty_lut = None
+        self._cal_version = -1
+
+    def set_config(self, data):
+        # Apply known keys; bumping the version refreshes derived/cached values
+        changed = {}
+        for k, v in data.items():
+            if k in self.config and v is not None:
+                self.config[k] = v
+                changed[k] = v
+        self.config_version += 1
+        if self.recorder is not None:
+            self.recorder.config(changed)
+
+    def safe_outputs(self):
+        # Pump OFF, Actuator 0V. Held by update() until safe_hold is cleared.
+        self.safe_hold = True
+        self.pump_on = False
+        self.actuator_voltage = 0.0
+        if self.pump: self.pump.value(0)
+        if self.actuator: self.actuator.duty(0)
+        if self.led: self.led.value(0)
+
+    def _compile_curves(self):
+        # Rebuilt only when the config changes, never per tick. A table that
+        # can't be built leaves that mapping linear; it never fails the tick.
+        try:
+            self._build_curves()
+        except Exception as e:
+            print("Calibration compile failed (%s), using linear" % e)
+            self._valve_lut = self._duty_lut = None
+        if isinstance(self.actuator, ShadowPWM):
+            self.actuator.resolution = self.config.get('duty_resolution', 0)
+        self._cal_version = self.config_version
+
+    def _build_curves(self):
+        c = self.config
+        res = c.get('valve_max_duty', 1023)
+        valve = curve_points(c.get('valve_curve') or [])
+        duty = curve_points(c.get('duty_curve') or [])
+        if c.get('valve_curve') and valve is None: print("valve_curve invalid, using linear")
+        if c.get('duty_curve') and duty is None: print("duty_curve invalid, using linear")
+        # Valve % (Q8) -> mV; mV -> duty counts
+        self._valve_lut = build_lut(valve, Q_PCT_100, CAL_PCT_SHIFT, Q_ONE, 1000, HW_MAX_MV) if valve else None
+        self._duty_lut = build_lut(duty, HW_MAX_MV, CAL_MV_SHIFT, 1000, res / 100, res) if duty else None
+
+    def output_stats(self):
+        # Write/skip counts of the shadowed outputs
+        st = {}
+        for name in ('pump', 'actuator', 'led'):
+            out = getattr(self, name)
+            if isinstance(out, (ShadowPin, ShadowPWM)):
+                st[name] = out.stats()
+        return st
+
+    def _compile_sensor(self):
+        # Pick the level backend; a failed ADC setup falls back to ultrasonic
+        self._sensor_version = self.config_version
+        c = self.config
+        if c.get('sensor') != 'adc':
+            self.level_sensor = None
+            return
+        key = (c['adc_pin'], c['adc_atten'], c['adc_width'], c['adc_samples'], c['adc_decimate'])
+        s = self.level_sensor
+        if s is not None and self._sensor_key == key:
+            s.empty = c['adc_empty']
+            s.full = c['adc_full']
+            return
+        try:
+            self.level_sensor = make_adc_sensor(c)
+            self._sensor_key = key
+        except Exception as e:
+            print("ADC sensor init failed (%s), using ultrasonic" % e)
+            self.level_sensor = None
+
+    def _ping_us(self):
+        self.trig.value(0)
+        time.sleep_us(2)
+        self.trig.value(1)
+        time.sleep_us(10)
+        self.trig.value(0)
+
+        # Timeout 30ms (approx 5m max distance)
+        return machine.time_pulse_us(self.echo, 1, 30000)
 
     def read_distance(self):
+        if self._sensor_version != self.config_version:
+            self._compile_sensor()
+        if self.level_sensor is not None:
+            # Read errors count as full, like the ultrasonic path: pump stops
+            try:
+                return self.level_sensor.read_mm(int(self.config['max_dist'] * 10),
+                                                 int(self.config['tank_height'] * 10)) / 10
+            except:
+                return 0
+
         if self.trig is None:
-            # Sim logic
+            # Sim logic (rates in %/s, integrated over elapsed ticks)
+            now = time.ticks_ms()
+            dt = time.ticks_diff(now, self._sim_last) / 1000.0 if self._sim_last is not None else 0
+            self._sim_last = now
+
             flow_potential = self.valve_percent / 100.0
             if not self.pump_on: flow_potential = 0
 
-            fill_rate = flow_potential * 1.5
-            drain_rate = 0.5
-            self.simulated_level += (fill_rate - drain_rate)
+            fill_rate = flow_potential * SIM_FILL_RATE
+            drain_rate = SIM_DRAIN_RATE
+            self.simulated_level += (fill_rate - drain_rate) * dt
             if self.simulated_level < 0: self.simulated_level = 0
             if self.simulated_level > 100: self.simulated_level = 100
 
@@ -153,14 +660,7 @@ class TankController:
 
         # Hardware Read
         try:
-            self.trig.value(0)
-            time.sleep_us(2)
-            self.trig.value(1)
-            time.sleep_us(10)
-            self.trig.value(0)
-
-            # Timeout 30ms (approx 5m max distance)
-            pulse_duration = machine.time_pulse_us(self.echo, 1, 30000)
+            pulse_duration = self._ping_us()
 
             if pulse_duration < 0:
                 return self.config['max_dist'] # Timeout or error
@@ -176,19 +676,14 @@ class TankController:
         # 1. Config
         self.pid.update_params(self.config['kp'], self.config['ki'], self.config['kd'])
         self.pid.setpoint = self.config['target_setpoint']
+        if self._cal_version != self.config_version:
+            self._compile_curves()
 
         # 2. Input
         dist = self.read_distance()
-        h = self.config['tank_height']
-        empty = self.config['max_dist']
-        full = empty - h
-        span = empty - full
-        if span <= 0: span = 1
-
-        level_cm = empty - dist
-        self.level_percent = (level_cm / span) * 100.0
-        if self.level_percent < 0: self.level_percent = 0
-        if self.level_percent > 100: self.level_percent = 100
+        if self.recorder is not None:
+            self.recorder.sample(dist, self.safe_hold)
+        self.level_percent = calc_level_percent(dist, self.config['max_dist'], self.config['tank_height'])
 
         # 3. Deadband (Pump Logic)
         if self.config['deadband_enabled']:
@@ -200,343 +695,1348 @@ class TankController:
         else:
             self.pump_on = True
 
+        if self.safe_hold:
+            self.pump_on = False
+
         # 4. PID Calc
         pid_out = self.pid.compute(self.level_percent)
         self.valve_percent = pid_out
 
-        # 5. Output Logic
-        # V = Min + (PID% * (Max - Min))
-        min_v = self.config['dac_min_v']
-        max_v = self.config['dac_max_v']
+        # 5. Output Logic (Actuator forced 0V if Pump OFF)
+        if self._valve_lut is None:
+            self.actuator_voltage = calc_actuator_volts(self.valve_percent, self.config['dac_min_v'],
+                                                   self.config['dac_max_v'], self.pump_on)
+        elif self.pump_on:
+            self.actuator_voltage = lut_interp(self._valve_lut, int(self.valve_percent * Q_ONE),
+                                               CAL_PCT_SHIFT, Q_PCT_100) / 1000
+        else:
+            self.actuator_voltage = 0.0
+
+        # Apply to Hardware
+        if self.pump:
+            self.pump.value(1 if self.pump_on else 0)
+
+        if self.actuator:
+            if self._duty_lut is None:
+                duty = calc_duty(self.actuator_voltage, self.config.get('valve_max_duty', 1023))
+            else:
+                duty = lut_interp(self._duty_lut, int(self.actuator_voltage * 1000), CAL_MV_SHIFT, HW_MAX_MV)
+            self.actuator.duty(duty)
+
+        if self.led:
+            self.led.value(1 if self.pump_on else 0)
+
+class FixedTankController(TankController):
+    # TankController with the per-tick path in integers: level/valve in Q8
+    # percent, voltage in mV, distance in mm. Config values are converted
+    # once per config_version, so change config through set_config().
+    def __init__(self, config=DEFAULT_CONFIG):
+        self.level_q = 0
+        self.valve_q = 0
+        self.actuator_mv = 0
+        TankController.__init__(self, config)
+        self.pid = PIDFixed(0, 0, 0, 0)
+        self._q_version = -1
+
+    # Float views for status/telemetry
+    @property
+    def level_percent(self): return self.level_q / Q_ONE
+    @level_percent.setter
+    def level_percent(self, v): self.level_q = int(v * Q_ONE)
+
+    @property
+    def valve_percent(self): return self.valve_q / Q_ONE
+    @valve_percent.setter
+    def valve_percent(self, v): self.valve_q = int(v * Q_ONE)
+
+    @property
+    def actuator_voltage(self): return self.actuator_mv / 1000
+    @actuator_voltage.setter
+    def actuator_voltage(self, v): self.actuator_mv = int(v * 1000)
+
+    def read_distance_mm(self):
+        if self.level_sensor is not None:
+            try:
+                return self.level_sensor.read_mm(self._empty_mm, self._span_mm)
+            except:
+                return 0
+        if self.trig is None:
+            return int(self.read_distance() * 10)
+
+        try:
+            pulse_duration = self._ping_us()
+            if pulse_duration < 0:
+                return self._empty_mm
+            # 0.0343 cm/us round trip -> mm = us * 343 / 2000
+            return pulse_duration * 343 // 2000
+        except:
+            return 0
+
+    def _compile_config(self):
+        c = self.config
+        self.pid.update_params(c['kp'], c['ki'], c['kd'])
+        self.pid.setpoint = int(c['target_setpoint'] * Q_ONE)
+
+        self._empty_mm = int(c['max_dist'] * 10)
+        span = int(c['tank_height'] * 10)
+        self._span_mm = span if span > 0 else 10
+
+        self._stop_q = int(c['stop_level'] * Q_ONE)
+        self._start_q = int(c['start_level'] * Q_ONE)
+        self._min_mv = int(c['dac_min_v'] * 1000)
+        self._max_mv = int(c['dac_max_v'] * 1000)
+        self._duty_res = c.get('valve_max_duty', 1023)
+        self._compile_curves()
+        self._compile_sensor()
+        self._q_version = self.config_version
 
-        if self.pump_on:
-             voltage_span = max_v - min_v
-             if voltage_span < 0: voltage_span = 0
-             self.actuator_voltage = min_v + (self.valve_percent / 100.0 * voltage_span)
+    def update(self):
+        # 1. Config (only when changed)
+        if self._q_version != self.config_version:
+            self._compile_config()
+
+        # 2. Input
+        dist_mm = self.read_distance_mm()
+        if self.recorder is not None:
+            self.recorder.sample(dist_mm / 10, self.safe_hold)
+        level = calc_level_q(dist_mm, self._empty_mm, self._span_mm)
+        self.level_q = level
+
+        # 3. Deadband (Pump Logic)
+        if self.config['deadband_enabled']:
+            if level >= self._stop_q:
+                self.pump_active_latch = False
+            elif level <= self._start_q:
+                self.pump_active_latch = True
+            self.pump_on = self.pump_active_latch
         else:
-             self.actuator_voltage = 0.0
+            self.pump_on = True
+
+        if self.safe_hold:
+            self.pump_on = False
 
-        # Clamp
-        if self.actuator_voltage > 3.3: self.actuator_voltage = 3.3 # HW Limit
-        if self.actuator_voltage < 0: self.actuator_voltage = 0
+        # 4. PID Calc
+        self.valve_q = self.pid.compute(level)
+
+        # 5. Output Logic (mV)
+        if self._valve_lut is None:
+            mv = calc_actuator_mv(self.valve_q, self._min_mv, self._max_mv, self.pump_on)
+        elif self.pump_on:
+            mv = lut_interp(self._valve_lut, self.valve_q, CAL_PCT_SHIFT, Q_PCT_100)
+        else:
+            mv = 0
+        self.actuator_mv = mv
 
         # Apply to Hardware
         if self.pump:
             self.pump.value(1 if self.pump_on else 0)
 
         if self.actuator:
-            # Map Voltage to Duty (Assuming 3.3V Max HW)
-            # Duty = (V / 3.3) * Resolution
-            hw_max_v = 3.3
-            duty_fraction = self.actuator_voltage / hw_max_v
-            if duty_fraction > 1.0: duty_fraction = 1.0
-
-            duty_res = self.config.get('valve_max_duty', 1023)
-            duty = int(duty_fraction * duty_res)
-            self.actuator.duty(duty)
+            if self._duty_lut is None:
+                self.actuator.duty(mv * self._duty_res // HW_MAX_MV)
+            else:
+                self.actuator.duty(lut_interp(self._duty_lut, mv, CAL_MV_SHIFT, HW_MAX_MV))
 
         if self.led:
             self.led.value(1 if self.pump_on else 0)
 
 # ==========================================
-# HTML CONTENT
-# ==========================================
-HTML_CONTENT = """<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no, viewport-fit=cover">
-    <title>Tank Ultra-Console</title>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-    <style>
-        :root { --bg: #06080c; --accent: #22d3ee; --accent-glow: rgba(34, 211, 238, 0.4); --card-bg: rgba(15, 23, 42, 0.85); --card-border: rgba(255, 255, 255, 0.06); --text: #ffffff; --text-muted: #64748b; --success: #10b981; --danger: #f43f5e; --warning: #fbbf24; }
-        * { box-sizing: border-box; -webkit-tap-highlight-color: transparent; }
-        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif; background-color: var(--bg); color: var(--text); margin: 0; padding: 24px 16px; min-height: 100vh; }
-        .container { max-width: 500px; margin: 0 auto; }
-        header { text-align: center; margin-bottom: 24px; }
-        h1 { font-size: 2.2rem; margin: 0; font-weight: 700; background: linear-gradient(135deg, #fff 0%, #94a3b8 100%); -webkit-background-clip: text; -webkit-text-fill-color: transparent; }
-        .status-badge { display: inline-flex; align-items: center; gap: 8px; background: rgba(15, 23, 42, 0.6); border: 1px solid var(--card-border); padding: 6px 16px; border-radius: 100px; font-size: 0.75rem; font-weight: 600; text-transform: uppercase; margin-top: 12px; }
-        .status-dot { width: 8px; height: 8px; border-radius: 50%; background: var(--danger); box-shadow: 0 0 10px var(--danger); }
-        .status-dot.online { background: var(--success); box-shadow: 0 0 10px var(--success); }
-        .card { background: var(--card-bg); border: 1px solid var(--card-border); border-radius: 24px; padding: 24px; margin-bottom: 16px; }
-        .metric-grid { display: grid; grid-template-columns: 1fr 1fr; gap: 12px; margin-bottom: 16px; }
-        .metric-card { background: rgba(255, 255, 255, 0.02); border: 1px solid var(--card-border); border-radius: 20px; padding: 16px; text-align: center; }
-        .metric-label { color: var(--text-muted); font-size: 0.65rem; font-weight: 700; text-transform: uppercase; margin-bottom: 4px; }
-        .metric-value { font-size: 2rem; font-weight: 700; line-height: 1; }
-        .metric-unit { font-size: 0.9rem; color: var(--text-muted); font-weight: 400; }
-        .section-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 20px; }
-        .section-title { font-size: 1rem; font-weight: 700; display: flex; align-items: center; gap: 8px; }
-        .live-tag { font-size: 0.6rem; background: var(--accent); color: #000; padding: 2px 8px; border-radius: 100px; font-weight: 800; text-transform: uppercase; }
-        .form-grid { display: grid; grid-template-columns: 1fr 1fr; gap: 16px; margin-bottom: 16px; }
-        .input-group { margin-bottom: 12px; }
-        .label { display: block; color: var(--text-muted); font-size: 0.7rem; font-weight: 600; margin-bottom: 6px; text-transform: uppercase; }
-        input { width: 100%; background: rgba(0, 0, 0, 0.4); border: 1px solid var(--card-border); border-radius: 12px; padding: 12px; color: #fff; font-size: 1rem; font-weight: 600; text-align: center; border: 1px solid #334155; }
-        button { width: 100%; background: var(--accent); color: #000; border: none; border-radius: 16px; padding: 14px; font-size: 0.9rem; font-weight: 700; cursor: pointer; text-transform: uppercase; margin-top: 8px; }
-        button.secondary { background: rgba(255, 255, 255, 0.05); color: #fff; border: 1px solid var(--card-border); }
-        button.danger { background: rgba(244, 63, 94, 0.1); color: var(--danger); border: 1px solid rgba(244, 63, 94, 0.2); }
-        .active-config { margin-top: 16px; padding: 12px; background: rgba(0, 0, 0, 0.2); border-radius: 16px; font-size: 0.75rem; color: var(--text-muted); display: flex; flex-direction: column; gap: 6px; }
-        .config-row { display: flex; justify-content: space-between; }
-        .config-value { color: var(--accent); font-weight: 700; }
-        .chart-container { height: 160px; margin: 12px -8px 0 -8px; }
-        footer { text-align: center; padding: 24px 0 40px; font-size: 0.7rem; color: var(--text-muted); text-transform: uppercase; }
-
-        .switch { position: relative; display: inline-block; width: 40px; height: 20px; }
-        .switch input { opacity: 0; width: 0; height: 0; position: absolute; }
-        .slider { position: absolute; cursor: pointer; top: 0; left: 0; right: 0; bottom: 0; background-color: #334155; transition: .4s; border-radius: 20px; }
-        .slider:before { position: absolute; content: ""; height: 16px; width: 16px; left: 2px; bottom: 2px; background-color: white; transition: .4s; border-radius: 50%; }
-        input:checked + .slider { background-color: var(--accent); }
-        input:checked + .slider:before { transform: translateX(20px); }
-        .toggle-row { display: flex; align-items: center; justify-content: space-between; margin-bottom: 12px; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <header>
-            <h1>Tank Ultra</h1>
-            <div class="status-badge">
-                <div class="status-dot" id="dot"></div>
-                <span id="stTxt">System Offline</span>
-            </div>
-        </header>
-
-        <div class="metric-grid">
-            <div class="metric-card">
-                <div class="metric-label">Water Level</div>
-                <div class="metric-value" id="lvl">--<span class="metric-unit">%</span></div>
-            </div>
-            <div class="metric-card">
-                <div class="metric-label">Actuator Voltage</div>
-                <div class="metric-value" id="volt" style="font-size: 1.5rem;">--V</div>
-            </div>
-        </div>
-
-        <div class="card" style="padding: 16px;">
-            <div class="metric-label">Real-time Stream</div>
-            <div class="chart-container"><canvas id="chart"></canvas></div>
-        </div>
-
-        <div class="card">
-            <div class="section-header"><div class="section-title">Actuator Setpoint <span class="live-tag">PID Target</span></div></div>
-            <div class="input-group"><label class="label">Target Level (%)</label><input type="number" id="inTarget" placeholder="50"></div>
-            <button id="btnTarget">Set Target Point</button>
-            <div class="active-config"><div class="config-row"><span>Active Target:</span><span class="config-value" id="valTarget">--%</span></div></div>
-        </div>
-
-        <div class="card">
-            <div class="section-header"><div class="section-title">Pump Deadband <span class="live-tag">Safety</span></div></div>
-
-            <div class="toggle-row">
-                <label class="label" style="margin:0;">Enable Deadband</label>
-                <label class="switch"><input type="checkbox" id="chkDeadband"><span class="slider"></span></label>
-            </div>
-
-            <div class="form-grid">
-                <div class="input-group"><label class="label">Stop Limit (%)</label><input type="number" id="inStop" placeholder="90"></div>
-                <div class="input-group"><label class="label">Start Limit (%)</label><input type="number" id="inStart" placeholder="10"></div>
-            </div>
-            <button class="secondary" id="btnPump">Apply Deadband</button>
-            <div class="active-config">
-                <div class="config-row"><span>Start/Stop:</span><span class="config-value" id="valPump">-- / --%</span></div>
-                <div class="config-row"><span>Pump Status:</span><span class="config-value" id="valPumpStatus">--</span></div>
-            </div>
-        </div>
-
-        <div class="card">
-            <div class="section-header"><div class="section-title">Hardware Profile <span class="live-tag">Tank</span></div></div>
-            <div class="form-grid">
-                <div class="input-group"><label class="label">Tank Total (cm)</label><input type="number" id="inH" placeholder="200"></div>
-                <div class="input-group"><label class="label">Empty Dist (cm)</label><input type="number" id="inM" placeholder="180"></div>
-            </div>
-            <button class="secondary" id="btnHw">Sync Geometry</button>
-            <div class="active-config">
-                <div class="config-row"><span>Total Height:</span><span class="config-value" id="valH">-- cm</span></div>
-                <div class="config-row"><span>Empty Sensor:</span><span class="config-value" id="valM">-- cm</span></div>
-            </div>
-        </div>
-
-        <div class="card">
-            <div class="section-header"><div class="section-title">Actuator Tuning <span class="live-tag">PID/DAC</span></div></div>
-            <div class="form-grid">
-                <div class="input-group"><label class="label">Kp</label><input type="number" id="inKp" step="0.1"></div>
-                <div class="input-group"><label class="label">Ki</label><input type="number" id="inKi" step="0.01"></div>
-                <div class="input-group"><label class="label">Kd</label><input type="number" id="inKd" step="0.01"></div>
-                <div class="input-group"><label class="label">Min (V)</label><input type="number" id="inMinV" step="0.01"></div>
-                <div class="input-group"><label class="label">Max (V)</label><input type="number" id="inMaxV" step="0.01"></div>
-            </div>
-            <button class="secondary" id="btnTun">Update Tuning</button>
-            <div class="active-config">
-                <div class="config-row"><span>Gains [P/I/D]:</span><span class="config-value" id="valPid">--</span></div>
-                <div class="config-row"><span>Range:</span><span class="config-value" id="valRange">--V</span></div>
-            </div>
-        </div>
-
-        <footer>Tank Controller Pro • v2.3 • MicroPython</footer>
-    </div>
-
-    <script>
-        const el = {
-            dot: document.getElementById('dot'), st: document.getElementById('stTxt'),
-            lvl: document.getElementById('lvl'), volt: document.getElementById('volt'),
-            vTarget: document.getElementById('valTarget'), vPump: document.getElementById('valPump'), vPumpSt: document.getElementById('valPumpStatus'),
-            vH: document.getElementById('valH'), vM: document.getElementById('valM'), vPid: document.getElementById('valPid'), vRange: document.getElementById('valRange'),
-            iTarget: document.getElementById('inTarget'), iStop: document.getElementById('inStop'),
-            iStart: document.getElementById('inStart'), iH: document.getElementById('inH'),
-            iM: document.getElementById('inM'), iKp: document.getElementById('inKp'),
-            iKi: document.getElementById('inKi'), iKd: document.getElementById('inKd'),
-            iMinV: document.getElementById('inMinV'), iMaxV: document.getElementById('inMaxV'),
-            chkDB: document.getElementById('chkDeadband')
-        };
-
-        const chart = new Chart(document.getElementById('chart').getContext('2d'), {
-            type: 'line', data: { labels: Array(60).fill(''), datasets: [
-                { label: 'Level', data: Array(60).fill(null), borderColor: '#22d3ee', borderWidth: 3, tension: 0.4, pointRadius: 0, fill: true, backgroundColor: 'rgba(34, 211, 238, 0.05)' },
-                { label: 'Setpoint', data: Array(60).fill(null), borderColor: '#fbbf24', borderWidth: 2, borderDash: [5, 5], pointRadius: 0, fill: false }
-            ]},
-            options: { responsive: true, maintainAspectRatio: false, plugins: { legend: { display: false } }, scales: { x: { display: false }, y: { min: 0, max: 100, grid: { color: 'rgba(255,255,255,0.02)' }, ticks: { display: false } } }, animation: false }
-        });
-
-        async function postConfig(data) {
-            try {
-                await fetch('/config', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(data) });
-                alert("Settings Saved");
-            } catch(e) { alert("Save Failed"); }
+# LOOP SUPERVISOR
+# ==========================================
+class Histogram:
+    def __init__(self, edges=LOOP_HIST_EDGES_MS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.n = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        for edge in self.edges:
+            if value < edge: break
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        if value > self.max: self.max = value
+
+    def to_dict(self):
+        return {"edges": list(self.edges), "counts": self.counts, "n": self.n, "max": self.max}
+
+class LoopSupervisor:
+    """Runs TankController.update() once per tick and watches its timing.
+
+    The WDT is fed only by ticks that start within LOOP_SLACK_MS of their
+    deadline, so a loop stuck in the network code resets the board. A tick
+    later than LOOP_TRIP_MS puts the outputs in the safe state until
+    LOOP_RECOVER_TICKS consecutive ticks are on time again.
+    """
+    def __init__(self, controller, period_ms=LOOP_PERIOD_MS, slack_ms=LOOP_SLACK_MS,
+                 trip_ms=LOOP_TRIP_MS, recover_ticks=LOOP_RECOVER_TICKS, wdt_timeout_ms=None):
+        self.controller = controller
+        self.period_ms = period_ms
+        self.slack_ms = slack_ms
+        self.trip_ms = trip_ms
+        self.recover_ticks = recover_ticks
+
+        self.wdt = None
+        if wdt_timeout_ms:
+            try:
+                self.wdt = machine.WDT(timeout=wdt_timeout_ms)
+            except:
+                print("WDT unavailable")
+
+        self.period_hist = Histogram()
+        self.late_hist = Histogram()
+        self.exec_hist = Histogram()
+        self.ticks = 0
+        self.late_ticks = 0
+        self.trips = 0
+        self.feeds = 0
+        self._on_time = 0
+        self._last_start = None
+
+    def tick(self):
+        start = time.ticks_ms()
+        late = 0
+        if self._last_start is not None:
+            period = time.ticks_diff(start, self._last_start)
+            late = period - self.period_ms
+            if late < 0: late = 0
+            self.period_hist.add(period)
+            self.late_hist.add(late)
+        self._last_start = start
+
+        if late >= self.trip_ms:
+            self.trips += 1
+            self._on_time = 0
+            self.controller.safe_outputs()
+        elif late > self.slack_ms:
+            self._on_time = 0
+        else:
+            self._on_time += 1
+            if self.controller.safe_hold and self._on_time >= self.recover_ticks:
+                self.controller.safe_hold = False
+
+        self.controller.update()
+        self.ticks += 1
+        self.exec_hist.add(time.ticks_diff(time.ticks_ms(), start))
+
+        if late > self.slack_ms:
+            self.late_ticks += 1
+        elif self.wdt:
+            self.wdt.feed()
+            self.feeds += 1
+        return late
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "late_ticks": self.late_ticks,
+            "trips": self.trips,
+            "wdt_feeds": self.feeds,
+            "safe_hold": self.controller.safe_hold,
+            "period_ms": self.period_hist.to_dict(),
+            "late_ms": self.late_hist.to_dict(),
+            "exec_ms": self.exec_hist.to_dict()
         }
 
-        async function sync() {
-            try {
-                const res = await fetch('/status');
-                if(!res.ok) throw new Error();
-                const d = await res.json();
-
-                el.dot.classList.add('online');
-                el.st.innerText = "System Online";
-                el.st.style.color = "var(--success)";
-
-                el.lvl.innerHTML = `${d.level_percent.toFixed(0)}<span class="metric-unit">%</span>`;
-                el.volt.innerText = `${d.actuator_voltage.toFixed(2)}V`;
-
-                el.vTarget.innerText = `${d.target_setpoint}%`;
-                el.vPump.innerText = `${d.start_level}% - ${d.stop_level}% (${d.deadband_enabled ? 'ON' : 'OFF'})`;
-                el.vPumpSt.innerText = d.pump_on ? "ACTIVE" : "STOPPED";
-                el.vPumpSt.style.color = d.pump_on ? "var(--success)" : "var(--danger)";
-
-                el.vH.innerText = `${d.tank_height} cm`;
-                el.vM.innerText = `${d.max_dist} cm`;
-                el.vPid.innerText = `[${d.kp}, ${d.ki}, ${d.kd}]`;
-                el.vRange.innerText = `${d.dac_min_v}V - ${d.dac_max_v}V`;
-
-                if(document.activeElement !== el.chkDB) el.chkDB.checked = d.deadband_enabled;
-
-                if(chart.data.datasets[0].data.length >= 60) {
-                    chart.data.datasets[0].data.shift();
-                    chart.data.datasets[1].data.shift();
-                }
-                chart.data.datasets[0].data.push(d.level_percent);
-                chart.data.datasets[1].data.push(d.target_setpoint);
-                chart.update('none');
-
-            } catch(e) {
-                el.dot.classList.remove('online');
-                el.st.innerText = "Connection Lost";
-                el.st.style.color = "var(--danger)";
-            }
+# ==========================================
+# ADAPTIVE SAMPLING
+# ==========================================
+class SamplingPolicy:
+    """Chooses when the next control tick (and sensor ping) is due.
+
+    The interval never exceeds the time the level needs, at the fastest
+    expected rate, to reach start_level/stop_level from where it is, so a
+    limit crossing is seen within about SAMPLE_MIN_MS. Away from the limits
+    a stable level doubles the interval up to SAMPLE_MAX_MS; movement or a
+    large PID error drops it straight back to SAMPLE_MIN_MS.
+    """
+    def __init__(self, controller, min_ms=SAMPLE_MIN_MS, max_ms=SAMPLE_MAX_MS,
+                 max_rate=SAMPLE_MAX_RATE, stable_pct=SAMPLE_STABLE_PCT, error_pct=SAMPLE_ERROR_PCT):
+        self.controller = controller
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.max_rate = max_rate
+        self.stable_pct = stable_pct
+        self.error_pct = error_pct
+
+        self.interval_ms = min_ms
+        self.samples = 0
+        self.worst_detect_ms = 0
+        self._first = None
+        self._last = None
+        self._last_level = None
+        self._was_inside = True
+
+    def due(self, now=None):
+        if self._last is None: return True
+        if now is None: now = time.ticks_ms()
+        return time.ticks_diff(now, self._last) >= self.interval_ms
+
+    def observe(self, now=None):
+        # Call right after controller.update(); returns the next interval
+        if now is None: now = time.ticks_ms()
+        c = self.controller
+        level = c.level_percent
+        start = c.config['start_level']
+        stop = c.config['stop_level']
+        error = c.config['target_setpoint'] - level
+
+        inside = start < level < stop
+        if self._last is not None:
+            gap = time.ticks_diff(now, self._last)
+            if self._was_inside and not inside and gap > self.worst_detect_ms:
+                self.worst_detect_ms = gap
+            rate = abs(level - self._last_level) * 1000 / gap if gap > 0 else 0
+        else:
+            self._first = now
+            rate = 0
+        self._was_inside = inside
+        self.samples += 1
+
+        # Time until a limit could be reached at the fastest plausible rate
+        margin = min(level - start, stop - level)
+        if margin < 0: margin = 0
+        fastest = rate if rate > self.max_rate else self.max_rate
+        limit_ms = margin * 1000 / fastest
+
+        moved = self._last_level is None or abs(level - self._last_level) > self.stable_pct
+        if moved or abs(error) > self.error_pct:
+            interval = self.min_ms
+        else:
+            interval = self.interval_ms * 2
+        if interval > limit_ms: interval = limit_ms
+        if interval > self.max_ms: interval = self.max_ms
+        if interval < self.min_ms: interval = self.min_ms
+
+        self.interval_ms = int(interval)
+        self._last = now
+        self._last_level = level
+        return self.interval_ms
+
+    def stats(self):
+        elapsed = time.ticks_diff(self._last, self._first) if self._last is not None else 0
+        return {
+            "interval_ms": self.interval_ms,
+            "samples": self.samples,
+            "samples_per_min": self.samples * 60000 / elapsed if elapsed > 0 else 0,
+            "worst_detect_ms": self.worst_detect_ms
         }
-        setInterval(sync, 1000);
-        sync();
 
-        el.chkDB.addEventListener('change', () => postConfig({ deadband_enabled: el.chkDB.checked }));
+# ==========================================
+# DUAL-CORE STATE SHARING
+# ==========================================
+# Snapshot slot layout
+SNAP_SEQ = 0
+SNAP_LEVEL = 1
+SNAP_VALVE = 2
+SNAP_VOLTAGE = 3
+SNAP_PUMP = 4
+SNAP_SAFE = 5
+SNAP_CONFIG = 6
+SNAP_VERSION = 7
+SNAP_FIELDS = 8
+
+class StateSnapshot:
+    """Double-buffered tick state, written by one thread, read by any.
+
+    publish() fills the slot readers are not looking at, then bumps seq.
+    read() copies the current slot and retries if seq moved meanwhile, so a
+    reader never sees a mix of two ticks and neither side takes a lock.
+    """
+    def __init__(self):
+        self._slots = ([0] * SNAP_FIELDS, [0] * SNAP_FIELDS)
+        self.seq = 0
+        self.retries = 0
+        self._config = None
+        self._config_version = -1
+
+    def publish(self, controller):
+        if controller.config_version != self._config_version:
+            # Readers only ever see this copy, never the live dict
+            self._config = controller.config.copy()
+            self._config_version = controller.config_version
+        slot = self._slots[(self.seq + 1) & 1]
+        slot[SNAP_SEQ] = self.seq + 1
+        slot[SNAP_LEVEL] = controller.level_percent
+        slot[SNAP_VALVE] = controller.valve_percent
+        slot[SNAP_VOLTAGE] = controller.actuator_voltage
+        slot[SNAP_PUMP] = controller.pump_on
+        slot[SNAP_SAFE] = controller.safe_hold
+        slot[SNAP_CONFIG] = self._config
+        slot[SNAP_VERSION] = self._config_version
+        self.seq += 1
+
+    def read(self, out=None):
+        if out is None: out = [0] * SNAP_FIELDS
+        while True:
+            seq = self.seq
+            slot = self._slots[seq & 1]
+            for i in range(SNAP_FIELDS):
+                out[i] = slot[i]
+            if self.seq == seq:
+                return out
+            self.retries += 1
+
+class CommandQueue:
+    # Server -> control thread. The lock only guards list swaps, never I/O.
+    def __init__(self, maxlen=COMMAND_QUEUE_LEN):
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._items = []
+        self._lock = _thread.allocate_lock() if _thread else None
+
+    def put(self, cmd):
+        if self._lock: self._lock.acquire()
+        try:
+            if len(self._items) >= self.maxlen:
+                self.dropped += 1
+                return False
+            self._items.append(cmd)
+            return True
+        finally:
+            if self._lock: self._lock.release()
+
+    def take(self):
+        if not self._items:
+            return None
+        if self._lock: self._lock.acquire()
+        items = self._items
+        self._items = []
+        if self._lock: self._lock.release()
+        return items
 
-        document.getElementById('btnTarget').onclick = () => postConfig({ target_setpoint: parseFloat(el.iTarget.value) });
-        document.getElementById('btnPump').onclick = () => postConfig({ stop_level: parseFloat(el.iStop.value), start_level: parseFloat(el.iStart.value) });
-        document.getElementById('btnHw').onclick = () => postConfig({ tank_height: parseFloat(el.iH.value), max_dist: parseFloat(el.iM.value) });
-        document.getElementById('btnTun').onclick = () => postConfig({
-            kp: parseFloat(el.iKp.value), ki: parseFloat(el.iKi.value), kd: parseFloat(el.iKd.value),
-            dac_min_v: parseFloat(el.iMinV.value), dac_max_v: parseFloat(el.iMaxV.value)
-        });
-    </script>
-</body>
-</html>
-"""
+# ==========================================
+# STATUS CACHE
+# ==========================================
+STATUS_HEADER = 'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+
+class StatusCache:
+    # The complete /status response (header + JSON), built once per
+    # (tick, config version) and sent as-is to every client until then.
+    def __init__(self, build):
+        self.build = build
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._tick = None
+        self._version = None
+        self._buf = None
+
+    def get(self, tick, version):
+        if self.enabled and tick == self._tick and version == self._version:
+            self.hits += 1
+            return self._buf
+        self.misses += 1
+        body = json.dumps(self.build()).encode()
+        self._buf = (STATUS_HEADER % len(body)).encode() + body
+        self._tick = tick
+        self._version = version
+        return self._buf
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
 
 # ==========================================
-# SERVER
+# BATCH COMMANDS
 # ==========================================
-def start_server(controller):
-    try:
-        ap = network.WLAN(network.AP_IF)
-        ap.active(True)
-        ap.config(essid=WIFI_SSID, password=WIFI_PASS)
-    except: pass
+BATCH_MAX_OPS = 32
+
+def check_value(current, value):
+    # Same kind as the current value. Float keys take ints too, but integer
+    # keys (duty counts, ADC settings) must stay ints: they index tables and
+    # fill array('H') entries.
+    if isinstance(current, bool) or isinstance(value, bool):
+        return isinstance(current, bool) and isinstance(value, bool)
+    if isinstance(current, int):
+        return isinstance(value, int)
+    if isinstance(current, float):
+        return isinstance(value, (int, float))
+    return type(current) == type(value)
+
+def run_batch(ops, config, view):
+    """Validate an ordered list of set/get ops against config.
+
+    view is the current status dict; gets see the sets before them. Returns
+    (updates, results, errors); when errors is non-empty nothing may be
+    applied.
+    """
+    if not isinstance(ops, list) or not ops:
+        return {}, [], ["ops must be a non-empty list"]
+    if len(ops) > BATCH_MAX_OPS:
+        return {}, [], ["too many ops (max %d)" % BATCH_MAX_OPS]
+
+    updates = {}
+    results = []
+    errors = []
+    for i, op in enumerate(ops):
+        kind = op.get('op') if isinstance(op, dict) else None
+        key = op.get('key') if kind else None
+        if key is not None and not isinstance(key, str):
+            errors.append("%d: key must be a string" % i)
+        elif kind == 'set':
+            value = op.get('value')
+            if key not in config:
+                errors.append("%d: unknown key %r" % (i, key))
+            elif not check_value(config[key], value):
+                errors.append("%d: bad value for %s" % (i, key))
+            else:
+                updates[key] = value
+                view[key] = value
+                results.append({"op": "set", "key": key, "value": value})
+        elif kind == 'get':
+            if key is None:
+                results.append({"op": "get", "value": view.copy()})
+            elif key in view:
+                results.append({"op": "get", "key": key, "value": view[key]})
+            else:
+                errors.append("%d: unknown key %r" % (i, key))
+        else:
+            errors.append("%d: op must be 'set' or 'get'" % i)
+    return updates, results, errors
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(('', 80))
-    s.listen(5)
-    s.setblocking(False)
+# ==========================================
+# ADMISSION CONTROL
+# ==========================================
+RESP_400 = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESP_408 = b'HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESP_429 = b'HTTP/1.1 429 Too Many Requests\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESP_503 = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+class AdmissionControl:
+    """Keeps networking from starving the control loop.
+
+    Each loop step may spend budget_ms on connections (serve() stops
+    accepting after that), every client IP gets a token bucket of
+    rate/s with a burst, and the dashboard (the only large response) is
+    only started while ADMIT_STATIC_MIN_MS of budget remains.
+    """
+    def __init__(self, budget_ms=ADMIT_BUDGET_MS, rate=ADMIT_CLIENT_RATE,
+                 burst=ADMIT_CLIENT_BURST, max_clients=ADMIT_MAX_CLIENTS):
+        self.budget_ms = budget_ms
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = {} # ip -> [tokens, last_ms]
+        self.admitted = 0
+        self.shed_429 = 0
+        self.shed_503 = 0
+        self.timeouts = 0
+        self.malformed = 0
+        self.errors = 0
+        self.send_aborts = 0
+        self.exhausted = 0
+        self._start = time.ticks_ms()
+
+    def begin(self):
+        self._start = time.ticks_ms()
+
+    def spent_ms(self):
+        return time.ticks_diff(time.ticks_ms(), self._start)
+
+    def allow(self, ip):
+        now = time.ticks_ms()
+        b = self.buckets.get(ip)
+        if b is None:
+            if len(self.buckets) >= self.max_clients:
+                # Forget the client seen longest ago
+                oldest = None
+                for k, v in self.buckets.items():
+                    if oldest is None or time.ticks_diff(v[1], self.buckets[oldest][1]) < 0:
+                        oldest = k
+                del self.buckets[oldest]
+            b = self.buckets[ip] = [self.burst, now]
+        else:
+            b[0] += time.ticks_diff(now, b[1]) * self.rate / 1000
+            if b[0] > self.burst: b[0] = self.burst
+            b[1] = now
+        if b[0] < 1:
+            return False
+        b[0] -= 1
+        return True
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "shed_429": self.shed_429,
+            "shed_503": self.shed_503,
+            "timeouts": self.timeouts,
+            "malformed": self.malformed,
+            "errors": self.errors,
+            "send_aborts": self.send_aborts,
+            "budget_exhausted": self.exhausted,
+            "clients": len(self.buckets)
+        }
 
-    print("Ultra-Console Ready")
+# ==========================================
+# UDP TELEMETRY
+# ==========================================
+# Datagram layout (little endian, 20 bytes): magic, protocol, flags, seq,
+# ticks_ms, level % Q8, valve % Q8, actuator mV, config version (low 16 bits)
+TELEMETRY_FMT = '<2sBBIIHHHH'
+TELEMETRY_MAGIC = b'TK'
+TELEMETRY_PROTO = 1
+TELEMETRY_PUMP = 0x01
+TELEMETRY_SAFE = 0x02
+
+class TelemetryPublisher:
+    """Sends one sequence-numbered telemetry datagram per control tick.
+
+    The datagram goes to a broadcast or multicast address, so the device
+    pays one sendto() however many listeners there are. A send that fails
+    (no route yet, buffers full) is counted and dropped, never retried.
+    """
+    def __init__(self, addr=TELEMETRY_ADDR, port=TELEMETRY_PORT, period_ms=TELEMETRY_PERIOD_MS):
+        self.dest = (addr, port)
+        self.period_ms = period_ms
+        self.buf = bytearray(struct.calcsize(TELEMETRY_FMT))
+        self.sock = None
+        self.seq = 0
+        self.sent = 0
+        self.errors = 0
+        self._last = None
+
+    def open(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BROADCAST', 0x20), 1)
+        except OSError:
+            pass # Multicast/unicast destinations don't need it
+        s.setblocking(False)
+        self.sock = s
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def publish(self, controller, now=None):
+        # Returns True if a datagram was handed to the network stack
+        if self.sock is None:
+            return False
+        if now is None:
+            now = time.ticks_ms()
+        if self.period_ms and self._last is not None and time.ticks_diff(now, self._last) < self.period_ms:
+            return False
+        self._last = now
+
+        c = controller
+        flags = (TELEMETRY_PUMP if c.pump_on else 0) | (TELEMETRY_SAFE if c.safe_hold else 0)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        struct.pack_into(TELEMETRY_FMT, self.buf, 0, TELEMETRY_MAGIC, TELEMETRY_PROTO, flags,
+                         self.seq, now & 0xFFFFFFFF,
+                         int(c.level_percent * Q_ONE) & 0xFFFF,
+                         int(c.valve_percent * Q_ONE) & 0xFFFF,
+                         int(c.actuator_voltage * 1000) & 0xFFFF,
+                         c.config_version & 0xFFFF)
+        try:
+            self.sock.sendto(self.buf, self.dest)
+        except OSError:
+            self.errors += 1
+            return False
+        self.sent += 1
+        return True
 
-    while True:
-        controller.update()
+    def stats(self):
+        return {"dest": "%s:%d" % self.dest, "seq": self.seq, "sent": self.sent, "errors": self.errors}
 
+# ==========================================
+# SENSOR TRACE
+# ==========================================
+# File: header (magic, version, start ticks_ms), then records, each starting
+# with a tag byte and the ms since the previous record (u16):
+#   sample  distance cm (f32); tag bit 7 set if outputs were held safe
+#   config  JSON length (u16) + the changed keys as JSON
+#   gap     ms since the previous record (u32), when u16 would overflow
+TRACE_MAGIC = b'TKTR'
+TRACE_VERSION = 1
+TRACE_HEADER_FMT = '<4sBI'
+TRACE_SAMPLE_FMT = '<BHf'
+TRACE_CONFIG_FMT = '<BHH'
+TRACE_GAP_FMT = '<BI'
+TRACE_SAMPLE = 1
+TRACE_CONFIG = 2
+TRACE_GAP = 3
+TRACE_SAFE = 0x80
+TRACE_SAMPLE_SIZE = struct.calcsize(TRACE_SAMPLE_FMT)
+TRACE_GAP_SIZE = struct.calcsize(TRACE_GAP_FMT)
+
+class TraceRecorder:
+    """Records what TankController.update() saw, for replay on a PC.
+
+    Attach with start(); the full config is written first. sample() runs
+    inside the tick, so it only packs into a RAM buffer; service(), called
+    after the tick, writes the buffer once it is half full or flush_ms old,
+    so a reset loses at most flush_ms of samples. A sample that finds the
+    buffer full (service() not called) is dropped. Recording stops (and
+    counts what it dropped) once max_bytes have been written.
+    """
+    def __init__(self, f, buf_size=512, max_bytes=TRACE_MAX_BYTES, flush_ms=TRACE_FLUSH_MS):
+        self.f = f
+        self.buf = bytearray(buf_size)
+        self.pos = 0
+        self.written = 0
+        self.max_bytes = max_bytes
+        self.flush_ms = flush_ms
+        self.samples = 0
+        self.dropped = 0
+        self.flushes = 0
+        self._last = None
+        self._flushed = None
+
+    def start(self, controller):
+        now = time.ticks_ms()
+        self._last = self._flushed = now
+        self._put(struct.pack(TRACE_HEADER_FMT, TRACE_MAGIC, TRACE_VERSION, now & 0xFFFFFFFF))
+        self.config(controller.config)
+        controller.recorder = self
+
+    def _delta(self):
+        # ms since the previous record; over 0xFFFF needs a gap record first
+        now = time.ticks_ms()
+        dt = time.ticks_diff(now, self._last)
+        self._last = now
+        return dt if dt > 0 else 0
+
+    def sample(self, dist, safe=False):
+        # In the tick: no file I/O here
+        if self.f is None or self.pos + TRACE_GAP_SIZE + TRACE_SAMPLE_SIZE > len(self.buf):
+            self.dropped += 1
+            return
+        dt = self._delta()
+        if dt > 0xFFFF:
+            struct.pack_into(TRACE_GAP_FMT, self.buf, self.pos, TRACE_GAP, dt)
+            self.pos += TRACE_GAP_SIZE
+            dt = 0
+        tag = TRACE_SAMPLE | (TRACE_SAFE if safe else 0)
+        struct.pack_into(TRACE_SAMPLE_FMT, self.buf, self.pos, tag, dt, dist)
+        self.pos += TRACE_SAMPLE_SIZE
+        self.samples += 1
+
+    def service(self):
+        # After the tick: write the buffer out once half full or flush_ms old
+        if self.pos and (self.pos >= len(self.buf) // 2 or
+                         time.ticks_diff(time.ticks_ms(), self._flushed) >= self.flush_ms):
+            self.flush()
+
+    def config(self, changed):
+        if self.f is None:
+            return
+        body = json.dumps(changed).encode()
+        dt = self._delta()
+        if dt > 0xFFFF:
+            self._put(struct.pack(TRACE_GAP_FMT, TRACE_GAP, dt))
+            dt = 0
+        self._put(struct.pack(TRACE_CONFIG_FMT, TRACE_CONFIG, dt, len(body)) + body)
+
+    def _put(self, data):
+        if self.pos + len(data) > len(self.buf):
+            self.flush()
+        if len(data) > len(self.buf):
+            self._write(data)
+            return
+        self.buf[self.pos:self.pos + len(data)] = data
+        self.pos += len(data)
+
+    def _write(self, data):
+        if self.f is None:
+            return
+        if self.written + len(data) > self.max_bytes:
+            self.f.close()
+            self.f = None
+            return
+        self.f.write(data)
+        self.written += len(data)
+
+    def flush(self):
+        self._flushed = time.ticks_ms()
+        if self.pos:
+            self._write(memoryview(self.buf)[:self.pos])
+            self.pos = 0
+            if self.f is not None:
+                self.f.flush() # Out of the VFS cache, onto flash
+                self.flushes += 1
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def stats(self):
+        return {"samples": self.samples, "bytes": self.written + self.pos,
+                "dropped": self.dropped, "flushes": self.flushes,
+                "recording": self.f is not None}
+
+def open_trace(path, keep=TRACE_KEEP):
+    # Shift path -> path.1 -> ... -> path.<keep-1> and start a fresh file,
+    # so the boot after a WDT reset or brownout keeps the trace that led to it
+    for i in range(keep - 1, 0, -1):
+        src = path if i == 1 else "%s.%d" % (path, i - 1)
+        dst = "%s.%d" % (path, i)
         try:
-            conn, addr = s.accept()
-            conn.settimeout(0.5)
-            request = b""
-            try:
-                while True:
-                    chunk = conn.recv(1024)
-                    if not chunk: break
-                    request += chunk
-                    if b"\r\n\r\n" in request or len(chunk) < 1024: break
-            except OSError: pass
+            os.stat(src)
+        except OSError:
+            continue
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        os.rename(src, dst)
+    return open(path, 'wb')
 
-            req_str = request.decode()
-            if not req_str:
-                conn.close()
-                continue
+# ==========================================
+# BOOT
+# ==========================================
+def mem_free():
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return None
+
+class BootProfile:
+    # Phase timestamps in ms. On MicroPython ticks_ms() starts at reset,
+    # so the phases are times since power-on.
+    def __init__(self):
+        self.t0 = 0 if sys.implementation.name == 'micropython' else time.ticks_ms()
+        self.phases = []
+
+    def mark(self, name):
+        self.phases.append((name, time.ticks_diff(time.ticks_ms(), self.t0), mem_free()))
+
+    def get(self, name):
+        for phase in self.phases:
+            if phase[0] == name: return phase[1]
+        return None
+
+    def to_dict(self):
+        return {
+            "phases": [{"name": n, "t_ms": t, "heap_free": m} for n, t, m in self.phases],
+            "first_tick_ms": self.get('first_tick'),
+            "heap_free": mem_free()
+        }
 
-            line = req_str.split('\n')[0]
-            parts = line.split(' ')
-            method = parts[0]
-            path = parts[1] if len(parts) > 1 else '/'
+BOOT = BootProfile()
 
-            resp = ""
-            ctype = "text/html"
+# ==========================================
+# MEMORY POLICY
+# ==========================================
+class MemoryPolicy:
+    """Keeps gc.collect() pauses out of the sensor-to-actuator path.
+
+    idle(slack_ms) runs right after a tick. It collects when at least
+    GC_COLLECT_BYTES have been allocated since the last collect and the
+    next tick is at least GC_MIN_SLACK_MS away. Collecting often keeps
+    each pause short. gc.threshold is kept at GC_THRESHOLD_STEPS loop
+    steps of measured allocation, so the automatic collection is only a
+    backstop for steps with no slack.
+
+    It also counts the bytes each tick and each HTTP route allocates. On
+    CPython (no gc.mem_alloc) it does nothing.
+    """
+    def __init__(self, collect_bytes=GC_COLLECT_BYTES, min_slack_ms=GC_MIN_SLACK_MS,
+                 threshold_steps=GC_THRESHOLD_STEPS, gc_module=gc):
+        self.collect_bytes = collect_bytes
+        self.min_slack_ms = min_slack_ms
+        self.threshold_steps = threshold_steps
+        self.gc = gc_module
+        self.tick_hist = Histogram(GC_ALLOC_EDGES)
+        self.pause_hist = Histogram(GC_PAUSE_EDGES_US)
+        self.handlers = {} # route -> [requests, bytes, max]
+        self.collects = 0
+        self.no_slack = 0  # Collects wanted but deferred: next tick too close
+        self.auto_gcs = 0  # Collections we did not schedule (heap shrank)
+        self.tick_gcs = 0  # ...of which landed inside a control tick
+        self.threshold = None
+        self.rate = 0      # Bytes allocated per loop step (moving average)
+        self.enabled = hasattr(gc_module, 'mem_alloc')
+        self._mark = self._after = self._tick = gc_module.mem_alloc() if self.enabled else 0
+
+    def tick_begin(self):
+        if self.enabled:
+            self._tick = self.gc.mem_alloc()
+
+    def tick_end(self):
+        if self.enabled:
+            n = self.gc.mem_alloc() - self._tick
+            if n < 0:
+                self.tick_gcs += 1
+            else:
+                self.tick_hist.add(n)
+
+    def handler(self, route, start):
+        # start: mem_alloc() before the request was read
+        if not self.enabled or route is None:
+            return
+        n = self.gc.mem_alloc() - start
+        if n < 0:
+            return # A collection ran meanwhile; the count is meaningless
+        h = self.handlers.get(route)
+        if h is None:
+            h = self.handlers[route] = [0, 0, 0]
+        h[0] += 1
+        h[1] += n
+        if n > h[2]: h[2] = n
+
+    def idle(self, slack_ms):
+        # Returns True if it collected
+        if not self.enabled:
+            return False
+        g = self.gc
+        now = g.mem_alloc()
+        step = now - self._mark
+        if step < 0:
+            self.auto_gcs += 1
+            self._after = now
+        else:
+            self.rate += (step - self.rate) >> 2
+        self._mark = now
+        self._retune()
+
+        if now - self._after < self.collect_bytes:
+            return False
+        if slack_ms < self.min_slack_ms:
+            self.no_slack += 1
+            return False
+        t0 = time.ticks_us()
+        g.collect()
+        self.pause_hist.add(time.ticks_diff(time.ticks_us(), t0))
+        self.collects += 1
+        self._mark = self._after = g.mem_alloc()
+        return True
+
+    def _retune(self):
+        t = self.rate * self.threshold_steps
+        if t < 2 * self.collect_bytes: t = 2 * self.collect_bytes
+        free = self.gc.mem_free()
+        if t > free // 2: t = free // 2
+        # Only touch the allocator when the target moved by a quarter
+        if self.threshold is None or abs(t - self.threshold) > self.threshold >> 2:
+            self.gc.threshold(t)
+            self.threshold = t
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "collects": self.collects,
+            "no_slack": self.no_slack,
+            "auto_gcs": self.auto_gcs,
+            "tick_gcs": self.tick_gcs,
+            "threshold": self.threshold,
+            "alloc_per_step": self.rate,
+            "heap_free": mem_free(),
+            "tick_alloc_bytes": self.tick_hist.to_dict(),
+            "gc_pause_us": self.pause_hist.to_dict(),
+            "handlers": {r: {"requests": h[0], "bytes": h[1], "max": h[2]} for r, h in self.handlers.items()}
+        }
 
-            if path == '/' or path == '/index.html':
-                resp = HTML_CONTENT
-            elif path == '/status':
-                ctype = "application/json"
-                st = controller.config.copy()
-                st.update({
-                    "level_percent": controller.level_percent,
-                    "valve_percent": controller.valve_percent,
-                    "actuator_voltage": controller.actuator_voltage,
-                    "pump_on": controller.pump_on
-                })
-                resp = json.dumps(st)
-            elif path == '/config' and method == 'POST':
+# ==========================================
+# SERVER
+# ==========================================
+ROUTES = ('/', '/index.html', '/status', '/loop', '/boot', '/config', '/batch')
+
+def send_file(conn, path, buf, deadline_ms=None):
+    # Stream a flash file in len(buf) chunks through one preallocated buffer.
+    # With deadline_ms, the whole send stops (returning the bytes sent so
+    # far) once it has taken that long; a slow ACK can't wait past it either.
+    mv = memoryview(buf)
+    sent = 0
+    t0 = time.ticks_ms()
+    with open(path, 'rb') as f:
+        while True:
+            if deadline_ms is not None:
+                left = deadline_ms - time.ticks_diff(time.ticks_ms(), t0)
+                if left <= 0: break
+                if left < ADMIT_SEND_TIMEOUT_MS: conn.settimeout(left / 1000)
+            n = f.readinto(buf)
+            if not n: break
+            conn.sendall(mv[:n])
+            sent += n
+    return sent
+
+def request_complete(request):
+    # Headers done and, for POSTs, Content-Length bytes of body received
+    end = request.find(b"\r\n\r\n")
+    if end < 0:
+        return False
+    head = request[:end].lower()
+    i = head.find(b"content-length:")
+    if i < 0:
+        return True
+    j = head.find(b"\r\n", i)
+    try:
+        length = int(head[i + 15:j if j > 0 else end])
+    except ValueError:
+        return True
+    return len(request) - end - 4 >= length
+
+def start_ap():
+    # Non-blocking: the AP finishes coming up while the control loop runs
+    try:
+        ap = network.WLAN(network.AP_IF)
+        ap.active(True)
+        ap.config(essid=WIFI_SSID, password=WIFI_PASS)
+        return ap
+    except:
+        return None
+
+class ServerLoop:
+    """The firmware main loop, one step() at a time.
+
+    run() is start() then step() forever with a short sleep. Tests and the
+    simulator call step() directly, optionally under a virtual clock.
+    """
+    def __init__(self, controller, port=80, dual_core=DUAL_CORE):
+        self.controller = controller
+        self.port = port
+        self.supervisor = LoopSupervisor(controller, wdt_timeout_ms=WDT_TIMEOUT_MS)
+        self.sampler = SamplingPolicy(controller) if ADAPTIVE_SAMPLING else None
+        self.ap = None
+        self.sock = None
+        self.file_buf = bytearray(FILE_CHUNK)
+
+        self.dual_core = dual_core and _thread is not None
+        self.snapshot = StateSnapshot()
+        self.commands = CommandQueue()
+        self.running = False
+        self._snap = [0] * SNAP_FIELDS
+        self.status_cache = StatusCache(self.status)
+        self.admission = AdmissionControl()
+        self.telemetry = TelemetryPublisher() if TELEMETRY_ENABLED else None
+        self.memory = MemoryPolicy() if GC_POLICY else None
+
+    def start(self, network=True):
+        BOOT.mark('server')
+
+        if TRACE_FILE:
+            TraceRecorder(open_trace(TRACE_FILE)).start(self.controller)
+
+        # Outputs are controlled before any networking starts
+        self.control_tick()
+        self.snapshot.publish(self.controller)
+        BOOT.mark('first_tick')
+
+        if self.dual_core:
+            self.running = True
+            _thread.start_new_thread(self.control_loop, ())
+            BOOT.mark('control_thread')
+
+        if not network:
+            return
+
+        self.ap = start_ap()
+        BOOT.mark('ap_start')
+
+        if self.telemetry is not None:
+            self.telemetry.open()
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('', self.port))
+        s.listen(5)
+        s.setblocking(False)
+        self.sock = s
+        BOOT.mark('listen')
+
+    def control_tick(self):
+        # Returns True if a tick ran
+        sampler = self.sampler
+        if sampler is not None:
+            if not sampler.due():
+                return False
+            self.supervisor.period_ms = sampler.interval_ms
+        mem = self.memory
+        if mem is not None: mem.tick_begin()
+        self.supervisor.tick()
+        if mem is not None: mem.tick_end()
+        if sampler is not None:
+            sampler.observe()
+        if self.telemetry is not None:
+            self.telemetry.publish(self.controller)
+        rec = self.controller.recorder
+        if rec is not None:
+            rec.service() # Flash writes after the outputs, never inside the tick
+        return True
+
+    def control_loop(self):
+        # Control thread: commands, tick, publish; sleep until the next tick
+        while self.running:
+            self.apply_commands()
+            if self.control_tick():
+                self.snapshot.publish(self.controller)
+                if self.memory is not None:
+                    self.memory.idle(self.idle_ms())
+            wait = self.idle_ms()
+            if wait > LOOP_PERIOD_MS: wait = LOOP_PERIOD_MS
+            time.sleep_ms(wait if wait > 0 else 1)
+
+    def stop(self):
+        self.running = False
+
+    def apply_commands(self):
+        items = self.commands.take()
+        if items:
+            for kind, data in items:
+                # A bad command is dropped; it must never stop the control thread
                 try:
-                    body = req_str.split('\r\n\r\n')[1]
-                    data = json.loads(body)
-                    for k,v in data.items():
-                        if k in controller.config and v is not None:
-                            controller.config[k] = v
-                    resp = json.dumps({"status": "ok"})
-                    ctype = "application/json"
-                except:
-                    resp = json.dumps({"status": "err"})
+                    if kind == 'config':
+                        self.controller.set_config(data)
+                except Exception as e:
+                    print("Command %s failed (%s)" % (kind, e))
+
+    def submit_config(self, data):
+        # Single-threaded: apply now (we are between ticks). Dual: queue it.
+        # Checked here so a queued command can't fail later in the control thread.
+        if not isinstance(data, dict):
+            raise ValueError("config must be an object")
+        if self.gain_errors(data):
+            raise ValueError("gain out of range")
+        if self.dual_core:
+            return self.commands.put(('config', data))
+        self.controller.set_config(data)
+        return True
+
+    def gain_errors(self, data):
+        # Fixed point holds gains in Q10 below 16; refuse rather than clamp,
+        # so the PID that runs is always the one configured (to 1/1024)
+        errors = []
+        if isinstance(self.controller, FixedTankController):
+            for k in ('kp', 'ki', 'kd'):
+                v = data.get(k)
+                if isinstance(v, (int, float)) and not -FIXED_GAIN_LIMIT <= v <= FIXED_GAIN_LIMIT:
+                    errors.append("%s: |gain| must be <= %.3f in fixed point" % (k, FIXED_GAIN_LIMIT))
+        return errors
+
+    def batch(self, data):
+        # All-or-nothing: validate every op, then one set_config (or one
+        # queued command) so the whole batch lands at a single tick boundary
+        ops = data.get('ops') if isinstance(data, dict) else None
+        updates, results, errors = run_batch(ops, self.controller.config, self.status())
+        if not errors:
+            errors = self.gain_errors(updates)
+        if errors:
+            return {"status": "err", "errors": errors}
+        if updates and not self.submit_config(updates):
+            return {"status": "busy"}
+        return {"status": "ok", "results": results}
+
+    def status_response(self):
+        if self.dual_core:
+            return self.status_cache.get(self.snapshot.seq, 0)
+        return self.status_cache.get(self.supervisor.ticks, self.controller.config_version)
+
+    def status(self):
+        if self.dual_core:
+            snap = self.snapshot.read(self._snap)
+            st = snap[SNAP_CONFIG].copy()
+            st.update({
+                "level_percent": snap[SNAP_LEVEL],
+                "valve_percent": snap[SNAP_VALVE],
+                "actuator_voltage": snap[SNAP_VOLTAGE],
+                "pump_on": snap[SNAP_PUMP],
+                "safe_hold": snap[SNAP_SAFE]
+            })
+            return st
+        c = self.controller
+        st = c.config.copy()
+        st.update({
+            "level_percent": c.level_percent,
+            "valve_percent": c.valve_percent,
+            "actuator_voltage": c.actuator_voltage,
+            "pump_on": c.pump_on,
+            "safe_hold": c.safe_hold
+        })
+        return st
+
+    def idle_ms(self):
+        # Time until the next control tick is due
+        if self.sampler is not None:
+            last, interval = self.sampler._last, self.sampler.interval_ms
+        else:
+            last, interval = self.supervisor._last_start, self.supervisor.period_ms
+        if last is None:
+            return 0
+        left = interval - time.ticks_diff(time.ticks_ms(), last)
+        return left if left > 0 else 0
+
+    def step(self):
+        if not self.dual_core:
+            self.control_tick()
+
+        ap = self.ap
+        if ap is not None and BOOT.get('ap_up') is None and ap.active():
+            BOOT.mark('ap_up')
+
+        if self.sock is not None:
+            self.serve()
+
+        # Networking done: the rest of the step until the next tick is slack
+        if self.memory is not None and not self.dual_core:
+            self.memory.idle(self.idle_ms())
+
+    def run(self):
+        self.start()
+        print("Ultra-Console Ready")
+        print("Boot:", BOOT.to_dict())
+        while True:
+            self.step()
+            time.sleep(0.05)
+
+    def serve(self):
+        # Handle queued connections until this step's I/O budget is spent;
+        # the rest wait in the listen backlog for the next step
+        adm = self.admission
+        adm.begin()
+        while True:
+            left = adm.budget_ms - adm.spent_ms()
+            if left <= 0:
+                adm.exhausted += 1
+                break
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            mem = self.memory
+            start = mem.gc.mem_alloc() if mem is not None and mem.enabled else None
+            try:
+                route = self.handle(conn, addr, left)
+            except Exception:
+                # Whatever one connection does, the loop goes on
+                adm.errors += 1
+                route = None
+            conn.close()
+            if mem is not None:
+                mem.handler(route, start)
+
+    def handle(self, conn, addr, left):
+        adm = self.admission
+        supervisor = self.supervisor
+        sampler = self.sampler
+
+        # Charged before reading: a client that never finishes its request
+        # must run out of tokens too, or it holds every step's budget
+        if not adm.allow(addr[0]):
+            adm.shed_429 += 1
+            conn.settimeout(ADMIT_SEND_TIMEOUT_MS / 1000)
+            conn.sendall(RESP_429)
+            return 'shed'
+
+        conn.settimeout((left if left > ADMIT_MIN_READ_MS else ADMIT_MIN_READ_MS) / 1000)
+        request = b""
+        try:
+            while True:
+                chunk = conn.recv(1024)
+                if not chunk: break
+                request += chunk
+                if request_complete(request): break
+        except OSError: pass
+        # The read deadline is far too short for a response on a slow link
+        conn.settimeout(ADMIT_SEND_TIMEOUT_MS / 1000)
+
+        if not request_complete(request):
+            # Too slow for this step's budget; don't let it hold the loop
+            adm.timeouts += 1
+            conn.sendall(RESP_408)
+            return 'shed'
 
-            conn.send('HTTP/1.1 200 OK\r\n'.encode())
-            conn.send(f'Content-Type: {ctype}\r\n'.encode())
-            conn.send('Connection: close\r\n\r\n'.encode())
+        try:
+            req_str = request.decode()
+        except UnicodeError:
+            adm.malformed += 1
+            conn.sendall(RESP_400)
+            return 'shed'
+        line = req_str.split('\n')[0]
+        parts = line.split(' ')
+        method = parts[0]
+        path = parts[1] if len(parts) > 1 else '/'
+
+        resp = ""
+        raw = None
+        ctype = "text/html"
+        status = "200 OK"
+
+        if path == '/' or path == '/index.html':
+            # Lowest priority: only start a dashboard send with budget to spare
+            if adm.budget_ms - adm.spent_ms() < ADMIT_STATIC_MIN_MS:
+                adm.shed_503 += 1
+                conn.sendall(RESP_503)
+                return 'shed'
+            try:
+                size = os.stat(DASHBOARD_FILE)[6]
+                resp = None # Streamed below
+            except OSError:
+                status = "404 Not Found"
+                resp = "Dashboard not installed"
+        elif path == '/status':
+            raw = self.status_response()
+        elif path == '/loop':
+            ctype = "application/json"
+            st = supervisor.stats()
+            if sampler: st["sampling"] = sampler.stats()
+            st["status_cache"] = self.status_cache.stats()
+            st["admission"] = adm.stats()
+            if self.telemetry: st["telemetry"] = self.telemetry.stats()
+            if self.controller.recorder: st["trace"] = self.controller.recorder.stats()
+            if self.memory: st["memory"] = self.memory.stats()
+            st["outputs"] = self.controller.output_stats()
+            if isinstance(self.controller, FixedTankController):
+                pid = self.controller.pid
+                st["fixed_gains"] = {"kp": pid.kp / (1 << GAIN_SHIFT), "ki": pid.ki / (1 << GAIN_SHIFT),
+                                     "kd": pid.kd / (1 << GAIN_SHIFT)}
+            resp = json.dumps(st)
+        elif path == '/boot':
+            ctype = "application/json"
+            resp = json.dumps(BOOT.to_dict())
+        elif path == '/config' and method == 'POST':
+            try:
+                body = req_str.split('\r\n\r\n')[1]
+                data = json.loads(body)
+                if self.submit_config(data):
+                    resp = json.dumps({"status": "ok"})
+                else:
+                    resp = json.dumps({"status": "busy"})
+                ctype = "application/json"
+            except:
+                resp = json.dumps({"status": "err"})
+        elif path == '/batch' and method == 'POST':
+            ctype = "application/json"
+            try:
+                data = json.loads(req_str.split('\r\n\r\n')[1])
+            except:
+                data = None
+            result = self.batch(data)
+            if result["status"] == "err": status = "400 Bad Request"
+            resp = json.dumps(result)
+
+        adm.admitted += 1
+        route = path if path in ROUTES else 'other'
+        if raw is not None:
+            conn.sendall(raw)
+            return route
+
+        conn.send(f'HTTP/1.1 {status}\r\n'.encode())
+        conn.send(f'Content-Type: {ctype}\r\n'.encode())
+        conn.send('Connection: close\r\n\r\n'.encode())
+        if resp is None:
+            # Single loop: the tick waits on this send, so it gets a deadline
+            # (a truncated page beats a late tick). Dual core: no need.
+            try:
+                sent = send_file(conn, DASHBOARD_FILE, self.file_buf,
+                                 None if self.dual_core else ADMIT_STATIC_SEND_MS)
+            except OSError:
+                sent = -1
+            if sent != size:
+                adm.send_aborts += 1
+        else:
             conn.send(resp.encode())
-            conn.close()
+        return route
 
-        except OSError: pass
-        time.sleep(0.05)
+def start_server(controller, port=80, dual_core=DUAL_CORE):
+    ServerLoop(controller, port, dual_core).run()
 
 if __name__ == '__main__':
-    ctrl = TankController()
+    BOOT.mark('import')
+    ctrl = FixedTankController() if FIXED_POINT else TankController()
+    BOOT.mark('outputs_safe')
     start_server(ctrl)
@@ -5,9 +5,11 @@ class Pin:
         self.id = id
         self.mode = mode
         self.value_ = 0
+        self.writes = 0
     def value(self, v=None):
         if v is not None:
             self.value_ = v
+            self.writes += 1
         return self.value_
 
 class PWM:
@@ -15,22 +17,46 @@ class PWM:
         self.pin = pin
         self.freq_ = freq
         self.duty_ = duty
+        self.writes = 0
     def freq(self, f=None):
         if f is not None: self.freq_ = f
         return self.freq_
     def duty(self, d=None):
-        if d is not None: self.duty_ = d
+        if d is not None:
+            self.duty_ = d
+            self.writes += 1
         return self.duty_
 
 class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
     ATTN_11DB = 3
-    WIDTH_10BIT = 10
+    WIDTH_9BIT = 0
+    WIDTH_10BIT = 1
+    WIDTH_11BIT = 2
+    WIDTH_12BIT = 3
     def __init__(self, pin):
         self.pin = pin
+        self.value_ = 0     # Raw reading, or a callable returning one
+        self.reads = 0
+        self.atten_ = None
+        self.width_ = None
     def read(self):
-        return 0
-    def atten(self, a): pass
-    def width(self, w): pass
+        self.reads += 1
+        return self.value_() if callable(self.value_) else self.value_
+    def atten(self, a): self.atten_ = a
+    def width(self, w): self.width_ = w
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+    def feed(self):
+        self.feeds += 1
+
+def time_pulse_us(pin, level, timeout_us=1000000):
+    return -2 # No echo: timed out waiting for the pulse
 
 def reset():
     pass
@@ -1,17 +1,97 @@
 # Add missing time functions for testing
 import time
 
+# MicroPython ticks wrap at 2**30 (ESP32 port)
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+def wrap_ticks_diff(end, start):
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
 if not hasattr(time, 'ticks_ms'):
     def ticks_ms():
         return int(time.time() * 1000)
     time.ticks_ms = ticks_ms
 
+if not hasattr(time, 'ticks_us'):
+    def ticks_us():
+        return int(time.time() * 1000000)
+    time.ticks_us = ticks_us
+
 if not hasattr(time, 'ticks_diff'):
     def ticks_diff(start, end):
         return start - end
     time.ticks_diff = ticks_diff
 
+if not hasattr(time, 'ticks_add'):
+    time.ticks_add = lambda ticks, delta: ticks + delta
+
 if not hasattr(time, 'sleep_us'):
     def sleep_us(us):
         time.sleep(us / 1000000.0)
     time.sleep_us = sleep_us
+
+if not hasattr(time, 'sleep_ms'):
+    def sleep_ms(ms):
+        time.sleep(ms / 1000.0)
+    time.sleep_ms = sleep_ms
+
+class VirtualClock:
+    """Deterministic replacement for the MicroPython time functions.
+
+    While installed, ticks_ms/ticks_us return wrapped virtual ticks and
+    sleep/sleep_ms/sleep_us advance virtual time instead of blocking:
+
+        with VirtualClock(start_ms=TICKS_MAX - 1000) as clock:
+            clock.advance(50)
+    """
+    PATCHED = ('ticks_ms', 'ticks_us', 'ticks_diff', 'ticks_add', 'sleep', 'sleep_ms', 'sleep_us')
+
+    def __init__(self, start_ms=0):
+        self.us = start_ms * 1000
+        self._saved = None
+
+    def ticks_ms(self):
+        return (self.us // 1000) & TICKS_MAX
+
+    def ticks_us(self):
+        return self.us & TICKS_MAX
+
+    def ticks_diff(self, end, start):
+        return wrap_ticks_diff(end, start)
+
+    def ticks_add(self, ticks, delta):
+        return ticks_add(ticks, delta)
+
+    def sleep(self, s):
+        self.us += int(round(s * 1000000))
+
+    def sleep_ms(self, ms):
+        self.us += int(ms) * 1000
+
+    def sleep_us(self, us):
+        self.us += int(us)
+
+    def advance(self, ms):
+        self.us += int(round(ms * 1000))
+
+    def install(self):
+        self._saved = {name: getattr(time, name, None) for name in self.PATCHED}
+        for name in self.PATCHED:
+            setattr(time, name, getattr(self, name))
+        return self
+
+    def uninstall(self):
+        for name, fn in self._saved.items():
+            setattr(time, name, fn)
+        self._saved = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
@@ -8,10 +8,16 @@ sys.path.append(os.getcwd())
 sys.path.append(os.path.join(os.getcwd(), 'tests/mocks'))
 
 import time_mock # Patch time module for ticks_ms
+from time_mock import VirtualClock, TICKS_MAX
 import machine
 import network
 import main
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # tools/analytics.py tests are skipped
+
 class TestTankController(unittest.TestCase):
     def setUp(self):
         self.ctrl = main.TankController()
@@ -73,5 +79,1352 @@ class TestTankController(unittest.TestCase):
         self.ctrl.update()
         self.assertAlmostEqual(self.ctrl.actuator_voltage, 1.5, places=2)
 
+class TestLoopSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = main.TankController()
+        self.ctrl.trig = None
+        self.ctrl.read_distance = lambda: 90.0 # 10% -> pump latched on
+        self.ctrl.pump_active_latch = True
+        self.sup = main.LoopSupervisor(self.ctrl, wdt_timeout_ms=5000)
+
+    def test_on_time_ticks_feed_wdt(self):
+        for _ in range(3):
+            self.sup.tick()
+        self.assertEqual(self.sup.wdt.feeds, 3)
+        self.assertEqual(self.sup.period_hist.n, 2)
+        self.assertEqual(self.ctrl.pump.value(), 1)
+
+    def test_late_tick_trips_safe_state(self):
+        self.sup.tick()
+        self.sup._last_start = time.ticks_ms() - 3000
+        late = self.sup.tick()
+        self.assertGreaterEqual(late, main.LOOP_TRIP_MS)
+        self.assertEqual(self.sup.trips, 1)
+        self.assertEqual(self.sup.wdt.feeds, 1) # Late tick not fed
+        self.assertTrue(self.ctrl.safe_hold)
+        self.assertEqual(self.ctrl.pump.value(), 0)
+        self.assertEqual(self.ctrl.actuator.duty(), 0)
+
+        # Outputs stay safe until enough on-time ticks
+        for _ in range(main.LOOP_RECOVER_TICKS - 1):
+            self.sup.tick()
+            self.assertEqual(self.ctrl.pump.value(), 0)
+        self.sup.tick()
+        self.assertFalse(self.ctrl.safe_hold)
+        self.assertEqual(self.ctrl.pump.value(), 1)
+
+class TestFixedPoint(unittest.TestCase):
+    CONFIG = {
+        "tank_height": 100.0, "max_dist": 100.0, "target_setpoint": 55.0,
+        "stop_level": 90.0, "start_level": 10.0,
+        "kp": 2.5, "ki": 0.3, "kd": 0.5,
+        "deadband_enabled": False, "dac_min_v": 0.66, "dac_max_v": 3.3
+    }
+
+    def setUp(self):
+        # Deterministic 50ms ticks
+        self.clock = VirtualClock().install()
+
+    def tearDown(self):
+        self.clock.uninstall()
+
+    def make(self, cls):
+        ctrl = cls()
+        ctrl.trig = None
+        ctrl.actuator = machine.PWM(machine.Pin(26))
+        ctrl.pump = machine.Pin(16)
+        ctrl.set_config(self.CONFIG)
+        return ctrl
+
+    def test_matches_float_over_long_run(self):
+        flt = self.make(main.TankController)
+        fix = self.make(main.FixedTankController)
+        max_valve = max_volt = 0.0
+        for i in range(20000):
+            # Slow wave plus steps (whole mm so both see the same input)
+            dist_mm = 500 + (i * 37) % 400 - 200 + (300 if (i // 2500) % 2 else -300)
+            flt.read_distance = lambda: dist_mm / 10.0
+            fix.read_distance = lambda: dist_mm / 10.0
+            self.clock.advance(50)
+            flt.update()
+            fix.update()
+            max_valve = max(max_valve, abs(flt.valve_percent - fix.valve_percent))
+            max_volt = max(max_volt, abs(flt.actuator_voltage - fix.actuator_voltage))
+            self.assertEqual(flt.pump_on, fix.pump_on)
+        # Q8 input step (1/256 %) amplified by kd / dt bounds the difference
+        self.assertLess(max_valve, 0.1)  # % of valve
+        self.assertLess(max_volt, 0.003)  # V
+
+    def test_anti_windup_clamp(self):
+        fix = self.make(main.FixedTankController)
+        fix.read_distance = lambda: 100.0  # Level 0, error 55%
+        for _ in range(1000):
+            self.clock.advance(50)
+            fix.update()
+        self.assertEqual(fix.pid._integral, fix.pid.out_max << main.GAIN_SHIFT)
+        self.assertEqual(fix.valve_percent, 100.0)
+        self.assertAlmostEqual(fix.actuator_voltage, 3.3, places=3)
+
+    def test_tick_state_is_small_int(self):
+        fix = self.make(main.FixedTankController)
+        for i in range(2000):
+            fix.read_distance = lambda: float(i % 100)
+            self.clock.advance(50)
+            fix.update()
+            for v in (fix.level_q, fix.valve_q, fix.actuator_mv, fix.actuator.duty(),
+                      fix.pid._integral, fix.pid._last_error):
+                self.assertIs(type(v), int)
+                self.assertLess(abs(v), 1 << 30)
+
+    def test_out_of_range_gain_refused(self):
+        fix = main.FixedTankController()
+        fix.trig = None
+        loop = main.ServerLoop(fix)
+        r = loop.batch({"ops": [{"op": "set", "key": "kp", "value": 20.0}]})
+        self.assertEqual(r["status"], "err")
+        body = b'{"kd": -16.5}'
+        conn = ScriptedConn(b"POST /config HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        loop.serve()
+        self.assertIn(b'"err"', b"".join(conn.sent))
+        self.assertEqual((fix.config["kp"], fix.config["kd"]),
+                         (main.DEFAULT_CONFIG["kp"], main.DEFAULT_CONFIG["kd"]))
+
+        # In range: /loop reports the gains the fixed-point PID actually uses
+        self.assertEqual(loop.batch({"ops": [{"op": "set", "key": "kp", "value": 15.9}]})["status"], "ok")
+        fix.update()
+        conn = ScriptedConn(b"GET /loop HTTP/1.1\r\n\r\n")
+        loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        loop.serve()
+        gains = json.loads(b"".join(conn.sent).split(b"\r\n\r\n", 1)[1])["fixed_gains"]
+        self.assertEqual(gains["kp"], round(15.9 * 1024) / 1024)
+
+        # The float controller has no such limit
+        flt = main.TankController()
+        self.assertEqual(main.ServerLoop(flt).batch(
+            {"ops": [{"op": "set", "key": "kp", "value": 20.0}]})["status"], "ok")
+
+def legacy_tick(pid_state, cfg, dist, dt, pump_on):
+    # Pre-kernel inline math from TankController.update() / PID.compute()
+    h = cfg['tank_height']
+    empty = cfg['max_dist']
+    full = empty - h
+    span = empty - full
+    if span <= 0: span = 1
+    level = ((empty - dist) / span) * 100.0
+    if level < 0: level = 0
+    if level > 100: level = 100
+
+    kp, ki, kd = cfg['kp'], cfg['ki'], cfg['kd']
+    error = cfg['target_setpoint'] - level
+    pid_state[0] += error * dt
+    if pid_state[0] * ki > 100: pid_state[0] = 100 / ki if ki else 0
+    elif pid_state[0] * ki < 0: pid_state[0] = 0 / ki if ki else 0
+    out = kp * error + ki * pid_state[0] + kd * ((error - pid_state[1]) / dt)
+    if out < 0: out = 0
+    elif out > 100: out = 100
+    pid_state[1] = error
+
+    if pump_on:
+        vs = cfg['dac_max_v'] - cfg['dac_min_v']
+        if vs < 0: vs = 0
+        v = cfg['dac_min_v'] + (out / 100.0 * vs)
+    else:
+        v = 0.0
+    if v > 3.3: v = 3.3
+    if v < 0: v = 0
+    duty = int(min(v / 3.3, 1.0) * cfg['valve_max_duty'])
+    return level, out, v, duty
+
+class TestKernels(unittest.TestCase):
+    def test_kernels_match_inline_math(self):
+        cfg = dict(main.DEFAULT_CONFIG, kp=1.7, ki=0.35, kd=0.2, target_setpoint=62.5)
+        state = [0.0, 0.0]
+        integral = last = 0.0
+        for i in range(5000):
+            dist = 180.0 - (i * 13 % 1900) / 10.0
+            dt = 0.02 + (i % 7) * 0.011
+            pump_on = (i // 300) % 3 != 0
+            ref = legacy_tick(state, cfg, dist, dt, pump_on)
+
+            level = main.calc_level_percent(dist, cfg['max_dist'], cfg['tank_height'])
+            error = cfg['target_setpoint'] - level
+            integral = main.pid_integral(integral, error, dt, cfg['ki'], 0, 100)
+            out = main.pid_output(error, last, integral, dt, cfg['kp'], cfg['ki'], cfg['kd'], 0, 100)
+            last = error
+            v = main.calc_actuator_volts(out, cfg['dac_min_v'], cfg['dac_max_v'], pump_on)
+            duty = main.calc_duty(v, cfg['valve_max_duty'])
+            self.assertEqual(ref, (level, out, v, duty))
+
+    def test_native_decorated_path(self):
+        # Simulate MicroPython: every kernel must go through micropython.native
+        import importlib.util, types
+        fake = types.ModuleType('micropython')
+        compiled = {}
+        def native(f):
+            compiled[f.__name__] = g = lambda *a: f(*a)
+            return g
+        fake.native = native
+        sys.modules['micropython'] = fake
+        try:
+            spec = importlib.util.spec_from_file_location('main_native', main.__file__)
+            mod = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(mod)
+        finally:
+            del sys.modules['micropython']
+
+        kernels = {'pid_integral', 'pid_output', 'calc_level_percent', 'calc_actuator_volts',
+                   'calc_duty', 'lut_interp', 'pid_integral_q', 'pid_output_q', 'calc_level_q',
+                   'calc_actuator_mv', 'adc_burst', 'block_mean', 'calc_adc_level_mm'}
+        self.assertEqual(set(compiled), kernels)
+        for name in kernels:
+            # The module binds what the decorator returned, not the bytecode function
+            self.assertIs(getattr(mod, name), compiled[name])
+
+class FakeConn:
+    def __init__(self):
+        self.sent = []
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+    def send(self, data):
+        self.sent.append(bytes(data))
+        return len(data)
+
+class TestBoot(unittest.TestCase):
+    def test_dashboard_streamed_in_chunks(self):
+        conn = FakeConn()
+        n = main.send_file(conn, main.DASHBOARD_FILE, bytearray(main.FILE_CHUNK))
+        with open(main.DASHBOARD_FILE, 'rb') as f:
+            html = f.read()
+        self.assertEqual(n, len(html))
+        self.assertEqual(b"".join(conn.sent), html)
+        self.assertTrue(all(len(c) <= main.FILE_CHUNK for c in conn.sent))
+        self.assertFalse(hasattr(main, 'HTML_CONTENT'))
+
+    def test_first_tick_before_ap(self):
+        class Stop(Exception): pass
+        ctrl = main.TankController()
+        ctrl.trig = None
+        events = []
+        update = ctrl.update
+        def tick():
+            events.append('tick')
+            update()
+        def ap():
+            events.append('ap')
+            raise Stop()
+        ctrl.update = tick
+        orig_ap = main.start_ap
+        main.start_ap = ap
+        try:
+            with self.assertRaises(Stop):
+                main.start_server(ctrl, port=0)
+        finally:
+            main.start_ap = orig_ap
+        self.assertEqual(events, ['tick', 'ap'])
+        self.assertIsNotNone(main.BOOT.get('first_tick'))
+        self.assertIn('first_tick_ms', main.BOOT.to_dict())
+
+class TestVirtualClock(unittest.TestCase):
+    def test_ticks_wraparound(self):
+        with VirtualClock(start_ms=TICKS_MAX - 20) as clock:
+            t0 = time.ticks_ms()
+            clock.sleep(0.05)
+            t1 = time.ticks_ms()
+            self.assertLess(t1, t0) # Wrapped
+            self.assertEqual(time.ticks_diff(t1, t0), 50)
+            self.assertEqual(time.ticks_diff(t0, t1), -50)
+            self.assertEqual(time.ticks_add(t0, 50), t1)
+            clock.sleep_us(1500)
+            self.assertEqual(time.ticks_diff(time.ticks_ms(), t1), 1)
+
+    def test_pid_dt_across_wrap(self):
+        with VirtualClock(start_ms=TICKS_MAX - 100) as clock:
+            pid = main.PID(0.0, 1.0, 0.0, 10.0)
+            for _ in range(4):
+                clock.advance(50)
+                pid.compute(0.0)
+            # 0.2s of 10% error
+            self.assertAlmostEqual(pid._integral, 2.0)
+
+    def simulate(self, hours):
+        with VirtualClock(start_ms=TICKS_MAX - 60000) as clock:
+            ctrl = main.TankController()
+            ctrl.trig = None
+            ctrl.simulated_level = 30.0
+            loop = main.ServerLoop(ctrl)
+            loop.supervisor.wdt = None
+            loop.start(network=False)
+            trace = []
+            end = hours * 3600 * 1000
+            elapsed = 0
+            while elapsed < end:
+                step = max(loop.idle_ms(), 1)
+                clock.advance(step)
+                elapsed += step
+                loop.step()
+                trace.append((ctrl.level_percent, ctrl.valve_percent, ctrl.pump_on))
+            return ctrl, loop, trace
+
+    def test_hours_of_control_reproducible(self):
+        t0 = time.perf_counter()
+        ctrl, loop, trace = self.simulate(2)
+        self.assertLess(time.perf_counter() - t0, 10)
+        self.assertEqual(loop.supervisor.trips, 0)
+        self.assertAlmostEqual(ctrl.level_percent, ctrl.config['target_setpoint'], delta=1.0)
+        self.assertEqual(self.simulate(2)[2], trace)
+
+class TestSamplingPolicy(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = main.TankController()
+        self.ctrl.config.update({"start_level": 10.0, "stop_level": 90.0, "target_setpoint": 50.0})
+        self.policy = main.SamplingPolicy(self.ctrl)
+        self.now = 0
+
+    def sample(self, level):
+        self.ctrl.level_percent = level
+        interval = self.policy.observe(self.now)
+        self.now += interval
+        return interval
+
+    def test_backs_off_when_stable_mid_band(self):
+        intervals = [self.sample(50.0) for _ in range(10)]
+        self.assertEqual(intervals[0], main.SAMPLE_MIN_MS)
+        self.assertEqual(intervals[-1], main.SAMPLE_MAX_MS)
+        self.assertEqual(intervals, sorted(intervals))
+
+    def test_fast_near_limit_and_on_error(self):
+        for _ in range(10): self.sample(50.0)
+        # 1% below stop limit: 0.5s at SAMPLE_MAX_RATE
+        for _ in range(5): interval = self.sample(88.8)
+        self.assertLessEqual(interval, 600)
+        self.assertEqual(self.sample(89.9), main.SAMPLE_MIN_MS)
+
+        for _ in range(10): self.sample(50.0)
+        self.ctrl.config['target_setpoint'] = 70.0
+        self.assertEqual(self.sample(50.0), main.SAMPLE_MIN_MS)
+
+    def test_detection_delay_bounded_at_limits(self):
+        # Level ramps at the assumed max rate from mid-band through stop_level
+        level = 50.0
+        while level < 92.0:
+            self.ctrl.config['target_setpoint'] = level # Keep error small
+            last = self.now
+            self.sample(level)
+            level += main.SAMPLE_MAX_RATE * (self.now - last) / 1000.0
+        st = self.policy.stats()
+        self.assertGreater(st["worst_detect_ms"], 0)
+        self.assertLessEqual(st["worst_detect_ms"], 2 * main.SAMPLE_MIN_MS)
+        self.assertLess(st["samples_per_min"], 60000 / main.SAMPLE_MIN_MS)
+
+    def test_due(self):
+        self.assertTrue(self.policy.due(0))
+        self.sample(50.0)
+        self.assertFalse(self.policy.due(self.policy._last + 1))
+        self.assertTrue(self.policy.due(self.policy._last + self.policy.interval_ms))
+
+class TestLoadHarness(unittest.TestCase):
+    def test_percentiles(self):
+        from tools import loadtest
+        vals = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(vals, 50), 50)
+        self.assertEqual(loadtest.percentile(vals, 99), 99)
+        self.assertIsNone(loadtest.percentile([], 50))
+        hist = {"edges": [10, 20, 50], "counts": [90, 9, 1, 0], "max": 35}
+        self.assertEqual(loadtest.hist_percentile(hist, 50), 10)
+        self.assertEqual(loadtest.hist_percentile(hist, 95), 20)
+        self.assertEqual(loadtest.hist_percentile(hist, 100), 35)
+
+    def test_short_run_report(self):
+        from tools import loadtest
+        report = loadtest.run(clients=2, duration=1.0)
+        json.dumps(report)
+        client = report["client"]
+        self.assertGreater(client["requests"], 0)
+        self.assertEqual(client["error_rate"], 0)
+        self.assertIsNotNone(client["p99_ms"])
+        self.assertGreater(report["server"]["ticks"], 0)
+
+class TestDualCore(unittest.TestCase):
+    def test_snapshot_never_torn(self):
+        import threading
+        snap = main.StateSnapshot()
+        # Property reads in publish() give the interpreter switch points
+        ctrl = main.FixedTankController()
+        stop = []
+        torn = []
+        reads = [0]
+
+        def writer():
+            i = 0
+            while not stop:
+                i += 1
+                ctrl.level_percent = ctrl.valve_percent = ctrl.actuator_voltage = float(i)
+                ctrl.pump_on = ctrl.safe_hold = bool(i & 1)
+                snap.publish(ctrl)
+
+        def reader():
+            out = [0] * main.SNAP_FIELDS
+            for _ in range(3000):
+                s = snap.read(out)
+                v = s[main.SNAP_LEVEL]
+                if not (s[main.SNAP_VALVE] == s[main.SNAP_VOLTAGE] == v
+                        and s[main.SNAP_PUMP] == s[main.SNAP_SAFE] == bool(int(v) & 1)):
+                    torn.append(list(s))
+                reads[0] += 1
+
+        w = threading.Thread(target=writer)
+        readers = [threading.Thread(target=reader) for _ in range(3)]
+        old = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6) # Force frequent preemption
+        try:
+            w.start()
+            for r in readers: r.start()
+            for r in readers: r.join()
+        finally:
+            stop.append(True)
+            w.join()
+            sys.setswitchinterval(old)
+        self.assertEqual(torn, [])
+        self.assertEqual(reads[0], 9000)
+        self.assertGreater(snap.seq, 100)
+
+    def test_control_thread_applies_queued_config(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        loop = main.ServerLoop(ctrl, dual_core=True)
+        loop.supervisor.wdt = None
+        loop.start(network=False)
+        try:
+            self.assertTrue(loop.dual_core)
+            self.assertTrue(loop.submit_config({"target_setpoint": 65.0}))
+            deadline = time.time() + 2
+            while loop.status()["target_setpoint"] != 65.0 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(ctrl.config["target_setpoint"], 65.0)
+            self.assertEqual(loop.status()["target_setpoint"], 65.0)
+            ticks = loop.supervisor.ticks
+            time.sleep(0.2)
+            self.assertGreater(loop.supervisor.ticks, ticks)
+        finally:
+            loop.stop()
+
+    def test_bad_config_never_reaches_control_thread(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        loop = main.ServerLoop(ctrl, dual_core=True)
+        self.assertTrue(loop.dual_core)
+        conn = ScriptedConn(b"POST /config HTTP/1.1\r\nContent-Length: 5\r\n\r\n[1,2]")
+        loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        loop.serve()
+        self.assertIn(b'"err"', b"".join(conn.sent))
+        self.assertIsNone(loop.commands.take())
+        # Whatever slips into the queue is dropped without killing the thread
+        loop.commands.put(('config', [1, 2]))
+        loop.commands.put(('config', {"target_setpoint": 65.0}))
+        loop.apply_commands()
+        self.assertEqual(ctrl.config["target_setpoint"], 65.0)
+
+    def test_command_queue_bounded(self):
+        q = main.CommandQueue(maxlen=2)
+        self.assertTrue(q.put(1))
+        self.assertTrue(q.put(2))
+        self.assertFalse(q.put(3))
+        self.assertEqual(q.dropped, 1)
+        self.assertEqual(q.take(), [1, 2])
+        self.assertIsNone(q.take())
+
+class TestStatusCache(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = main.TankController()
+        self.ctrl.trig = None
+        self.loop = main.ServerLoop(self.ctrl)
+        self.loop.sampler = None
+        self.loop.supervisor.wdt = None
+
+    def test_one_serialization_per_tick(self):
+        self.loop.control_tick()
+        bufs = [self.loop.status_response() for _ in range(5)]
+        self.assertTrue(all(b is bufs[0] for b in bufs))
+        self.assertEqual(self.loop.status_cache.stats(), {"hits": 4, "misses": 1})
+
+        header, body = bufs[0].split(b"\r\n\r\n", 1)
+        self.assertIn(b"Content-Length: %d" % len(body), header)
+        self.assertEqual(json.loads(body)["level_percent"], self.ctrl.level_percent)
+
+        self.loop.control_tick()
+        self.assertIsNot(self.loop.status_response(), bufs[0])
+        self.assertEqual(self.loop.status_cache.misses, 2)
+
+    def test_config_change_invalidates(self):
+        self.loop.control_tick()
+        self.loop.status_response()
+        self.loop.submit_config({"target_setpoint": 70.0})
+        body = self.loop.status_response().split(b"\r\n\r\n", 1)[1]
+        self.assertEqual(json.loads(body)["target_setpoint"], 70.0)
+        self.assertEqual(self.loop.status_cache.misses, 2)
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = main.TankController()
+        self.ctrl.trig = None
+        self.loop = main.ServerLoop(self.ctrl)
+
+    def test_ordered_and_atomic(self):
+        version = self.ctrl.config_version
+        r = self.loop.batch({"ops": [
+            {"op": "get", "key": "kp"},
+            {"op": "set", "key": "kp", "value": 2.5},
+            {"op": "set", "key": "deadband_enabled", "value": False},
+            {"op": "get", "key": "kp"},
+            {"op": "get"}
+        ]})
+        self.assertEqual(r["status"], "ok")
+        values = [res["value"] for res in r["results"]]
+        self.assertEqual(values[0], main.DEFAULT_CONFIG["kp"])
+        self.assertEqual(values[3], 2.5)
+        self.assertFalse(values[4]["deadband_enabled"])
+        self.assertIn("level_percent", values[4])
+        self.assertEqual(self.ctrl.config["kp"], 2.5)
+        self.assertEqual(self.ctrl.config_version, version + 1) # One commit
+
+    def test_invalid_op_applies_nothing(self):
+        version = self.ctrl.config_version
+        r = self.loop.batch({"ops": [
+            {"op": "set", "key": "kp", "value": 3.0},
+            {"op": "set", "key": "deadband_enabled", "value": 1},
+            {"op": "set", "key": "nope", "value": 1.0},
+            {"op": "frob"}
+        ]})
+        self.assertEqual(r["status"], "err")
+        self.assertEqual(len(r["errors"]), 3)
+        self.assertEqual(self.ctrl.config["kp"], main.DEFAULT_CONFIG["kp"])
+        self.assertEqual(self.ctrl.config_version, version)
+        self.assertEqual(self.loop.batch({"ops": []})["status"], "err")
+        self.assertEqual(self.loop.batch(None)["status"], "err")
+
+    def test_float_for_integer_key_rejected(self):
+        for cls in (main.TankController, main.FixedTankController):
+            ctrl = cls()
+            ctrl.trig = None
+            loop = main.ServerLoop(ctrl)
+            body = json.dumps({"ops": [
+                {"op": "set", "key": "valve_max_duty", "value": 1000.5},
+                {"op": "set", "key": "duty_curve", "value": [[0, 0], [3.3, 100]]}
+            ]}).encode()
+            conn = ScriptedConn(b"POST /batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+            loop.serve()
+            self.assertIn(b"400 Bad Request", b"".join(conn.sent))
+            self.assertEqual(ctrl.config["valve_max_duty"], 1023)
+            ctrl.update()
+        # Float keys still take ints
+        self.assertEqual(main.ServerLoop(ctrl).batch(
+            {"ops": [{"op": "set", "key": "target_setpoint", "value": 60}]})["status"], "ok")
+
+    def test_non_string_key_rejected(self):
+        version = self.ctrl.config_version
+        r = self.loop.batch({"ops": [
+            {"op": "set", "key": [1], "value": 1},
+            {"op": "get", "key": {}},
+            {"op": "get", "key": 3}
+        ]})
+        self.assertEqual(r["status"], "err")
+        self.assertEqual(len(r["errors"]), 3)
+        self.assertEqual(self.ctrl.config_version, version)
+        # Over HTTP the loop keeps serving
+        body = b'{"ops":[{"op":"set","key":[1],"value":1}]}'
+        conn = ScriptedConn(b"POST /batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        self.loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        self.loop.serve()
+        self.assertIn(b'"err"', b"".join(conn.sent))
+
+    def test_request_complete_waits_for_body(self):
+        head = b"POST /batch HTTP/1.1\r\nContent-Length: 10\r\n\r\n"
+        self.assertFalse(main.request_complete(b"GET / HTTP/1.1\r\n"))
+        self.assertTrue(main.request_complete(b"GET / HTTP/1.1\r\n\r\n"))
+        self.assertFalse(main.request_complete(head + b"12345"))
+        self.assertTrue(main.request_complete(head + b"1234567890"))
+
+    def test_lib_web_batch_saves_once(self):
+        import tempfile
+        sys.path.append(os.path.join(os.getcwd(), 'lib'))
+        import config as lib_config
+        import web as lib_web
+        path = os.path.join(tempfile.mkdtemp(), 'config.json')
+        cfg = lib_config.Config(path)
+        saves = []
+        save = cfg.save
+        cfg.save = lambda: (saves.append(1), save())
+        server = lib_web.WebServer(cfg, None, lambda: {"level": 42})
+        r = json.loads(server.router('POST', '/batch', json.dumps({"ops": [
+            {"op": "set", "key": "setpoint", "value": 70},
+            {"op": "set", "key": "lower_limit", "value": 30},
+            {"op": "get", "key": "level"}
+        ]})))
+        self.assertEqual(r["status"], "ok")
+        self.assertEqual(r["results"][2]["value"], 42)
+        self.assertEqual(len(saves), 1)
+        server.router('POST', '/pid', json.dumps({"setpoint": 75, "lower_limit": 35}))
+        self.assertEqual(len(saves), 2)
+        self.assertEqual(lib_config.Config(path).get('setpoint'), 75)
+
+class ScriptedConn(FakeConn):
+    def __init__(self, request, clock=None, cost_ms=0):
+        FakeConn.__init__(self)
+        self.request = request
+        self.clock = clock
+        self.cost_ms = cost_ms
+    def settimeout(self, t): pass
+    def recv(self, n):
+        if self.clock: self.clock.advance(self.cost_ms)
+        data, self.request = self.request, b""
+        return data
+    def close(self): pass
+
+class ScriptedSocket:
+    def __init__(self, conns):
+        self.conns = list(conns)
+    def accept(self):
+        if not self.conns:
+            raise OSError(11) # EAGAIN
+        return self.conns.pop(0)
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock().install()
+        self.ctrl = main.TankController()
+        self.ctrl.trig = None
+        self.loop = main.ServerLoop(self.ctrl)
+        self.loop.supervisor.wdt = None
+
+    def tearDown(self):
+        self.clock.uninstall()
+
+    def request(self, path, ip='192.168.4.2', cost_ms=0):
+        conn = ScriptedConn(b"GET %s HTTP/1.1\r\n\r\n" % path.encode(), self.clock, cost_ms)
+        return conn, (ip, 5000)
+
+    def status_line(self, conn):
+        return b"".join(conn.sent).split(b"\r\n", 1)[0]
+
+    def test_token_bucket_per_client(self):
+        adm = self.loop.admission
+        conns = [self.request('/status') for _ in range(adm.burst + 1)]
+        other = self.request('/status', ip='192.168.4.3')
+        self.loop.sock = ScriptedSocket(conns + [other])
+        self.loop.serve()
+        lines = [self.status_line(c) for c, _ in conns]
+        self.assertEqual(lines.count(b"HTTP/1.1 200 OK"), adm.burst)
+        self.assertEqual(lines[-1], b"HTTP/1.1 429 Too Many Requests")
+        self.assertEqual(self.status_line(other[0]), b"HTTP/1.1 200 OK")
+        self.assertEqual(adm.shed_429, 1)
+
+        # Tokens refill at rate/s
+        self.clock.advance(1000.0 / adm.rate)
+        conn = self.request('/status')
+        self.loop.sock = ScriptedSocket([conn])
+        self.loop.serve()
+        self.assertEqual(self.status_line(conn[0]), b"HTTP/1.1 200 OK")
+
+    def test_budget_bounds_step(self):
+        adm = self.loop.admission
+        conns = [self.request('/status', ip='192.168.4.%d' % i, cost_ms=10) for i in range(10)]
+        self.loop.sock = ScriptedSocket(conns)
+        t0 = self.clock.ticks_ms()
+        self.loop.serve()
+        self.assertLessEqual(self.clock.ticks_ms() - t0, adm.budget_ms)
+        served = sum(1 for c, _ in conns if c.sent)
+        self.assertEqual(served, adm.budget_ms // 10)
+        self.assertEqual(adm.exhausted, 1)
+        # The rest stay queued for the next step
+        self.assertEqual(len(self.loop.sock.conns), 10 - served)
+
+    def test_dashboard_shed_before_telemetry(self):
+        adm = self.loop.admission
+        slow = self.request('/status', ip='192.168.4.3', cost_ms=adm.budget_ms - main.ADMIT_STATIC_MIN_MS + 1)
+        page = self.request('/')
+        self.loop.sock = ScriptedSocket([slow, page])
+        self.loop.serve()
+        self.assertEqual(self.status_line(slow[0]), b"HTTP/1.1 200 OK")
+        self.assertEqual(self.status_line(page[0]), b"HTTP/1.1 503 Service Unavailable")
+        self.assertEqual(adm.stats()["shed_503"], 1)
+
+    def test_incomplete_request_times_out(self):
+        conn = ScriptedConn(b"GET /status HTTP/1.1\r\n")
+        self.loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        self.loop.serve()
+        self.assertEqual(self.status_line(conn), b"HTTP/1.1 408 Request Timeout")
+        self.assertEqual(self.loop.admission.timeouts, 1)
+
+    def test_slow_client_pays_tokens(self):
+        adm = self.loop.admission
+        stalled = [(ScriptedConn(b"GET /status HTTP/1.1\r\n", self.clock, adm.budget_ms), ('192.168.4.2', 5000))
+                   for _ in range(50)]
+        good = self.request('/status', ip='192.168.4.3')
+        self.loop.sock = ScriptedSocket(stalled + [good])
+        t0 = self.clock.ticks_ms()
+        steps = 0
+        while self.loop.sock.conns:
+            self.loop.serve()
+            steps += 1
+        # Each 408 cost a token; once they ran out the rest were shed unread
+        refill = (self.clock.ticks_ms() - t0) * adm.rate / 1000
+        self.assertLessEqual(adm.timeouts, adm.burst + refill)
+        self.assertEqual(adm.timeouts + adm.shed_429, 50)
+        self.assertLess(steps, 2 * adm.burst) # Not one stalled read per step
+        self.assertEqual(self.status_line(good[0]), b"HTTP/1.1 200 OK")
+
+    def test_dashboard_send_deadline(self):
+        clock = self.clock
+        class SlowAcks(ScriptedConn):
+            def sendall(self, data):
+                clock.advance(20) # Each chunk waits on a slow ACK
+                ScriptedConn.sendall(self, data)
+        conn = SlowAcks(b"GET / HTTP/1.1\r\n\r\n")
+        self.loop.sock = ScriptedSocket([(conn, ('192.168.4.2', 5000))])
+        t0 = clock.ticks_ms()
+        self.loop.serve()
+        self.assertLessEqual(clock.ticks_ms() - t0, main.ADMIT_STATIC_SEND_MS + 20)
+        self.assertEqual(self.loop.admission.send_aborts, 1)
+
+        # The control thread doesn't wait on it in dual-core mode
+        self.loop.dual_core = True
+        conn = SlowAcks(b"GET / HTTP/1.1\r\n\r\n")
+        self.loop.sock = ScriptedSocket([(conn, ('192.168.4.3', 5000))])
+        self.loop.serve()
+        with open(main.DASHBOARD_FILE, 'rb') as f:
+            self.assertTrue(b"".join(conn.sent).endswith(f.read()))
+        self.assertEqual(self.loop.admission.send_aborts, 1)
+
+    def test_malformed_request_never_ends_loop(self):
+        bad = ScriptedConn(b"GET /status\xff HTTP/1.1\r\n\r\n")
+        class Broken(ScriptedConn):
+            def sendall(self, data): raise ValueError("driver bug")
+        broken = Broken(b"GET /status HTTP/1.1\r\n\r\n")
+        good = self.request('/status', ip='192.168.4.3')
+        self.loop.sock = ScriptedSocket([(bad, ('192.168.4.2', 5000)), (broken, ('192.168.4.4', 5000)), good])
+        self.loop.step()
+        self.assertEqual(self.status_line(bad), b"HTTP/1.1 400 Bad Request")
+        self.assertEqual(self.status_line(good[0]), b"HTTP/1.1 200 OK")
+        st = self.loop.admission.stats()
+        self.assertEqual((st["malformed"], st["errors"]), (1, 1))
+
+    def test_response_gets_send_timeout(self):
+        timeouts = []
+        conn, addr = self.request('/status')
+        conn.settimeout = timeouts.append
+        self.loop.sock = ScriptedSocket([(conn, addr)])
+        self.loop.serve()
+        self.assertLessEqual(timeouts[0], self.loop.admission.budget_ms / 1000) # Read deadline
+        self.assertEqual(timeouts[-1], main.ADMIT_SEND_TIMEOUT_MS / 1000)
+        self.assertEqual(self.status_line(conn), b"HTTP/1.1 200 OK")
+
+class TestTelemetry(unittest.TestCase):
+    def test_loopback_one_send_per_tick(self):
+        from tools import telemetry_listen as tl
+        rx = tl.open_socket(0, bind='127.0.0.1')
+        port = rx.getsockname()[1]
+        try:
+            ctrl = main.TankController()
+            ctrl.trig = None
+            loop = main.ServerLoop(ctrl)
+            loop.sampler = None
+            loop.supervisor.wdt = None
+            loop.telemetry = main.TelemetryPublisher('127.0.0.1', port)
+            loop.telemetry.open()
+
+            loop.control_tick()
+            ctrl.set_config({"target_setpoint": 60.0})
+            loop.control_tick()
+            loop.control_tick()
+            self.assertEqual(loop.telemetry.stats()["sent"], 3)
+
+            got = []
+            reorder = tl.Reorderer()
+            tl.listen(rx, reorder, got.append, until=time.time() + 0.2)
+        finally:
+            rx.close()
+        self.assertEqual([p["seq"] for p in got], [1, 2, 3])
+        last = got[-1]
+        self.assertAlmostEqual(last["level_percent"], ctrl.level_percent, delta=1 / 256)
+        self.assertAlmostEqual(last["valve_percent"], ctrl.valve_percent, delta=1 / 256)
+        self.assertAlmostEqual(last["actuator_voltage"], ctrl.actuator_voltage, delta=0.001)
+        self.assertEqual(last["pump_on"], ctrl.pump_on)
+        self.assertEqual(last["config_version"], ctrl.config_version)
+        self.assertEqual(got[0]["config_version"] + 1, last["config_version"])
+        self.assertEqual(reorder.stats()["lost"], 0)
+
+    def test_rate_limit(self):
+        pub = main.TelemetryPublisher(period_ms=200)
+        pub.sock = type('Sock', (), {'sendto': lambda self, b, a: None})()
+        ctrl = main.TankController()
+        sent = [pub.publish(ctrl, now=t) for t in range(0, 1000, 50)]
+        self.assertEqual(sent.count(True), 5)
+        self.assertEqual(pub.seq, 5)
+
+    def test_reorder_and_gaps(self):
+        from tools import telemetry_listen as tl
+        r = tl.Reorderer(window=3)
+        out = []
+        for seq in (1, 3, 3, 2, 4, 2, 6, 7, 8):
+            out += [p["seq"] for p in r.push({"seq": seq})]
+        # 5 may still arrive: 6..8 are held
+        self.assertEqual(out, [1, 2, 3, 4])
+        out += [p["seq"] for p in r.push({"seq": 9})]
+        # Window full: 5 is given up
+        self.assertEqual(out, [1, 2, 3, 4, 6, 7, 8, 9])
+        r.push({"seq": 12})
+        out += [p["seq"] for p in r.flush()]
+        self.assertEqual(out[-1], 12)
+        st = r.stats()
+        self.assertEqual((st["lost"], st["duplicates"], st["late"]), (3, 1, 1))
+        self.assertEqual(st["released"], 9)
+
+    def test_sequence_wrap_and_restart(self):
+        from tools import telemetry_listen as tl
+        r = tl.Reorderer()
+        seqs = [tl.SEQ_MOD - 2, 0, tl.SEQ_MOD - 1, 1]
+        out = [p["seq"] for s in seqs for p in r.push({"seq": s})]
+        self.assertEqual(out, [tl.SEQ_MOD - 2, tl.SEQ_MOD - 1, 0, 1])
+        self.assertEqual(r.stats()["lost"], 0)
+        # A reordered straggler is late; a device reboot starts a new sequence
+        r.push({"seq": 0})
+        self.assertEqual(r.stats()["late"], 1)
+        r = tl.Reorderer()
+        r.push({"seq": 5000})
+        r.push({"seq": 5002})
+        out = [p["seq"] for p in r.push({"seq": 1})]
+        self.assertEqual(out, [5002, 1])
+        self.assertEqual(r.stats()["restarts"], 1)
+
+class TestTrace(unittest.TestCase):
+    def record(self, fixed, ticks=600):
+        import io
+        f = io.BytesIO()
+        live = []
+        with VirtualClock(start_ms=TICKS_MAX - 5000) as clock:
+            ctrl = main.FixedTankController() if fixed else main.TankController()
+            ctrl.trig = None
+            ctrl.simulated_level = 20.0
+            rec = main.TraceRecorder(f)
+            rec.start(ctrl)
+            for i in range(ticks):
+                clock.advance(100 if i != 300 else 70000) # One gap past the u16 delta
+                if i == 200:
+                    ctrl.set_config({"target_setpoint": 65.0, "kp": 3.0, "bogus": 1})
+                if i == 400:
+                    ctrl.safe_outputs()
+                if i == 420:
+                    ctrl.safe_hold = False
+                ctrl.update()
+                rec.service()
+                live.append((ctrl.valve_percent, ctrl.actuator_voltage, ctrl.pump_on))
+            rec.flush()
+        return f.getvalue(), live, rec
+
+    def test_replay_reproduces_outputs(self):
+        from tools import trace_replay
+        data, live, rec = self.record(fixed=False)
+        self.assertEqual(rec.samples, 600)
+        start, records = trace_replay.read_trace(data)
+        configs = [v for t, kind, v in records if kind == 'config']
+        self.assertEqual(len(configs), 2)
+        self.assertEqual(configs[1], {"target_setpoint": 65.0, "kp": 3.0})
+
+        out = trace_replay.replay(start, records)
+        self.assertEqual(len(out), len(live))
+        self.assertEqual(out[-1][0], 599 * 100 + 70000)
+        for (t, valve, volts, pump), (lv, lvolts, lpump) in zip(out, live):
+            # Distances are stored as float32
+            self.assertAlmostEqual(valve, lv, delta=1e-3)
+            self.assertAlmostEqual(volts, lvolts, delta=1e-3)
+            self.assertEqual(pump, lpump)
+        self.assertEqual(out, trace_replay.replay(start, records))
+
+    def test_fixed_point_replay_exact(self):
+        from tools import trace_replay
+        data, live, _ = self.record(fixed=True)
+        out = trace_replay.replay(*trace_replay.read_trace(data), fixed=True)
+        self.assertEqual([r[1:] for r in out], live)
+
+    def test_size_limit_and_truncation(self):
+        import io
+        from tools import trace_replay
+        data, _, _ = self.record(fixed=False, ticks=50)
+        # A record cut off by power loss is ignored
+        _, records = trace_replay.read_trace(data[:-3])
+        self.assertEqual(sum(1 for r in records if r[1] == 'sample'), 49)
+        with self.assertRaises(trace_replay.TraceError):
+            trace_replay.read_trace(b"nope" + data[4:])
+
+        rec = main.TraceRecorder(io.BytesIO(), buf_size=64, max_bytes=256)
+        rec.start(main.TankController())
+        for _ in range(100):
+            rec.sample(100.0)
+            rec.service()
+        self.assertFalse(rec.stats()["recording"])
+        self.assertLessEqual(rec.written, 256)
+        self.assertGreater(rec.dropped, 0)
+
+    def test_flushed_on_interval(self):
+        import io
+        f = io.BytesIO()
+        with VirtualClock() as clock:
+            rec = main.TraceRecorder(f, flush_ms=1000)
+            rec.start(main.TankController())
+            rec.flush()
+            size = len(f.getvalue())
+            for _ in range(9):
+                clock.advance(100)
+                rec.sample(100.0)
+                rec.service()
+            self.assertEqual(len(f.getvalue()), size) # Still buffered
+            clock.advance(100)
+            rec.sample(100.0)
+            self.assertEqual(len(f.getvalue()), size) # Never written inside the tick
+            rec.service()
+            self.assertEqual(len(f.getvalue()), size + 10 * main.TRACE_SAMPLE_SIZE)
+            self.assertEqual(rec.stats()["flushes"], 2)
+
+            # Unserviced, a full buffer drops samples rather than writing
+            rec = main.TraceRecorder(io.BytesIO(), buf_size=64)
+            rec.start(main.TankController())
+            rec.flush()
+            written = rec.written
+            for _ in range(20):
+                rec.sample(100.0)
+            self.assertEqual(rec.samples, (64 - main.TRACE_GAP_SIZE) // main.TRACE_SAMPLE_SIZE)
+            self.assertEqual(rec.dropped, 20 - rec.samples)
+            self.assertEqual(rec.written, written)
+
+    def test_serviced_after_control_tick(self):
+        import io
+        from tools import trace_replay
+        f = io.BytesIO()
+        with VirtualClock() as clock:
+            ctrl = main.TankController()
+            ctrl.trig = None
+            loop = main.ServerLoop(ctrl)
+            loop.sampler = None
+            loop.supervisor.wdt = None
+            main.TraceRecorder(f, flush_ms=0).start(ctrl)
+            clock.advance(50)
+            loop.control_tick()
+            _, records = trace_replay.read_trace(f.getvalue())
+            self.assertEqual([r[1] for r in records], ['config', 'sample'])
+
+    def test_previous_boots_kept(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'trace.bin')
+        for boot in (b"1", b"2", b"3", b"4"):
+            with main.open_trace(path, keep=3) as f:
+                f.write(boot)
+        def read(p):
+            with open(p, 'rb') as f:
+                return f.read()
+        self.assertEqual(read(path), b"4")
+        self.assertEqual(read(path + '.1'), b"3")
+        self.assertEqual(read(path + '.2'), b"2")
+        self.assertFalse(os.path.exists(path + '.3'))
+
+@unittest.skipIf(numpy is None, "tools/analytics.py needs NumPy")
+class TestAnalytics(unittest.TestCase):
+    ROWS = [
+        # t_ms, level, pump, setpoint: step 50 -> 60 at t=2000
+        (0, 50.0, 0, 50.0), (1000, 50.0, 1, 50.0), (2000, 52.0, 1, 60.0), (3000, 58.0, 0, 60.0),
+        (4000, 61.0, 1, 60.0), (5000, 60.5, 1, 60.0), (6000, 60.0, 1, 60.0)
+    ]
+
+    def write_csv(self, rows):
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write("t_ms,level_percent,valve_percent,pump_on,target_setpoint\n")
+            for t, level, pump, sp in rows:
+                f.write("%d,%.3f,0,%d,%.1f\n" % (t, level, pump, sp))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_kpis_by_hand(self):
+        from tools import analytics
+        path = self.write_csv(self.ROWS)
+        for chunk in (2, 3, 100):
+            r = analytics.analyze(path, chunk=chunk, start_level=20.0, stop_level=55.0, tol=2.0)
+            self.assertEqual(r["samples"], 7)
+            self.assertAlmostEqual(r["iae"], 11.5)
+            self.assertAlmostEqual(r["pump_duty"], 4 / 6)
+            self.assertEqual(r["pump_starts"], 2)
+            self.assertAlmostEqual(r["starts_per_hour"], 2 / (6 / 3600))
+            self.assertAlmostEqual(r["outside_band_s"], 3.0)
+            self.assertEqual(r["setpoint_steps"], 1)
+            self.assertAlmostEqual(r["steps"][0]["settling_s"], 1.0)
+            self.assertAlmostEqual(r["steps"][0]["overshoot_pct"], 10.0)
+
+    def test_chunk_size_independent(self):
+        from tools import analytics
+        rng = numpy.random.default_rng(3)
+        n = 20000
+        t = numpy.arange(n) * 100.0
+        sp = numpy.where((numpy.arange(n) // 3000) % 2, 65.0, 40.0)
+        level = sp + rng.normal(0, 1.5, n)
+        pump = rng.random(n) < 0.5
+
+        def run(chunk):
+            k = analytics.Kpis()
+            for i in range(0, n, chunk):
+                k.feed(t[i:i + chunk], level[i:i + chunk], pump[i:i + chunk], sp[i:i + chunk])
+            return k.result()
+
+        whole = run(n)
+        self.assertEqual(whole["setpoint_steps"], 6)
+        for chunk in (1, 999, 3000):
+            r = run(chunk)
+            for key in ("iae", "pump_duty", "outside_band_s", "pump_starts"):
+                self.assertAlmostEqual(r[key], whole[key], places=6)
+            self.assertEqual(r["steps"], whole["steps"])
+
+    def test_datagram_log(self):
+        import tempfile
+        from tools import analytics
+        pub = main.TelemetryPublisher()
+        frames = []
+        pub.sock = type('Sock', (), {'sendto': lambda self, b, a: frames.append(bytes(b))})()
+        ctrl = main.TankController()
+        ctrl.pump_on = True
+        start = TICKS_MAX - 250 # Device ticks wrap mid-log
+        for i in range(10):
+            ctrl.level_percent = 10.0 if i < 5 else 50.0
+            pub.publish(ctrl, now=(start + i * 100) & TICKS_MAX)
+        fd, path = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b"".join(frames))
+        self.addCleanup(os.remove, path)
+
+        r = analytics.analyze(path, chunk=4, setpoint=50.0, start_level=20.0)
+        self.assertEqual(r["samples"], 10)
+        self.assertAlmostEqual(r["duration_h"], 0.9 / 3600)
+        self.assertAlmostEqual(r["outside_band_s"], 0.5) # Below start_level 20
+        self.assertAlmostEqual(r["iae"], 40.0 * 0.5)
+        self.assertEqual(r["pump_duty"], 1.0)
+
+class TestCalibration(unittest.TestCase):
+    LINEAR = {"valve_curve": [[0, 0.66], [100, 3.3]], "duty_curve": [[0, 0], [3.3, 100]]}
+
+    def run_pair(self, cls, curves, ticks=400):
+        # Same plant and PID, once in linear mode and once with curves
+        rows = []
+        with VirtualClock() as clock:
+            ctrls = []
+            for cfg in ({}, curves):
+                c = cls()
+                c.trig = None
+                c.actuator = machine.PWM(machine.Pin(26))
+                c.set_config(dict(cfg, kp=4.0, ki=0.5, start_level=30.0, stop_level=70.0))
+                c.simulated_level = 10.0
+                ctrls.append(c)
+            for i in range(ticks):
+                clock.advance(100)
+                if i == 200:
+                    for c in ctrls: c.set_config({"target_setpoint": 40.0})
+                for c in ctrls:
+                    c.update()
+                    c.simulated_level = ctrls[0].simulated_level # One plant
+                rows.append([(c.valve_percent, c.actuator_voltage, c.actuator.duty_, c.pump_on) for c in ctrls])
+        return rows
+
+    def test_linear_curve_matches_linear_mode(self):
+        for cls in (main.TankController, main.FixedTankController):
+            pumped = 0
+            for lin, cal in self.run_pair(cls, self.LINEAR):
+                self.assertEqual(lin[0], cal[0])
+                self.assertEqual(lin[3], cal[3])
+                self.assertAlmostEqual(lin[1], cal[1], delta=0.002)
+                self.assertLessEqual(abs(lin[2] - cal[2]), 1)
+                pumped += lin[3]
+            self.assertGreater(pumped, 0)
+
+    def test_lut_sweep_against_linear_kernels(self):
+        ctrl = main.TankController()
+        ctrl.set_config(self.LINEAR)
+        ctrl._compile_curves()
+        for i in range(0, 25601, 37):
+            valve = i / 256
+            mv = main.lut_interp(ctrl._valve_lut, i, main.CAL_PCT_SHIFT, main.Q_PCT_100)
+            v = main.calc_actuator_volts(valve, 0.66, 3.3, True)
+            # Entries are rounded to 1 mV and interpolation floors
+            self.assertLessEqual(abs(mv - v * 1000), 1.5)
+            duty = main.lut_interp(ctrl._duty_lut, mv, main.CAL_MV_SHIFT, main.HW_MAX_MV)
+            self.assertLessEqual(abs(duty - main.calc_duty(mv / 1000, 1023)), 1)
+
+    def test_piecewise_curve(self):
+        ctrl = main.FixedTankController()
+        ctrl.set_config({"valve_curve": [[100, 3.0], [0, 0.5], [20, 1.5]], # Any order
+                         "duty_curve": [[0, 0], [1.0, 50], [3.3, 100]]})
+        ctrl._compile_config()
+        lut = lambda t, x, shift, top: main.lut_interp(t, x, shift, top)
+        self.assertEqual(lut(ctrl._valve_lut, 0, main.CAL_PCT_SHIFT, main.Q_PCT_100), 500)
+        self.assertEqual(lut(ctrl._valve_lut, 10 * 256, main.CAL_PCT_SHIFT, main.Q_PCT_100), 1000)
+        self.assertEqual(lut(ctrl._valve_lut, 60 * 256, main.CAL_PCT_SHIFT, main.Q_PCT_100), 2250)
+        self.assertAlmostEqual(lut(ctrl._valve_lut, 60 * 256 + 128, main.CAL_PCT_SHIFT, main.Q_PCT_100),
+                               2259.375, delta=1)
+        self.assertEqual(lut(ctrl._valve_lut, 200 * 256, main.CAL_PCT_SHIFT, main.Q_PCT_100), 3000)
+        # 1.0 V is between 4 mV grid points: the corner is cut slightly
+        self.assertAlmostEqual(lut(ctrl._duty_lut, 1000, main.CAL_MV_SHIFT, main.HW_MAX_MV), 511.5, delta=1)
+        self.assertEqual(lut(ctrl._duty_lut, 3300, main.CAL_MV_SHIFT, main.HW_MAX_MV), 1023)
+        self.assertEqual(len(ctrl._valve_lut), 102)
+
+    def test_invalid_curve_falls_back_to_linear(self):
+        ctrl = main.TankController()
+        for bad in ([[0, 1]], [[0, 1], [0, 2]], [["a", 1], [2, 3]], [1, 2]):
+            ctrl.set_config({"valve_curve": bad})
+            ctrl._compile_curves()
+            self.assertIsNone(ctrl._valve_lut)
+
+    def test_non_finite_curve_never_fails_tick(self):
+        for cls in (main.TankController, main.FixedTankController):
+            ctrl = cls()
+            ctrl.trig = None
+            for bad in ([[0, "nan"], [100, 3]], [[0, 0.66], ["inf", 3]], [[0, 1e400], [100, 3]]):
+                loop = main.ServerLoop(ctrl)
+                r = loop.batch({"ops": [{"op": "set", "key": "valve_curve", "value": bad},
+                                        {"op": "set", "key": "duty_curve", "value": bad}]})
+                self.assertEqual(r["status"], "ok") # Well-formed JSON lists
+                ctrl.update()
+                self.assertIsNone(ctrl._valve_lut)
+                self.assertIsNone(ctrl._duty_lut)
+        # A table that still can't be built is dropped, not raised
+        ctrl = main.TankController()
+        ctrl.set_config({"valve_curve": [[0, 0.5], [100, 3.0]], "valve_max_duty": "x",
+                         "duty_curve": [[0, 0], [3.3, 100]]})
+        ctrl._compile_curves()
+        self.assertIsNone(ctrl._duty_lut)
+
+    def test_batch_sets_curve(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        loop = main.ServerLoop(ctrl)
+        r = loop.batch({"ops": [{"op": "set", "key": "valve_curve", "value": [[0, 0.5], [100, 3.0]]}]})
+        self.assertEqual(r["status"], "ok")
+        ctrl.update()
+        self.assertIsNotNone(ctrl._valve_lut)
+        r = loop.batch({"ops": [{"op": "set", "key": "valve_curve", "value": 3}]})
+        self.assertEqual(r["status"], "err")
+
+class TestAdcSensor(unittest.TestCase):
+    CFG = {"sensor": "adc", "adc_empty": 400, "adc_full": 3600, "adc_atten": "6DB", "adc_width": 10,
+           "adc_samples": 16, "adc_decimate": 4, "tank_height": 200.0, "max_dist": 180.0}
+
+    def test_backend_from_config(self):
+        for cls in (main.TankController, main.FixedTankController):
+            ctrl = cls()
+            ctrl.set_config(self.CFG)
+            ctrl.update()
+            adc = ctrl.level_sensor.adc
+            self.assertEqual((adc.atten_, adc.width_), (machine.ADC.ATTN_6DB, machine.ADC.WIDTH_10BIT))
+            adc.value_ = 2000 # Half way between empty and full
+            ctrl.update()
+            self.assertEqual(ctrl.level_percent, 50.0)
+            self.assertEqual(adc.reads, 32) # One 16-conversion burst per tick
+
+            # Calibration changes keep the ADC and its buffer
+            buf = ctrl.level_sensor.buf
+            ctrl.set_config({"adc_full": 2000})
+            ctrl.update()
+            self.assertIs(ctrl.level_sensor.buf, buf)
+            self.assertEqual(ctrl.level_percent, 100.0)
+
+            ctrl.set_config({"sensor": "ultrasonic"})
+            ctrl.trig = None
+            ctrl.update()
+            self.assertIsNone(ctrl.level_sensor)
+
+    def test_bad_setup_falls_back(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        ctrl.set_config(dict(self.CFG, adc_atten="99DB"))
+        ctrl.update()
+        self.assertIsNone(ctrl.level_sensor)
+
+    def test_read_error_fails_safe(self):
+        def broken():
+            raise OSError(5) # EIO
+        for cls in (main.TankController, main.FixedTankController):
+            ctrl = cls()
+            ctrl.set_config(dict(self.CFG, deadband_enabled=True))
+            ctrl.update()
+            ctrl.level_sensor.adc.value_ = broken
+            ctrl.update() # Keeps running
+            # Distance 0, as an ultrasonic read error gives
+            self.assertEqual(ctrl.level_percent, main.calc_level_percent(0, 180.0, 200.0))
+            self.assertFalse(ctrl.pump_on)
+
+    def test_decimation_rejects_spike(self):
+        buf = [1000] * 16
+        buf[5] = 4095 # One relay spike
+        self.assertEqual(main.block_mean(buf, 4), 1000)
+        self.assertEqual(main.block_mean(list(range(8)), 4), 3) # Two blocks: plain mean
+        sensor = main.AdcLevelSensor(machine.ADC(machine.Pin(34)), samples=10, decimate=4)
+        self.assertEqual(len(sensor.buf), 8)
+        noise = iter([1000 + (i * 37 % 21) - 10 for i in range(8)])
+        sensor.adc.value_ = lambda: next(noise)
+        self.assertAlmostEqual(sensor.read_raw(), 1000, delta=3)
+
+class FakeGc:
+    # MicroPython's gc API over a counter: collect() frees all but `live`
+    def __init__(self, live=2000, heap=100000):
+        self.alloc = live
+        self.live = live
+        self.heap = heap
+        self.collects = 0
+        self.thresholds = []
+    def mem_alloc(self): return self.alloc
+    def mem_free(self): return self.heap - self.alloc
+    def collect(self):
+        self.alloc = self.live
+        self.collects += 1
+    def threshold(self, t): self.thresholds.append(t)
+
+class TestMemoryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock().install()
+        self.gc = FakeGc()
+        self.ctrl = main.TankController()
+        self.ctrl.trig = None
+        self.loop = main.ServerLoop(self.ctrl)
+        self.loop.sampler = None
+        self.loop.supervisor.wdt = None
+        self.loop.memory = self.mem = main.MemoryPolicy(gc_module=self.gc)
+        update = self.ctrl.update
+        def allocating_update():
+            self.gc.alloc += 3000
+            update()
+        self.ctrl.update = allocating_update
+
+    def tearDown(self):
+        self.clock.uninstall()
+
+    def test_collects_in_slack_after_tick(self):
+        for _ in range(30):
+            self.loop.step()
+            self.clock.advance(max(self.loop.idle_ms(), 1))
+        st = self.mem.stats()
+        self.assertEqual(st["collects"], 10) # Every third 3000-byte tick
+        self.assertEqual(st["tick_gcs"], 0)
+        self.assertEqual(st["auto_gcs"], 0)
+        self.assertEqual(st["tick_alloc_bytes"]["n"], 30)
+        self.assertEqual(st["tick_alloc_bytes"]["max"], 3000)
+        self.assertEqual(st["gc_pause_us"]["counts"][0], 10)
+        # Steady 3000 B/step: threshold ~8 steps, retuned only on large moves
+        self.assertAlmostEqual(self.gc.thresholds[-1], 8 * 3000, delta=8 * 3000 // 4)
+        self.assertLess(len(self.gc.thresholds), 8)
+
+    def test_defers_without_slack(self):
+        self.gc.alloc += 10000
+        self.assertFalse(self.mem.idle(main.GC_MIN_SLACK_MS - 1))
+        self.assertEqual(self.mem.no_slack, 1)
+        self.assertTrue(self.mem.idle(main.GC_MIN_SLACK_MS))
+        self.assertEqual(self.gc.alloc, self.gc.live)
+
+    def test_unscheduled_collections_counted(self):
+        self.mem.tick_begin()
+        self.gc.alloc = 100 # Collected mid-tick
+        self.mem.tick_end()
+        self.assertEqual(self.mem.tick_gcs, 1)
+        self.mem.idle(50)
+        self.assertEqual(self.mem.auto_gcs, 1)
+
+    def test_per_handler_allocations(self):
+        gc = self.gc
+        class AllocConn(ScriptedConn):
+            def recv(self, n):
+                gc.alloc += 500
+                return ScriptedConn.recv(self, n)
+        conns = [(AllocConn(b"GET %s HTTP/1.1\r\n\r\n" % p), ('192.168.4.%d' % i, 5000))
+                 for i, p in enumerate((b"/status", b"/status", b"/nope", b"/loop"))]
+        self.loop.sock = ScriptedSocket(conns)
+        self.loop.serve()
+        h = self.mem.stats()["handlers"]
+        self.assertEqual(h["/status"], {"requests": 2, "bytes": 1000, "max": 500})
+        self.assertEqual(h["other"]["requests"], 1)
+        body = b"".join(conns[3][0].sent).split(b"\r\n\r\n", 1)[1]
+        self.assertIn("memory", json.loads(body))
+
+    def test_cpython_gc_is_left_alone(self):
+        mem = main.MemoryPolicy()
+        self.assertFalse(mem.enabled)
+        self.assertFalse(mem.idle(1000))
+
+class TestOutputShadow(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock().install()
+
+    def tearDown(self):
+        self.clock.uninstall()
+
+    def run_ticks(self, ctrl, n):
+        for _ in range(n):
+            self.clock.advance(100)
+            ctrl.update()
+
+    def test_steady_outputs_written_once(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        ctrl.set_config({"kp": 0.0, "ki": 0.0, "kd": 0.0, "deadband_enabled": False})
+        self.run_ticks(ctrl, 100)
+        # Initial zero, then the first tick's value; every later tick is skipped
+        for out in (ctrl.pump, ctrl.led):
+            self.assertEqual(out.pin.writes, 2)
+            self.assertEqual(out.pin.value_, 1)
+        self.assertEqual(ctrl.actuator.pwm.writes, 2)
+        self.assertEqual(ctrl.actuator.pwm.duty_, main.calc_duty(0.66, 1023))
+        st = ctrl.output_stats()
+        self.assertEqual(st["pump"], {"writes": 2, "skipped": 99})
+        self.assertEqual(st["actuator"]["skipped"], 99)
+
+    def test_duty_resolution(self):
+        pwm = machine.PWM(machine.Pin(26))
+        out = main.ShadowPWM(pwm, resolution=4)
+        for d in (100, 102, 104, 105, 0, 0, 3):
+            out.duty(d)
+        self.assertEqual(pwm.writes, 4) # 100, 105, 0, 3
+        self.assertEqual(pwm.duty_, 3)
+        self.assertEqual(out.skipped, 3)
+
+        ctrl = main.TankController()
+        ctrl.set_config({"duty_resolution": 8})
+        ctrl.update()
+        self.assertEqual(ctrl.actuator.resolution, 8)
+
+    def test_safe_outputs_not_absorbed(self):
+        ctrl = main.TankController()
+        ctrl.trig = None
+        ctrl.set_config({"deadband_enabled": False, "duty_resolution": 1023})
+        self.run_ticks(ctrl, 5)
+        self.assertEqual(ctrl.pump.pin.value_, 1)
+        self.assertGreater(ctrl.actuator.pwm.duty_, 0)
+        ctrl.safe_outputs()
+        self.assertEqual(ctrl.pump.pin.value_, 0)
+        self.assertEqual(ctrl.led.pin.value_, 0)
+        self.assertEqual(ctrl.actuator.pwm.duty_, 0)
+
+    def test_same_outputs_as_raw_writes(self):
+        for cls in (main.TankController, main.FixedTankController):
+            shadow, raw = cls(), cls()
+            raw.actuator = machine.PWM(machine.Pin(26))
+            raw.pump = machine.Pin(16)
+            raw.led = machine.Pin(2)
+            for c in (shadow, raw):
+                c.trig = None
+            for _ in range(300):
+                self.clock.advance(100)
+                shadow.update()
+                raw.update()
+                self.assertEqual(shadow.actuator.pwm.duty_, raw.actuator.duty_)
+                self.assertEqual(shadow.pump.pin.value_, raw.pump.value_)
+            self.assertEqual(raw.pump.writes, 300)
+            self.assertLess(shadow.pump.pin.writes, 10)
+            self.assertLess(shadow.actuator.pwm.writes, raw.actuator.writes)
+
 if __name__ == '__main__':
     unittest.main()
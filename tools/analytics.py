@@ -0,0 +1,247 @@
+# Control-performance KPIs from exported controller telemetry (PC only, needs NumPy).
+#
+# Streams the log in fixed-size chunks, so memory stays bounded whatever
+# the file size, and computes per chunk with array operations:
+#   - settling time and overshoot after each setpoint change
+#   - IAE (integral of |setpoint - level|, %*s)
+#   - pump duty cycle and starts per hour
+#   - time outside the start_level/stop_level band
+#
+# Inputs:
+#   *.csv  header row with t_ms, level_percent, pump_on and optionally
+#          target_setpoint (else --setpoint); other columns are ignored
+#   other  raw telemetry datagrams as logged by telemetry_listen.py --log
+#          (no setpoint in the datagram: --setpoint applies throughout)
+#
+#   python3 tools/analytics.py log.csv [--chunk 1000000] [--tol 2.0]
+#   python3 tools/analytics.py --synth 5000000 big.csv   # Benchmark log
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# Same layout as TELEMETRY_FMT in main.py
+DATAGRAM = np.dtype([('magic', 'S2'), ('proto', 'u1'), ('flags', 'u1'), ('seq', '<u4'),
+                     ('ticks', '<u4'), ('level', '<u2'), ('valve', '<u2'), ('mv', '<u2'),
+                     ('version', '<u2')])
+TICKS_PERIOD = 1 << 30 # Device ticks_ms wrap
+
+# DEFAULT_CONFIG in main.py
+SETPOINT = 50.0
+START_LEVEL = 10.0
+STOP_LEVEL = 90.0
+SETTLE_TOL = 2.0 # Level within +/- this many % of the setpoint counts as settled
+CHUNK_ROWS = 1000000
+
+CSV_COLUMNS = ('t_ms', 'level_percent', 'pump_on')
+
+def read_csv_chunks(path, chunk=CHUNK_ROWS, setpoint=SETPOINT):
+    # Yields (t_ms, level, pump, setpoint) arrays of up to chunk rows
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+        missing = [c for c in CSV_COLUMNS if c not in header]
+        if missing:
+            raise ValueError("%s: missing column(s) %s" % (path, ", ".join(missing)))
+        cols = [header.index(c) for c in CSV_COLUMNS]
+        has_sp = 'target_setpoint' in header
+        if has_sp:
+            cols.append(header.index('target_setpoint'))
+        while True:
+            lines = [line for _, line in zip(range(chunk), f)]
+            if not lines:
+                return
+            a = np.loadtxt(lines, delimiter=',', usecols=cols, ndmin=2)
+            sp = a[:, 3] if has_sp else np.full(len(a), setpoint)
+            yield a[:, 0], a[:, 1], a[:, 2] != 0, sp
+
+def read_datagram_chunks(path, chunk=CHUNK_ROWS, setpoint=SETPOINT):
+    # Yields the same arrays from a raw datagram log; ticks are unwrapped
+    last = None
+    t0 = 0
+    with open(path, 'rb') as f:
+        while True:
+            d = np.fromfile(f, dtype=DATAGRAM, count=chunk)
+            if not len(d):
+                return
+            ticks = d['ticks'].astype(np.int64)
+            prev = ticks[0] if last is None else last
+            steps = np.diff(ticks, prepend=prev) % TICKS_PERIOD
+            t = t0 + np.cumsum(steps)
+            last, t0 = ticks[-1], t[-1]
+            yield (t.astype(np.float64), d['level'] / 256.0, (d['flags'] & 1) != 0,
+                   np.full(len(d), setpoint))
+
+class Kpis:
+    """Accumulates the KPIs chunk by chunk.
+
+    Between samples the previous value holds (the controller's outputs
+    are held until the next tick), so each interval is weighted by the
+    value at its start. The last sample of a chunk is carried into the
+    next, which makes the result independent of the chunk size.
+    """
+    def __init__(self, start_level=START_LEVEL, stop_level=STOP_LEVEL, tol=SETTLE_TOL):
+        self.start_level = start_level
+        self.stop_level = stop_level
+        self.tol = tol
+        self.samples = 0
+        self.total_ms = 0.0
+        self.iae = 0.0
+        self.pump_ms = 0.0
+        self.starts = 0
+        self.outside_ms = 0.0
+        self.steps = []
+        self._step = None
+        self._prev = None # (t, level, pump, sp) of the last sample seen
+
+    def feed(self, t, level, pump, sp):
+        n = len(t)
+        if not n:
+            return
+        self.samples += n
+        if self._prev is not None:
+            pt, pl, pp, ps = self._prev
+            t_all = np.concatenate(([pt], t))
+            l_all = np.concatenate(([pl], level))
+            p_all = np.concatenate(([pp], pump))
+            s_all = np.concatenate(([ps], sp))
+        else:
+            t_all, l_all, p_all, s_all = t, level, pump, sp
+
+        # Interval sums, value held from the start of each interval
+        dt = np.diff(t_all)
+        lv, pv = l_all[:-1], p_all[:-1]
+        self.total_ms += dt.sum()
+        self.iae += np.dot(np.abs(s_all[:-1] - lv), dt) / 1000.0
+        self.pump_ms += dt[pv].sum()
+        self.outside_ms += dt[(lv < self.start_level) | (lv > self.stop_level)].sum()
+        self.starts += int(np.count_nonzero(p_all[1:] & ~p_all[:-1]))
+
+        # Setpoint steps: split the new samples where the setpoint changes
+        changed = np.flatnonzero(s_all[1:] != s_all[:-1])
+        if self._prev is None:
+            changed += 1 # No carried sample: entry k-1 marks sample k
+        starts = set(changed.tolist())
+        bounds = sorted(starts | {0}) + [n]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if a in starts:
+                prev_sp = sp[a - 1] if a > 0 else self._prev[3]
+                self._close_step()
+                self._step = {"t0": t[a], "from": prev_sp, "to": sp[a], "peak": 0.0,
+                              "inside_since": None}
+            if self._step is not None:
+                self._track(t[a:b], level[a:b])
+
+        self._prev = (t[-1], level[-1], pump[-1], sp[-1])
+
+    def _track(self, t, level):
+        st = self._step
+        direction = 1.0 if st["to"] > st["from"] else -1.0
+        err = level - st["to"]
+        st["peak"] = max(st["peak"], float((err * direction).max()))
+        out = np.flatnonzero(np.abs(err) > self.tol)
+        if len(out):
+            k = out[-1] + 1
+            st["inside_since"] = t[k] if k < len(t) else None
+        elif st["inside_since"] is None:
+            st["inside_since"] = t[0]
+
+    def _close_step(self):
+        st = self._step
+        if st is None:
+            return
+        size = abs(st["to"] - st["from"])
+        settle = st["inside_since"]
+        self.steps.append({
+            "t_ms": float(st["t0"]),
+            "from": float(st["from"]),
+            "to": float(st["to"]),
+            "settling_s": (float(settle) - float(st["t0"])) / 1000.0 if settle is not None else None,
+            "overshoot_pct": 100.0 * st["peak"] / size if size else 0.0
+        })
+        self._step = None
+
+    def result(self):
+        self._close_step()
+        hours = self.total_ms / 3600000.0
+        settled = [s["settling_s"] for s in self.steps if s["settling_s"] is not None]
+        overshoot = [s["overshoot_pct"] for s in self.steps]
+        return {
+            "samples": self.samples,
+            "duration_h": hours,
+            "iae": self.iae,
+            "pump_duty": self.pump_ms / self.total_ms if self.total_ms else 0.0,
+            "pump_starts": self.starts,
+            "starts_per_hour": self.starts / hours if hours else 0.0,
+            "outside_band_s": self.outside_ms / 1000.0,
+            "outside_band_pct": 100.0 * self.outside_ms / self.total_ms if self.total_ms else 0.0,
+            "setpoint_steps": len(self.steps),
+            "unsettled_steps": len(self.steps) - len(settled),
+            "settling_s_max": max(settled) if settled else None,
+            "settling_s_mean": sum(settled) / len(settled) if settled else None,
+            "overshoot_pct_max": max(overshoot) if overshoot else None,
+            "steps": self.steps
+        }
+
+def analyze(path, chunk=CHUNK_ROWS, setpoint=SETPOINT, start_level=START_LEVEL,
+            stop_level=STOP_LEVEL, tol=SETTLE_TOL):
+    reader = read_csv_chunks if path.endswith('.csv') else read_datagram_chunks
+    kpis = Kpis(start_level, stop_level, tol)
+    t0 = time.perf_counter()
+    for arrays in reader(path, chunk, setpoint):
+        kpis.feed(*arrays)
+    elapsed = time.perf_counter() - t0
+    report = kpis.result()
+    report["elapsed_s"] = elapsed
+    report["samples_per_s"] = report["samples"] / elapsed if elapsed else 0.0
+    return report
+
+def synth_csv(path, rows, period_ms=100, seed=1, chunk=CHUNK_ROWS):
+    # A long closed-loop-looking log: setpoint steps every ~2 h, first-order
+    # response with noise, pump cycling on the deadband
+    rng = np.random.default_rng(seed)
+    level = 50.0
+    pump = False
+    with open(path, 'w') as f:
+        f.write("t_ms,level_percent,valve_percent,actuator_voltage,pump_on,target_setpoint\n")
+        for start in range(0, rows, chunk):
+            n = min(chunk, rows - start)
+            i = np.arange(start, start + n)
+            t = i * period_ms
+            sp = np.where((i // 72000) % 2, 60.0, 45.0)
+            # Exponential approach to the setpoint, restarted at each step
+            since = (i % 72000) * period_ms / 1000.0
+            prev_sp = np.where(sp == 60.0, 45.0, 60.0)
+            lv = sp + (prev_sp - sp) * np.exp(-since / 300.0) * np.cos(since / 120.0)
+            lv = lv + rng.normal(0, 0.3, n)
+            pump = (np.sin(t / 900000.0) > -0.2)
+            valve = np.clip(50 + (sp - lv) * 2.0, 0, 100)
+            volts = np.where(pump, 0.5 + valve / 100.0 * 2.0, 0.0)
+            np.savetxt(f, np.column_stack((t, lv, valve, volts, pump, sp)),
+                       fmt=('%d', '%.3f', '%.3f', '%.3f', '%d', '%.1f'), delimiter=',')
+
+def main():
+    ap = argparse.ArgumentParser(description="Control-performance KPIs from telemetry logs")
+    ap.add_argument('path')
+    ap.add_argument('--chunk', type=int, default=CHUNK_ROWS, help='rows per chunk')
+    ap.add_argument('--setpoint', type=float, default=SETPOINT, help='when the log has none')
+    ap.add_argument('--start-level', type=float, default=START_LEVEL)
+    ap.add_argument('--stop-level', type=float, default=STOP_LEVEL)
+    ap.add_argument('--tol', type=float, default=SETTLE_TOL, help='settling band, +/- %%')
+    ap.add_argument('--synth', type=int, metavar='ROWS', help='first write a synthetic CSV log to path')
+    ap.add_argument('--steps', action='store_true', help='include every setpoint step in the report')
+    args = ap.parse_args()
+
+    if args.synth:
+        synth_csv(args.path, args.synth)
+    report = analyze(args.path, args.chunk, args.setpoint, args.start_level, args.stop_level, args.tol)
+    if not args.steps:
+        del report["steps"]
+    print(json.dumps(report, indent=2))
+    print("%d samples in %.2f s: %.0f samples/s (%.1f MB)" % (
+        report["samples"], report["elapsed_s"], report["samples_per_s"],
+        os.path.getsize(args.path) / 1e6))
+
+if __name__ == '__main__':
+    main()
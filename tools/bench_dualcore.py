@@ -0,0 +1,32 @@
+# Control-tick jitter with the network in the same loop vs a separate thread.
+#
+# Runs tools/loadtest.py against a single-loop and a dual-core server with
+# the same client mix and prints the server-side tick lateness.
+#
+#   python3 tools/bench_dualcore.py [--clients 5] [--duration 15]
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import loadtest
+
+# Operators' phones polling status, one on a weak link, occasional edits
+MIX = {"index": 1, "status": 8, "config": 1, "slow": 2}
+
+def main():
+    ap = argparse.ArgumentParser(description="Tick jitter, single loop vs dual-core")
+    ap.add_argument('--clients', type=int, default=5)
+    ap.add_argument('--duration', type=float, default=15.0)
+    args = ap.parse_args()
+
+    print("mode          ticks  late  p50_ms  p95_ms  p99_ms  max_ms  client_p95_ms")
+    for dual in (False, True):
+        r = loadtest.run(args.clients, args.duration, mix=MIX, dual_core=dual)
+        late = r["server"]["tick_late_ms"]
+        print("%-12s %6d %5d %7s %7s %7s %7s %14.1f" % (
+            "dual-core" if dual else "single-loop", r["server"]["ticks"], r["server"]["late_ticks"],
+            late["p50"], late["p95"], late["p99"], late["max"], r["client"]["p95_ms"] or 0))
+
+if __name__ == '__main__':
+    main()
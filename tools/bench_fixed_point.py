@@ -0,0 +1,74 @@
+# Allocations and time per control tick: float vs fixed-point controller.
+#
+# On the ESP32 (copy main.py and this file, then `import bench_fixed_point`)
+# allocations are measured with gc.mem_alloc() while the GC is disabled.
+# CPython boxes every int too, so there only the timing is meaningful.
+#
+#   python3 tools/bench_fixed_point.py
+import sys
+import gc
+import time
+
+try:
+    import micropython
+    ON_DEVICE = True
+except ImportError:
+    import os
+    ON_DEVICE = False
+    sys.path.append(os.getcwd())
+    sys.path.append(os.path.join(os.getcwd(), 'tests/mocks'))
+    import time_mock
+
+import main
+
+TICKS = 2000
+# Precomputed sensor input so the sensor itself does not allocate
+INPUT_MM = [400 + (i * 7) % 600 for i in range(64)]
+INPUT_CM = [v / 10 for v in INPUT_MM]
+
+def make(cls):
+    ctrl = cls()
+    ctrl.trig = None
+    ctrl.pump = None # Never energize the relay from a benchmark
+    ctrl.led = None
+    ctrl.set_config({"kp": 2.0, "ki": 0.2, "kd": 0.1, "deadband_enabled": False})
+    idx = [0]
+    def next_mm():
+        idx[0] = (idx[0] + 1) & 63
+        return INPUT_MM[idx[0]]
+    def next_cm():
+        idx[0] = (idx[0] + 1) & 63
+        return INPUT_CM[idx[0]]
+    ctrl.read_distance_mm = next_mm
+    ctrl.read_distance = next_cm
+    return ctrl
+
+def run(cls):
+    ctrl = make(cls)
+    for _ in range(10):
+        ctrl.update()
+
+    alloc = None
+    gc.collect()
+    if ON_DEVICE:
+        gc.disable()
+        a0 = gc.mem_alloc()
+    t0 = time.ticks_us() if ON_DEVICE else time.perf_counter()
+    for _ in range(TICKS):
+        ctrl.update()
+    if ON_DEVICE:
+        elapsed_us = time.ticks_diff(time.ticks_us(), t0)
+        alloc = (gc.mem_alloc() - a0) / TICKS
+        gc.enable()
+    else:
+        elapsed_us = (time.perf_counter() - t0) * 1e6
+    return elapsed_us / TICKS, alloc
+
+def main_bench():
+    print("controller            us/tick   alloc bytes/tick")
+    for name, cls in (("float", main.TankController), ("fixed", main.FixedTankController)):
+        us, alloc = run(cls)
+        alloc_s = "%.1f" % alloc if alloc is not None else "n/a (CPython)"
+        print("%-20s %8.1f   %s" % (name, us, alloc_s))
+
+main_bench()
@@ -0,0 +1,131 @@
+# Per-tick time of the kernel-based update() against the previous inline
+# bytecode version. On the ESP32 the kernels are @micropython.native, so the
+# ratio is the speedup. On CPython both are plain Python and the kernels'
+# extra calls make them slower (roughly 0.4-0.9x), so only device numbers
+# mean anything.
+#
+#   python3 tools/bench_kernels.py
+import sys
+import time
+
+try:
+    import micropython
+    ON_DEVICE = True
+except ImportError:
+    import os
+    ON_DEVICE = False
+    sys.path.append(os.getcwd())
+    sys.path.append(os.path.join(os.getcwd(), 'tests/mocks'))
+    import time_mock
+
+import main
+
+TICKS = 2000
+INPUT_CM = [40.0 + (i * 7) % 120 for i in range(64)]
+
+class LegacyPID(main.PID):
+    def compute(self, input_val):
+        current_time = time.ticks_ms()
+        dt = time.ticks_diff(current_time, self._last_time) / 1000.0
+        if dt <= 0: dt = 0.1
+
+        error = self.setpoint - input_val
+        p_term = self.kp * error
+        self._integral += error * dt
+        if self._integral * self.ki > self.out_max: self._integral = self.out_max / self.ki if self.ki else 0
+        elif self._integral * self.ki < self.out_min: self._integral = self.out_min / self.ki if self.ki else 0
+        i_term = self.ki * self._integral
+        derivative = (error - self._last_error) / dt
+        d_term = self.kd * derivative
+        output = p_term + i_term + d_term
+        if output < self.out_min: output = self.out_min
+        elif output > self.out_max: output = self.out_max
+
+        self._last_error = error
+        self._last_time = current_time
+        return output
+
+class LegacyTankController(main.TankController):
+    def __init__(self):
+        main.TankController.__init__(self)
+        self.pid = LegacyPID(0, 0, 0, 0)
+
+    def update(self):
+        self.pid.update_params(self.config['kp'], self.config['ki'], self.config['kd'])
+        self.pid.setpoint = self.config['target_setpoint']
+
+        dist = self.read_distance()
+        h = self.config['tank_height']
+        empty = self.config['max_dist']
+        full = empty - h
+        span = empty - full
+        if span <= 0: span = 1
+        level_cm = empty - dist
+        self.level_percent = (level_cm / span) * 100.0
+        if self.level_percent < 0: self.level_percent = 0
+        if self.level_percent > 100: self.level_percent = 100
+
+        if self.config['deadband_enabled']:
+            if self.level_percent >= self.config['stop_level']:
+                self.pump_active_latch = False
+            elif self.level_percent <= self.config['start_level']:
+                self.pump_active_latch = True
+            self.pump_on = self.pump_active_latch
+        else:
+            self.pump_on = True
+
+        self.valve_percent = self.pid.compute(self.level_percent)
+
+        min_v = self.config['dac_min_v']
+        max_v = self.config['dac_max_v']
+        if self.pump_on:
+            voltage_span = max_v - min_v
+            if voltage_span < 0: voltage_span = 0
+            self.actuator_voltage = min_v + (self.valve_percent / 100.0 * voltage_span)
+        else:
+            self.actuator_voltage = 0.0
+        if self.actuator_voltage > 3.3: self.actuator_voltage = 3.3
+        if self.actuator_voltage < 0: self.actuator_voltage = 0
+
+        if self.actuator:
+            duty_fraction = self.actuator_voltage / 3.3
+            if duty_fraction > 1.0: duty_fraction = 1.0
+            self.actuator.duty(int(duty_fraction * self.config.get('valve_max_duty', 1023)))
+
+def make(cls):
+    ctrl = cls()
+    ctrl.trig = None
+    ctrl.pump = None # Never energize the relay from a benchmark
+    ctrl.led = None
+    ctrl.set_config({"kp": 2.0, "ki": 0.2, "kd": 0.1, "deadband_enabled": False})
+    idx = [0]
+    def next_cm():
+        idx[0] = (idx[0] + 1) & 63
+        return INPUT_CM[idx[0]]
+    ctrl.read_distance = next_cm
+    ctrl.read_distance_mm = lambda: int(next_cm() * 10)
+    return ctrl
+
+def per_tick_us(cls):
+    ctrl = make(cls)
+    for _ in range(10):
+        ctrl.update()
+    if ON_DEVICE:
+        t0 = time.ticks_us()
+        for _ in range(TICKS):
+            ctrl.update()
+        return time.ticks_diff(time.ticks_us(), t0) / TICKS
+    t0 = time.perf_counter()
+    for _ in range(TICKS):
+        ctrl.update()
+    return (time.perf_counter() - t0) * 1e6 / TICKS
+
+def main_bench():
+    base = per_tick_us(LegacyTankController)
+    print("path                  us/tick   speedup")
+    print("%-20s %8.1f   %5.2fx" % ("legacy bytecode", base, 1.0))
+    for name, cls in (("float kernels", main.TankController), ("fixed kernels", main.FixedTankController)):
+        us = per_tick_us(cls)
+        print("%-20s %8.1f   %5.2fx" % (name, us, base / us))
+
+main_bench()
@@ -0,0 +1,61 @@
+# Per-sample latency of the level sensor backends: ultrasonic ping vs the
+# oversampled ADC pressure transducer at a few burst lengths.
+#
+# On the ESP32 both read the real hardware (sensor on TRIG/ECHO, transducer
+# on adc_pin). On a PC the echo wait is modelled as the sound's round trip
+# over DISTANCE_CM and ADC conversions return at once, so only the ADC's
+# Python overhead is measured there.
+#
+#   python3 tools/bench_sensor.py
+import sys
+import time
+
+try:
+    import micropython
+    ON_DEVICE = True
+except ImportError:
+    import os
+    ON_DEVICE = False
+    sys.path.append(os.getcwd())
+    sys.path.append(os.path.join(os.getcwd(), 'tests/mocks'))
+    import time_mock
+
+import machine
+import main
+
+READS = 50
+DISTANCE_CM = 100.0
+BURSTS = ((8, 2), (32, 4), (64, 8)) # (adc_samples, adc_decimate)
+
+def now_us():
+    return time.ticks_us() if ON_DEVICE else int(time.perf_counter() * 1e6)
+
+if not ON_DEVICE:
+    def time_pulse_us(pin, level, timeout_us):
+        # Echo pulse lasts the sound's round trip; the sensor blocks meanwhile
+        pulse = int(DISTANCE_CM * 2 / 0.0343)
+        end = time.perf_counter() + pulse / 1e6
+        while time.perf_counter() < end:
+            pass
+        return pulse
+    machine.time_pulse_us = time_pulse_us
+
+def per_read_us(read):
+    read() # Warm up
+    t0 = now_us()
+    for _ in range(READS):
+        read()
+    return (now_us() - t0) / READS
+
+def main_bench():
+    ctrl = main.TankController()
+    print("backend              us/sample")
+    print("%-20s %9.0f" % ("ultrasonic", per_read_us(ctrl.read_distance)))
+
+    for samples, decimate in BURSTS:
+        ctrl.set_config({"sensor": "adc", "adc_samples": samples, "adc_decimate": decimate})
+        ctrl.read_distance() # Builds the ADC backend
+        name = "adc %dx/%d" % (samples, decimate)
+        print("%-20s %9.0f" % (name, per_read_us(ctrl.read_distance)))
+
+main_bench()
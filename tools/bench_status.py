@@ -0,0 +1,77 @@
+# /status requests per second through ServerLoop.serve(), with and without
+# the per-tick status cache. Five clients poll between consecutive control
+# ticks; the socket layer is an in-memory fake so only handler cost counts.
+# Each client has its own IP and enough token-bucket burst for the whole
+# run, so admission control never sheds a request here.
+#
+#   python3 tools/bench_status.py
+import sys
+import time
+
+try:
+    import micropython
+    ON_DEVICE = True
+except ImportError:
+    import os
+    ON_DEVICE = False
+    sys.path.append(os.getcwd())
+    sys.path.append(os.path.join(os.getcwd(), 'tests/mocks'))
+    import time_mock
+
+import main
+
+CLIENTS = 5
+TICKS = 400
+REQUEST = b"GET /status HTTP/1.1\r\nHost: 192.168.4.1\r\n\r\n"
+
+class FakeConn:
+    def settimeout(self, t): pass
+    def recv(self, n): return REQUEST
+    def send(self, data): return len(data)
+    def sendall(self, data): pass
+    def close(self): pass
+
+class FakeSocket:
+    # CLIENTS pending connections per tick, then EAGAIN like a drained backlog
+    conn = FakeConn()
+    def __init__(self):
+        self.pending = 0
+    def accept(self):
+        if not self.pending:
+            raise OSError(11) # EAGAIN
+        self.pending -= 1
+        return self.conn, ('192.168.4.%d' % (2 + self.pending), 5000)
+
+def now_us():
+    return time.ticks_us() if ON_DEVICE else int(time.perf_counter() * 1e6)
+
+def run(cached):
+    ctrl = main.TankController()
+    ctrl.trig = None
+    ctrl.pump = None # Never energize the relay from a benchmark
+    ctrl.led = None
+    loop = main.ServerLoop(ctrl)
+    loop.sampler = None # Tick every call
+    loop.supervisor.wdt = None
+    loop.sock = sock = FakeSocket()
+    loop.admission = main.AdmissionControl(burst=TICKS)
+    loop.status_cache.enabled = cached
+
+    busy_us = 0
+    for _ in range(TICKS):
+        loop.control_tick()
+        t0 = now_us()
+        sock.pending = CLIENTS
+        loop.serve()
+        busy_us += now_us() - t0
+    served = loop.admission.admitted
+    assert served == TICKS * CLIENTS, "only %d of %d requests admitted" % (served, TICKS * CLIENTS)
+    return served * 1e6 / busy_us, loop.status_cache.stats()
+
+def main_bench():
+    print("mode        req/s      hits   misses")
+    for name, cached in (("uncached", False), ("cached", True)):
+        rps, st = run(cached)
+        print("%-10s %8.0f %8d %8d" % (name, rps, st["hits"], st["misses"]))
+
+main_bench()
@@ -0,0 +1,290 @@
+# HTTP load / soak harness for the main.py server.
+#
+# Starts the real ServerLoop in simulation mode (mocked hardware, no sensor)
+# in a child process on a localhost port, drives it with concurrent clients
+# and writes a JSON report: client latency percentiles, error/reset rates
+# and the control-tick lateness the server measured during the run.
+#
+# Each client connects from its own loopback address (127.0.0.2, .3, ...)
+# so the server's per-client rate limits see separate phones. Requests the
+# server sheds on purpose (408/429/503) are reported as shed_rate, not errors.
+#
+#   python3 tools/loadtest.py --clients 4 --duration 30 --mix index=1,status=8,config=1 --out load.json
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_BOOT = """
+import sys
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {mocks!r})
+import time_mock
+import main
+ctrl = main.TankController()
+ctrl.trig = None
+main.start_server(ctrl, {port}, {dual_core})
+"""
+
+DEFAULT_MIX = {"index": 1, "status": 8, "config": 1}
+
+REQUESTS = {
+    "index": ("GET", "/", None),
+    "status": ("GET", "/status", None),
+    "config": ("POST", "/config", None), # Body built per request
+    "slow": ("GET", "/status", None),     # Sends its request SLOW_CLIENT_S after connecting
+}
+
+SLOW_CLIENT_S = 0.3 # A phone on a weak link
+SHED = ("http_408", "http_429", "http_503")
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def percentile(sorted_vals, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(pct / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+def hist_percentile(hist, pct):
+    # Upper bucket edge below which pct% of the histogram samples fall
+    n = sum(hist["counts"])
+    if not n:
+        return None
+    target = pct / 100.0 * n
+    seen = 0
+    for i, count in enumerate(hist["counts"]):
+        seen += count
+        if seen >= target:
+            if i < len(hist["edges"]) and hist["edges"][i] < hist["max"]:
+                return hist["edges"][i]
+            return hist["max"]
+    return hist["max"]
+
+def hist_delta(after, before):
+    return {
+        "edges": after["edges"],
+        "counts": [a - b for a, b in zip(after["counts"], before["counts"])],
+        "max": after["max"]
+    }
+
+class Server:
+    def __init__(self, port=None, dual_core=False):
+        self.port = port or free_port()
+        self.dual_core = dual_core
+        self.proc = None
+
+    def start(self, timeout=10.0):
+        code = SERVER_BOOT.format(root=ROOT, mocks=os.path.join(ROOT, 'tests', 'mocks'),
+                                  port=self.port, dual_core=self.dual_core)
+        self.proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return self.get_json('/loop')
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("server did not start on port %d" % self.port)
+
+    def get_json(self, path, timeout=5.0):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+        try:
+            conn.request('GET', path)
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+class Client(threading.Thread):
+    def __init__(self, port, mix, until, seed, timeout, source):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port
+        self.source = source
+        self.names = list(mix)
+        self.weights = [mix[n] for n in self.names]
+        self.until = until
+        self.rng = random.Random(seed)
+        self.timeout = timeout
+        self.results = [] # (name, latency_ms, outcome)
+
+    def slow_request(self):
+        t0 = time.perf_counter()
+        s = socket.create_connection(('127.0.0.1', self.port), timeout=self.timeout,
+                                     source_address=(self.source, 0))
+        try:
+            time.sleep(SLOW_CLIENT_S)
+            s.sendall(b"GET /status HTTP/1.1\r\nHost: tank\r\n\r\n")
+            data = b""
+            while True:
+                chunk = s.recv(4096)
+                if not chunk: break
+                data += chunk
+            status = data.split(b" ", 2)[1:2]
+            if status == [b"200"]:
+                outcome = "ok"
+            elif status:
+                outcome = "http_%s" % status[0].decode()
+            else:
+                outcome = "error"
+        except (ConnectionResetError, BrokenPipeError):
+            outcome = "reset"
+        except socket.timeout:
+            outcome = "timeout"
+        except OSError:
+            outcome = "error"
+        finally:
+            s.close()
+        return (time.perf_counter() - t0) * 1000.0, outcome
+
+    def request(self, name):
+        if name == "slow":
+            return self.slow_request()
+        method, path, body = REQUESTS[name]
+        headers = {}
+        if name == "config":
+            body = json.dumps({"target_setpoint": self.rng.choice((45.0, 50.0, 55.0))})
+            headers["Content-Type"] = "application/json"
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout,
+                                          source_address=(self.source, 0))
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            outcome = "ok" if resp.status == 200 else "http_%d" % resp.status
+        except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected):
+            outcome = "reset"
+        except socket.timeout:
+            outcome = "timeout"
+        except OSError:
+            outcome = "error"
+        finally:
+            conn.close()
+        return (time.perf_counter() - t0) * 1000.0, outcome
+
+    def run(self):
+        while time.time() < self.until:
+            name = self.rng.choices(self.names, self.weights)[0]
+            latency, outcome = self.request(name)
+            self.results.append((name, latency, outcome))
+
+def summarize(results, duration):
+    def block(rows):
+        lat = sorted(r[1] for r in rows if r[2] == "ok")
+        n = len(rows)
+        outcomes = {}
+        for r in rows:
+            outcomes[r[2]] = outcomes.get(r[2], 0) + 1
+        shed = sum(outcomes.get(o, 0) for o in SHED)
+        errors = n - outcomes.get("ok", 0) - shed
+        return {
+            "requests": n,
+            "rps": n / duration if duration else 0,
+            "p50_ms": percentile(lat, 50),
+            "p95_ms": percentile(lat, 95),
+            "p99_ms": percentile(lat, 99),
+            "max_ms": lat[-1] if lat else None,
+            "error_rate": errors / n if n else 0,
+            "reset_rate": outcomes.get("reset", 0) / n if n else 0,
+            "shed_rate": shed / n if n else 0,
+            "outcomes": outcomes
+        }
+
+    by_name = {}
+    for r in results:
+        by_name.setdefault(r[0], []).append(r)
+    report = block(results)
+    report["endpoints"] = {name: block(rows) for name, rows in sorted(by_name.items())}
+    return report
+
+def run(clients=4, duration=10.0, mix=None, seed=1, timeout=5.0, port=None, dual_core=False):
+    mix = mix or DEFAULT_MIX
+    server = Server(port, dual_core)
+    before = server.start()
+    try:
+        until = time.time() + duration
+        workers = [Client(server.port, mix, until, seed + i, timeout, '127.0.0.%d' % (i + 2))
+                   for i in range(clients)]
+        t0 = time.time()
+        for w in workers: w.start()
+        for w in workers: w.join()
+        elapsed = time.time() - t0
+        after = server.get_json('/loop')
+    finally:
+        server.stop()
+
+    results = [r for w in workers for r in w.results]
+    late = hist_delta(after["late_ms"], before["late_ms"])
+    admission = {k: after["admission"][k] - before["admission"][k]
+                 for k in ("admitted", "shed_429", "shed_503", "timeouts", "budget_exhausted")}
+    return {
+        "config": {"clients": clients, "duration_s": duration, "mix": mix, "seed": seed,
+                   "dual_core": dual_core},
+        "client": summarize(results, elapsed),
+        "server": {
+            "ticks": after["ticks"] - before["ticks"],
+            "late_ticks": after["late_ticks"] - before["late_ticks"],
+            "trips": after["trips"] - before["trips"],
+            "tick_late_ms": {
+                "p50": hist_percentile(late, 50),
+                "p95": hist_percentile(late, 95),
+                "p99": hist_percentile(late, 99),
+                "max": after["late_ms"]["max"],
+                "hist": late
+            },
+            "admission": admission
+        }
+    }
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in REQUESTS:
+            raise argparse.ArgumentTypeError("unknown request %r (use %s)" % (name, ", ".join(REQUESTS)))
+        mix[name] = float(weight)
+    return mix
+
+def main():
+    ap = argparse.ArgumentParser(description="HTTP load / soak harness for the main.py server")
+    ap.add_argument('--clients', type=int, default=4)
+    ap.add_argument('--duration', type=float, default=10.0, help='seconds')
+    ap.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='e.g. index=1,status=8,config=1')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--timeout', type=float, default=5.0, help='per-request timeout, seconds')
+    ap.add_argument('--dual-core', action='store_true', help='control loop in its own thread')
+    ap.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = ap.parse_args()
+
+    report = run(args.clients, args.duration, args.mix, args.seed, args.timeout, dual_core=args.dual_core)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
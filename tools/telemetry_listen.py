@@ -0,0 +1,189 @@
+# Listener for the UDP telemetry datagrams main.py broadcasts each tick.
+#
+# Datagrams are put back in sequence order through a small reorder window;
+# sequence numbers that never arrive are reported as gaps. Prints one line
+# per datagram and a summary on Ctrl-C.
+#
+# --log appends the in-order datagrams, as received, to a file that
+# tools/analytics.py reads.
+#
+#   python3 tools/telemetry_listen.py [--port 5005] [--group 239.1.2.3] [--window 8] [--log tank.bin]
+import argparse
+import socket
+import struct
+import time
+
+# Must match TELEMETRY_FMT in main.py
+FMT = '<2sBBIIHHHH'
+SIZE = struct.calcsize(FMT)
+MAGIC = b'TK'
+PROTO = 1
+SEQ_MOD = 1 << 32
+
+def decode(data):
+    # Telemetry dict, or None if this isn't one of our datagrams
+    if len(data) != SIZE:
+        return None
+    magic, proto, flags, seq, ticks, level, valve, mv, version = struct.unpack(FMT, data)
+    if magic != MAGIC or proto != PROTO:
+        return None
+    return {
+        "seq": seq,
+        "ticks_ms": ticks,
+        "level_percent": level / 256.0,
+        "valve_percent": valve / 256.0,
+        "actuator_voltage": mv / 1000.0,
+        "pump_on": bool(flags & 0x01),
+        "safe_hold": bool(flags & 0x02),
+        "config_version": version,
+        "raw": bytes(data)
+    }
+
+def seq_diff(a, b):
+    # a - b on the 32-bit sequence circle
+    return (a - b + SEQ_MOD // 2) % SEQ_MOD - SEQ_MOD // 2
+
+class Reorderer:
+    """Releases packets in sequence order.
+
+    Out-of-order packets are held until the missing ones arrive or the
+    window fills; then the missing sequence numbers are counted as lost.
+    Packets older than the last one released are dropped as late, unless
+    they are so far behind that the device must have rebooted.
+    """
+    def __init__(self, window=8):
+        self.window = window
+        self.next = None
+        self.held = {}
+        self.received = 0
+        self.released = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.late = 0
+        self.restarts = 0
+
+    def push(self, pkt):
+        # Returns the packets that are now in order
+        seq = pkt["seq"]
+        self.received += 1
+        if self.next is None:
+            self.next = seq
+        d = seq_diff(seq, self.next)
+        out = []
+        if d < -self.window:
+            # Sequence restarted: release what we hold and follow the new one
+            self.restarts += 1
+            out = self.flush()
+            self.next = seq
+            d = 0
+        elif d < 0:
+            self.late += 1
+            return []
+        if seq in self.held:
+            self.duplicates += 1
+            return []
+        if d > 0:
+            self.reordered += 1
+        self.held[seq] = pkt
+
+        n = len(out)
+        while True:
+            if self.next in self.held:
+                out.append(self.held.pop(self.next))
+                self.next = (self.next + 1) % SEQ_MOD
+            elif len(self.held) > self.window:
+                self.skip()
+            else:
+                break
+        self.released += len(out) - n
+        return out
+
+    def skip(self):
+        # Give up on everything before the oldest held packet
+        oldest = min(self.held, key=lambda s: seq_diff(s, self.next))
+        self.lost += seq_diff(oldest, self.next)
+        self.next = oldest
+
+    def flush(self):
+        out = []
+        while self.held:
+            if self.next not in self.held:
+                self.skip()
+            out.append(self.held.pop(self.next))
+            self.next = (self.next + 1) % SEQ_MOD
+        self.released += len(out)
+        return out
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "released": self.released,
+            "lost": self.lost,
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "late": self.late,
+            "restarts": self.restarts
+        }
+
+def open_socket(port, group=None, bind=''):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((bind, port))
+    if group:
+        mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return s
+
+def listen(sock, reorder, on_packet, until=None):
+    # Receive until the deadline (or forever); returns the number of foreign datagrams ignored
+    ignored = 0
+    while until is None or time.time() < until:
+        if until is not None:
+            sock.settimeout(max(0.01, until - time.time()))
+        try:
+            data, _ = sock.recvfrom(64)
+        except socket.timeout:
+            break
+        pkt = decode(data)
+        if pkt is None:
+            ignored += 1
+            continue
+        for p in reorder.push(pkt):
+            on_packet(p)
+    for p in reorder.flush():
+        on_packet(p)
+    return ignored
+
+def print_packet(p):
+    print("%10d %8d  level %6.2f%%  valve %6.2f%%  %5.3f V  pump %-3s  cfg v%d%s" % (
+        p["seq"], p["ticks_ms"], p["level_percent"], p["valve_percent"], p["actuator_voltage"],
+        "on" if p["pump_on"] else "off", p["config_version"], "  SAFE" if p["safe_hold"] else ""))
+
+def main():
+    ap = argparse.ArgumentParser(description="Listen for tank controller UDP telemetry")
+    ap.add_argument('--port', type=int, default=5005)
+    ap.add_argument('--group', help='multicast group to join (default: broadcast/unicast)')
+    ap.add_argument('--window', type=int, default=8, help='reorder window, datagrams')
+    ap.add_argument('--log', help='append raw datagrams to this file')
+    args = ap.parse_args()
+
+    log = open(args.log, 'ab') if args.log else None
+    def on_packet(p):
+        print_packet(p)
+        if log: log.write(p["raw"])
+
+    reorder = Reorderer(args.window)
+    sock = open_socket(args.port, args.group)
+    try:
+        listen(sock, reorder, on_packet)
+    except KeyboardInterrupt:
+        for p in reorder.flush():
+            on_packet(p)
+    finally:
+        sock.close()
+        if log: log.close()
+    print(reorder.stats())
+
+if __name__ == '__main__':
+    main()
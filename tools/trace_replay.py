@@ -0,0 +1,129 @@
+# Replays a sensor trace recorded on the device (TRACE_FILE in main.py)
+# through TankController.update() under a virtual clock, as fast as the
+# host runs, and writes the outputs the controller produced. Earlier boots
+# are kept on the device as TRACE_FILE.1, .2, ...
+#
+#   python3 tools/trace_replay.py trace.bin [--fixed] [--out outputs.csv]
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'tests', 'mocks'))
+from time_mock import VirtualClock
+
+import main
+
+HEADER_SIZE = struct.calcsize(main.TRACE_HEADER_FMT)
+CONFIG_SIZE = struct.calcsize(main.TRACE_CONFIG_FMT)
+GAP_SIZE = struct.calcsize(main.TRACE_GAP_FMT)
+
+class TraceError(ValueError):
+    pass
+
+def read_trace(data):
+    """Decode a trace. Returns (start_ms, records).
+
+    records is a list of (t_ms, kind, value) with t_ms relative to the
+    start: ('sample', (distance_cm, safe_hold)) or ('config', dict).
+    A record cut off at the end (power lost mid-write) is ignored.
+    """
+    if len(data) < HEADER_SIZE:
+        raise TraceError("not a trace: too short")
+    magic, version, start = struct.unpack_from(main.TRACE_HEADER_FMT, data, 0)
+    if magic != main.TRACE_MAGIC:
+        raise TraceError("not a trace: bad magic")
+    if version != main.TRACE_VERSION:
+        raise TraceError("unsupported trace version %d" % version)
+
+    records = []
+    t = 0
+    pos = HEADER_SIZE
+    n = len(data)
+    while pos < n:
+        tag = data[pos]
+        kind = tag & ~main.TRACE_SAFE
+        if kind == main.TRACE_SAMPLE:
+            if pos + main.TRACE_SAMPLE_SIZE > n: break
+            _, dt, dist = struct.unpack_from(main.TRACE_SAMPLE_FMT, data, pos)
+            pos += main.TRACE_SAMPLE_SIZE
+            t += dt
+            records.append((t, 'sample', (dist, bool(tag & main.TRACE_SAFE))))
+        elif kind == main.TRACE_CONFIG:
+            if pos + CONFIG_SIZE > n: break
+            _, dt, length = struct.unpack_from(main.TRACE_CONFIG_FMT, data, pos)
+            if pos + CONFIG_SIZE + length > n: break
+            body = data[pos + CONFIG_SIZE:pos + CONFIG_SIZE + length]
+            pos += CONFIG_SIZE + length
+            t += dt
+            records.append((t, 'config', json.loads(body)))
+        elif kind == main.TRACE_GAP:
+            if pos + GAP_SIZE > n: break
+            _, dt = struct.unpack_from(main.TRACE_GAP_FMT, data, pos)
+            pos += GAP_SIZE
+            t += dt
+        else:
+            raise TraceError("bad record tag 0x%02x at byte %d" % (tag, pos))
+    return start, records
+
+def replay(start, records, fixed=False):
+    """Feed the records to a fresh controller; returns one output row per sample.
+
+    Rows are (t_ms, valve_percent, actuator_voltage, pump_on).
+    """
+    clock = VirtualClock(start_ms=start)
+    with clock:
+        ctrl = main.FixedTankController() if fixed else main.TankController()
+        ctrl.trig = None
+        ctrl.pump = None
+        ctrl.actuator = None
+        ctrl.led = None
+
+        dist = [0.0]
+        ctrl.read_distance = lambda: dist[0]
+        ctrl.read_distance_mm = lambda: int(round(dist[0] * 10))
+
+        out = []
+        now = 0
+        for t, kind, value in records:
+            clock.advance(t - now)
+            now = t
+            if kind == 'config':
+                ctrl.set_config(value)
+            else:
+                dist[0], ctrl.safe_hold = value
+                ctrl.update()
+                out.append((t, ctrl.valve_percent, ctrl.actuator_voltage, ctrl.pump_on))
+    return out
+
+def write_csv(rows, f):
+    f.write("t_ms,valve_percent,actuator_voltage,pump_on\n")
+    for t, valve, volts, pump in rows:
+        f.write("%d,%.4f,%.4f,%d\n" % (t, valve, volts, 1 if pump else 0))
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="Replay a sensor trace through the controller")
+    ap.add_argument('trace')
+    ap.add_argument('--fixed', action='store_true', help='use FixedTankController')
+    ap.add_argument('--out', help='write outputs as CSV here')
+    args = ap.parse_args()
+
+    with open(args.trace, 'rb') as f:
+        start, records = read_trace(f.read())
+    t0 = time.perf_counter()
+    rows = replay(start, records, args.fixed)
+    elapsed = time.perf_counter() - t0
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            write_csv(rows, f)
+    span_s = records[-1][0] / 1000.0 if records else 0
+    print("%d samples (%.0f s of device time) replayed in %.3f s: %.0f samples/s" % (
+        len(rows), span_s, elapsed, len(rows) / elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+    main_cli()